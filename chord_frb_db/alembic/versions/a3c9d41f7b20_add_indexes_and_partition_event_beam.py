@@ -0,0 +1,90 @@
+"""add indexes; partition event_beam by month on PostgreSQL
+
+Revision ID: a3c9d41f7b20
+Revises: 676218ed23ab
+Create Date: 2026-10-18 14:02:37.512930
+
+"""
+from typing import Sequence, Union
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+from chord_frb_db.partitions import create_monthly_partitions
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3c9d41f7b20'
+down_revision: Union[str, None] = '676218ed23ab'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (index name, table, column)
+INDEXES = [
+    ('ix_event_timestamp', 'event', 'timestamp'),
+    ('ix_event_dm', 'event', 'dm'),
+    ('ix_event_is_rfi', 'event', 'is_rfi'),
+    ('ix_event_known_id', 'event', 'known_id'),
+    ('ix_event_beam_event_id', 'event_beam', 'event_id'),
+    ('ix_event_beam_timestamp_utc', 'event_beam', 'timestamp_utc'),
+]
+
+def is_postgres():
+    return op.get_bind().dialect.name == 'postgresql'
+
+def upgrade() -> None:
+    if is_postgres():
+        partition_event_beam()
+    for name,table,col in INDEXES:
+        # On PostgreSQL, indexes on the (partitioned) event_beam are created on each
+        # partition, including ones created later.
+        op.create_index(name, table, [col], unique=False)
+
+def partition_event_beam():
+    # Rebuild event_beam as a table partitioned by month on timestamp_utc.  The
+    # primary key of a partitioned table must include the partition column, so it
+    # becomes (id, timestamp_utc); ids still come from the same sequence.
+    #
+    # (The event table is not partitioned: event_beam has a foreign key to
+    # event.event_id, and a partitioned table can't have a unique constraint on
+    # event_id alone.)
+    conn = op.get_bind()
+    op.execute('ALTER TABLE event_beam RENAME TO event_beam_old')
+    op.execute('ALTER TABLE event_beam_old RENAME CONSTRAINT event_beam_pkey TO event_beam_old_pkey')
+    op.execute('ALTER TABLE event_beam_old DROP CONSTRAINT IF EXISTS event_beam_event_id_fkey')
+    op.execute('CREATE TABLE event_beam (LIKE event_beam_old INCLUDING DEFAULTS) '
+               'PARTITION BY RANGE (timestamp_utc)')
+    op.execute('ALTER TABLE event_beam ADD CONSTRAINT event_beam_pkey PRIMARY KEY (id, timestamp_utc)')
+    op.execute('ALTER TABLE event_beam ADD CONSTRAINT event_beam_event_id_fkey '
+               'FOREIGN KEY (event_id) REFERENCES event (event_id)')
+    op.execute('CREATE TABLE event_beam_default PARTITION OF event_beam DEFAULT')
+    # One partition for each month that has data, and a few months ahead.
+    months = conn.execute(sa.text(
+        "SELECT DISTINCT date_trunc('month', to_timestamp(timestamp_utc) AT TIME ZONE 'UTC') "
+        "FROM event_beam_old")).scalars().all()
+    for m in sorted(months):
+        create_monthly_partitions(conn, start=m.replace(tzinfo=timezone.utc), months_ahead=0)
+    create_monthly_partitions(conn, start=datetime.now(timezone.utc), months_ahead=3)
+    op.execute('INSERT INTO event_beam SELECT * FROM event_beam_old')
+    op.execute('ALTER SEQUENCE event_beam_id_seq OWNED BY event_beam.id')
+    op.execute('DROP TABLE event_beam_old')
+
+def unpartition_event_beam():
+    op.execute('ALTER TABLE event_beam RENAME TO event_beam_old')
+    op.execute('CREATE TABLE event_beam (LIKE event_beam_old INCLUDING DEFAULTS)')
+    op.execute('ALTER TABLE event_beam_old DROP CONSTRAINT event_beam_pkey')
+    op.execute('ALTER TABLE event_beam_old DROP CONSTRAINT event_beam_event_id_fkey')
+    op.execute('ALTER TABLE event_beam ADD CONSTRAINT event_beam_pkey PRIMARY KEY (id)')
+    op.execute('ALTER TABLE event_beam ADD CONSTRAINT event_beam_event_id_fkey '
+               'FOREIGN KEY (event_id) REFERENCES event (event_id)')
+    op.execute('INSERT INTO event_beam SELECT * FROM event_beam_old')
+    op.execute('ALTER SEQUENCE event_beam_id_seq OWNED BY event_beam.id')
+    # drops the partitions too
+    op.execute('DROP TABLE event_beam_old')
+
+def downgrade() -> None:
+    for name,table,col in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+    if is_postgres():
+        unpartition_event_beam()
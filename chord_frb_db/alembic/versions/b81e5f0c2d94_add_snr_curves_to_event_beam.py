@@ -0,0 +1,33 @@
+"""add S/N curves to event_beam
+
+Revision ID: b81e5f0c2d94
+Revises: a3c9d41f7b20
+Create Date: 2026-10-18 16:40:11.207354
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+import chord_frb_db.arrays
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b81e5f0c2d94'
+down_revision: Union[str, None] = 'a3c9d41f7b20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # REAL[] on PostgreSQL, BLOB on SQLite
+    op.add_column('event_beam', sa.Column('snr_vs_dm', chord_frb_db.arrays.Float32Array(), nullable=True))
+    op.add_column('event_beam', sa.Column('snr_vs_tree_index', chord_frb_db.arrays.Float32Array(), nullable=True))
+    op.add_column('event_beam', sa.Column('snr_vs_spectral_index', chord_frb_db.arrays.Float32Array(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('event_beam', 'snr_vs_spectral_index')
+    op.drop_column('event_beam', 'snr_vs_tree_index')
+    op.drop_column('event_beam', 'snr_vs_dm')
@@ -0,0 +1,156 @@
+'''
+Compact storage of float32 arrays (the per-beam S/N curves) in the database.
+
+Float32Array is a column type that is a REAL[] on PostgreSQL, and on other
+databases (SQLite) a blob: an 8-byte header -- the NumPy dtype string
+(b'<f4') padded to 4 bytes, and the uint32 number of elements -- followed by
+the packed values.  Either way, values go in and come out as NumPy arrays.
+
+Reading goes through np.frombuffer rather than per-element Python floats: on
+PostgreSQL, the column is SELECTed through array_send(), which returns the
+array in PostgreSQL's binary format (a header, then a 4-byte length and a
+big-endian float32 for each element), and that is decoded with one
+np.frombuffer call.
+
+For bulk reads, read_arrays() fetches one column for many rows in one query,
+without building ORM objects:
+
+    ids, curves = read_arrays(conn, EventBeam.snr_vs_dm, EventBeam.event_id.in_(event_ids))
+'''
+import struct
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.types import TypeDecorator, LargeBinary, REAL
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
+
+_HEADER = struct.Struct('<4sI')
+_DTYPE = np.dtype('<f4')
+
+# PostgreSQL binary array format ("array_send"): ndim, has-nulls flag, element type oid,
+# then (length, lower bound) for each dimension; then (byte length, value) per element.
+_PG_ARRAY_HEADER = struct.Struct('>iiI')
+_PG_FLOAT4_ELEMENT = np.dtype([('len', '>i4'), ('value', '>f4')])
+
+def pack_float32(arr):
+    '''
+    NumPy array -> bytes: header plus the packed float32 values.
+    '''
+    arr = np.ascontiguousarray(arr, dtype=_DTYPE).ravel()
+    return _HEADER.pack(_DTYPE.str.encode(), len(arr)) + arr.tobytes()
+
+def unpack_float32(data):
+    '''
+    bytes (from pack_float32) -> float32 NumPy array.
+    '''
+    dt, n = _HEADER.unpack_from(data)
+    dt = np.dtype(dt.rstrip(b'\0').decode())
+    return np.frombuffer(data, dt, count=n, offset=_HEADER.size).astype(np.float32, copy=False)
+
+def unpack_pg_float4_array(data):
+    '''
+    bytes (PostgreSQL binary array format, from array_send()) -> float32
+    NumPy array.  Only 1-d arrays without NULLs are supported.
+    '''
+    data = bytes(data)
+    ndim, hasnull, oid = _PG_ARRAY_HEADER.unpack_from(data)
+    if ndim == 0:
+        return np.zeros(0, np.float32)
+    if ndim != 1 or hasnull:
+        raise ValueError('Only 1-d float arrays without NULLs are supported')
+    n, lbound = struct.unpack_from('>ii', data, _PG_ARRAY_HEADER.size)
+    el = np.frombuffer(data, _PG_FLOAT4_ELEMENT, count=n, offset=_PG_ARRAY_HEADER.size + 8)
+    return el['value'].astype(np.float32)
+
+class _array_send(FunctionElement):
+    # array_send(x) on PostgreSQL, just x elsewhere.  Keeps x's type, so that results go
+    # through Float32Array.process_result_value.
+    inherit_cache = True
+
+    def __init__(self, col):
+        super().__init__(col)
+        self.type = col.type
+
+@compiles(_array_send)
+def _compile_array_send(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)
+
+@compiles(_array_send, 'postgresql')
+def _compile_array_send_pg(element, compiler, **kw):
+    return 'array_send(%s)' % compiler.process(element.clauses, **kw)
+
+class Float32Array(TypeDecorator):
+    '''
+    A 1-d array of float32: REAL[] on PostgreSQL, a packed blob elsewhere.
+    '''
+    impl = LargeBinary
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.ARRAY(REAL, dimensions=1))
+        return dialect.type_descriptor(LargeBinary())
+
+    def column_expression(self, col):
+        return _array_send(col)
+
+    def compare_values(self, x, y):
+        # (for the ORM's change detection; == on arrays is element-wise)
+        if x is None or y is None:
+            return x is y
+        return np.array_equal(np.asarray(x), np.asarray(y))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name == 'postgresql':
+            return np.asarray(value, np.float32).ravel().tolist()
+        return pack_float32(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name == 'postgresql':
+            if isinstance(value, list):
+                # (not SELECTed through column_expression)
+                return np.array(value, np.float32)
+            return unpack_pg_float4_array(value)
+        return unpack_float32(value)
+
+def pg_array_literals(arr):
+    '''
+    2-d NumPy array -> list of PostgreSQL array literals ('{1.5,2,...}'),
+    one per row, for COPY.
+    '''
+    arr = np.asarray(arr, np.float32)
+    if arr.size == 0:
+        return ['{}'] * len(arr)
+    strs = arr.astype(str)
+    return ['{' + ','.join(row) + '}' for row in strs]
+
+def read_arrays(conn, column, *where):
+    '''
+    Reads the array-valued *column* (eg EventBeam.snr_vs_dm) for the rows
+    matching the *where* clauses, in one query.  Returns (ids, arrays): the
+    primary keys, and a 2-d float32 array with one row per database row
+    (rows with NULL arrays, or arrays of a different length than the
+    first, are filled with NaN).
+    '''
+    table = column.table
+    pk = list(table.primary_key.columns)[0]
+    q = select(pk, column).where(*where).order_by(pk)
+    rows = conn.execute(q).all()
+    ids = np.array([r[0] for r in rows], np.int64)
+    n = 0
+    for r in rows:
+        if r[1] is not None:
+            n = len(r[1])
+            break
+    arrays = np.empty((len(rows), n), np.float32)
+    arrays[:,:] = np.nan
+    for i,r in enumerate(rows):
+        if r[1] is not None and len(r[1]) == n:
+            arrays[i,:] = r[1]
+    return ids, arrays
@@ -0,0 +1,177 @@
+'''
+Bulk database writes for the output of the FRB Sifter.
+
+Writing events through the ORM -- one EventBeam object per L1 event, with a
+flush() after each to get its id, and a commit per L2 event -- costs several
+round-trips per L1 event.  BulkWriter instead writes all the L2 events
+(Event rows) and L1 events (EventBeam rows) from a chunk's L2EventBatch
+(see chord_frb_sifter.events) in a few statements, in one transaction:
+
+* the Event rows go in one INSERT ... RETURNING event_id, executed as a
+  batched "insertmanyvalues" statement, which gives us their ids in order;
+* the EventBeam rows then get their event_id from those, and go in either
+  one executemany INSERT, or (on PostgreSQL with psycopg2, or psycopg 3) a
+  COPY.
+
+    writer = BulkWriter(engine)
+    for batch in pipeline_outputs:
+        event_ids = writer.write(batch)
+'''
+import io
+import csv
+
+import numpy as np
+from sqlalchemy import insert
+
+from chord_frb_db.models import Event, EventBeam
+from chord_frb_db.arrays import pg_array_literals
+
+def l2_batch_rows(batch):
+    '''
+    Converts an L2EventBatch into columns for the Event and EventBeam
+    tables: returns (event_columns, beam_columns), dicts of column name to
+    NumPy array.  The EventBeam rows are in group order, group i's rows
+    being [batch.l1_offsets[i], batch.l1_offsets[i+1]); their event_id
+    column is not filled in.
+    '''
+    ev = batch.events
+    l1 = batch.l1_events
+    n = len(ev)
+    offsets = batch.l1_offsets
+    # Combined (multi-beam) S/N: quadrature sum over beams
+    total_snr = np.zeros(n, np.float32)
+    if len(l1):
+        total_snr = np.sqrt(np.add.reduceat(l1['snr'].astype(np.float64)**2, offsets[:-1]))
+    # FIXME -- positions are the beam offsets from SimpleLocalizer (in deg) until we have a
+    # pointing model; there are no position errors yet.
+    events = dict(
+        # micro-seconds -> seconds
+        timestamp=ev['timestamp_utc'] * 1e-6,
+        is_rfi=np.zeros(n, bool),
+        is_known_pulsar=np.zeros(n, bool),
+        is_new_burst=np.zeros(n, bool),
+        is_frb=np.zeros(n, bool),
+        is_repeating_frb=np.zeros(n, bool),
+        # FIXME -- no RFI sifter yet; use the max-S/N L1 event's grade.
+        rfi_grade=ev['rfi_grade_level1'].astype(np.float32),
+        beam_activity=ev['beam_activity'],
+        best_beam=ev['beam'],
+        nbeams=ev['nbeams'],
+        best_snr=ev['max_snr'],
+        total_snr=total_snr.astype(np.float32),
+        dm=ev['dm'],
+        dm_error=ev['dm_error'],
+        ra=ev['average_dra'],
+        dec=ev['average_ddec'],
+        scattering=np.zeros(n, np.float32),
+        fluence=np.zeros(n, np.float32),
+    )
+    m = len(l1)
+    beams = dict(
+        beam=l1['beam'],
+        snr=l1['snr'],
+        timestamp_utc=l1['timestamp_utc'] * 1e-6,
+        timestamp_fpga=l1['timestamp_fpga'],
+        time_error=l1['time_error'],
+        tree_index=l1['tree_index'],
+        rfi_grade=l1['rfi_grade_level1'],
+        rfi_mask_fraction=l1['rfi_mask_fraction'],
+        rfi_clip_fraction=l1['rfi_clip_fraction'],
+        dm=l1['dm'],
+        dm_error=l1['dm_error'],
+        ra=l1['beam_dra'],
+        ra_error=np.zeros(m, np.float32),
+        dec=l1['beam_ddec'],
+        dec_error=np.zeros(m, np.float32),
+        # 2-d arrays, one row per L1 event
+        snr_vs_dm=l1['snr_vs_dm'],
+        snr_vs_tree_index=l1['snr_vs_tree_index'],
+        snr_vs_spectral_index=l1['snr_vs_spectral_index'],
+    )
+    return events, beams
+
+def columns_to_rows(columns):
+    # dict of arrays -> list of dicts, for executemany.  tolist() converts to Python
+    # scalars in C rather than element-by-element.  2-d arrays (the S/N curves) stay
+    # NumPy rows, for the Float32Array column type to pack.
+    keys = list(columns.keys())
+    cols = []
+    for k in keys:
+        c = np.asarray(columns[k])
+        cols.append(list(c) if c.ndim > 1 else c.tolist())
+    return [dict(zip(keys, vals)) for vals in zip(*cols)]
+
+class BulkWriter(object):
+    '''
+    Writes L2EventBatch objects to the database, one transaction per batch.
+
+    Parameters
+    ----------
+    engine : sqlalchemy Engine
+    use_copy : bool or None
+        Use PostgreSQL COPY for the EventBeam rows.  By default, COPY is
+        used when the engine is PostgreSQL with psycopg2 or psycopg 3.
+    '''
+    def __init__(self, engine, use_copy=None):
+        self.engine = engine
+        if use_copy is None:
+            use_copy = (engine.dialect.name == 'postgresql' and
+                        engine.dialect.driver in ['psycopg2', 'psycopg'])
+        self.use_copy = use_copy
+        self.n_events = 0
+        self.n_beams = 0
+
+    def write(self, batch):
+        '''
+        Writes *batch* and commits.  Returns the array of new event_ids (one
+        per L2 event).
+        '''
+        if len(batch) == 0:
+            return np.zeros(0, int)
+        events, beams = l2_batch_rows(batch)
+        with self.engine.begin() as conn:
+            event_ids = self.insert_events(conn, events)
+            beams['event_id'] = np.repeat(event_ids, batch.group_sizes())
+            self.insert_beams(conn, beams)
+        self.n_events += len(event_ids)
+        self.n_beams += len(beams['event_id'])
+        return event_ids
+
+    def insert_events(self, conn, events):
+        # INSERT ... RETURNING, batched by SQLAlchemy's "insertmanyvalues" into a few
+        # multi-row statements; sort_by_parameter_order makes the ids come back in the
+        # order of our rows.
+        st = insert(Event).returning(Event.event_id, sort_by_parameter_order=True)
+        result = conn.execute(st, columns_to_rows(events))
+        return np.array(result.scalars().all())
+
+    def insert_beams(self, conn, beams):
+        if self.use_copy:
+            self.copy_rows(conn, EventBeam.__table__.name, beams)
+        else:
+            conn.execute(insert(EventBeam), columns_to_rows(beams))
+
+    def copy_rows(self, conn, table, columns):
+        # PostgreSQL COPY ... FROM STDIN, from CSV formatted in memory.
+        keys = list(columns.keys())
+        cols = []
+        for k in keys:
+            c = np.asarray(columns[k])
+            cols.append(pg_array_literals(c) if c.ndim > 1 else c.tolist())
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerows(zip(*cols))
+        buf.seek(0)
+        sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (table, ', '.join(keys))
+        dbapi_conn = conn.connection.dbapi_connection
+        cursor = dbapi_conn.cursor()
+        try:
+            if hasattr(cursor, 'copy_expert'):
+                # psycopg2
+                cursor.copy_expert(sql, buf)
+            else:
+                # psycopg 3
+                with cursor.copy(sql) as copy:
+                    copy.write(buf.getvalue())
+        finally:
+            cursor.close()
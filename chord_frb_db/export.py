@@ -0,0 +1,278 @@
+'''
+Streaming exports of the Event and EventBeam tables, as NDJSON, CSV, Arrow
+IPC stream or Parquet (the last two need pyarrow).
+
+Rows are read through a server-side cursor (stream_results; a named cursor
+on PostgreSQL), chunk_size rows at a time, as plain Core rows rather than ORM
+objects; each chunk is transposed into columns and written out in the
+requested format.  The exporters are generators of bytes, so memory use
+stays flat however many rows are exported -- the web app streams them as
+chunked responses:
+
+    query = export_query('events', dict(t0=1.7e9, dm_min=100, is_rfi='0'))
+    for data in export_stream(engine, query, 'csv'):
+        f.write(data)
+'''
+import io
+import csv
+import json
+
+import numpy as np
+import sqlalchemy as sa
+
+from chord_frb_db.models import Event, EventBeam
+from chord_frb_db.arrays import Float32Array
+
+# name -> (model, timestamp column)
+EXPORT_TABLES = {
+    'events': (Event, Event.timestamp),
+    'event-beams': (EventBeam, EventBeam.timestamp_utc),
+}
+
+EXPORT_FLAGS = ['is_rfi', 'is_known_pulsar', 'is_new_burst', 'is_frb', 'is_repeating_frb']
+
+# format -> (MIME type, file name extension)
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+def _float_arg(args, name):
+    v = args.get(name)
+    if v is None:
+        return None
+    try:
+        return float(v)
+    except ValueError:
+        raise ValueError('Bad value for %s: %r' % (name, v))
+
+def _int_arg(args, name):
+    v = args.get(name)
+    if v is None:
+        return None
+    try:
+        return int(v)
+    except ValueError:
+        raise ValueError('Bad value for %s: %r' % (name, v))
+
+def _bool_arg(args, name):
+    v = args.get(name)
+    if v is None:
+        return None
+    v = v.lower()
+    if v in ['1', 'true', 't', 'yes']:
+        return True
+    if v in ['0', 'false', 'f', 'no']:
+        return False
+    raise ValueError('Bad value for %s: %r' % (name, v))
+
+def export_query(table, args):
+    '''
+    Builds the SELECT for exporting *table* ('events' or 'event-beams'),
+    filtered by *args* (eg, the request's query parameters):
+
+    t0, t1          : Unix time range [t0, t1)
+    dm_min, dm_max  : DM range
+    after           : primary key > after (to resume an export)
+    limit           : at most this many rows
+    columns         : comma-separated column names (default: all but the array columns)
+    is_rfi, is_frb, ... : (events) 0/1 flag values
+    event_id, beam  : (event-beams)
+
+    Rows are in primary-key order.  Raises ValueError for bad arguments.
+    '''
+    if table not in EXPORT_TABLES:
+        raise ValueError('Unknown table %r; options are %s' % (table, ', '.join(EXPORT_TABLES)))
+    model, tcol = EXPORT_TABLES[table]
+    cols = model.__table__.columns
+    names = args.get('columns')
+    if names is None:
+        columns = [c for c in cols if not isinstance(c.type, Float32Array)]
+    else:
+        columns = []
+        for n in names.split(','):
+            if n not in cols:
+                raise ValueError('Unknown column %r' % n)
+            columns.append(cols[n])
+    pk = list(model.__table__.primary_key.columns)[0]
+    query = sa.select(*columns)
+
+    t0 = _float_arg(args, 't0')
+    t1 = _float_arg(args, 't1')
+    if t0 is not None:
+        query = query.where(tcol >= t0)
+    if t1 is not None:
+        query = query.where(tcol < t1)
+    dm_min = _float_arg(args, 'dm_min')
+    dm_max = _float_arg(args, 'dm_max')
+    if dm_min is not None:
+        query = query.where(model.dm >= dm_min)
+    if dm_max is not None:
+        query = query.where(model.dm <= dm_max)
+    after = _int_arg(args, 'after')
+    if after is not None:
+        query = query.where(pk > after)
+    if model is Event:
+        for f in EXPORT_FLAGS:
+            v = _bool_arg(args, f)
+            if v is not None:
+                query = query.where(getattr(Event, f) == v)
+    else:
+        for f in ['event_id', 'beam']:
+            v = _int_arg(args, f)
+            if v is not None:
+                query = query.where(getattr(EventBeam, f) == v)
+    query = query.order_by(pk)
+    limit = _int_arg(args, 'limit')
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+def iter_column_batches(engine, query, chunk_size=10000):
+    '''
+    Runs *query* with a server-side cursor, yielding (names, columns) for
+    each chunk of up to *chunk_size* rows, where columns is a list with one
+    list of values per column.
+    '''
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True,
+                                        yield_per=chunk_size).execute(query)
+        names = list(result.keys())
+        for rows in result.partitions(chunk_size):
+            yield names, [list(c) for c in zip(*rows)]
+
+def _json_default(v):
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    if isinstance(v, np.generic):
+        return v.item()
+    raise TypeError('Cannot convert %s to JSON' % type(v))
+
+def ndjson_chunks(batches):
+    for names, cols in batches:
+        lines = [json.dumps(dict(zip(names, row)), default=_json_default)
+                 for row in zip(*cols)]
+        yield ('\n'.join(lines) + '\n').encode()
+
+def csv_chunks(batches, names):
+    # (the header goes out even if there are no rows)
+    buf = io.StringIO()
+    csv.writer(buf).writerow(names)
+    yield buf.getvalue().encode()
+    for names, cols in batches:
+        buf = io.StringIO()
+        csv.writer(buf).writerows(zip(*cols))
+        yield buf.getvalue().encode()
+
+class _ChunkSink(object):
+    # A write-only file for pyarrow that hands back what has been written since the last
+    # take(), while tell() keeps counting from the start (Parquet needs the offsets).
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def arrow_schema(query):
+    '''
+    The pyarrow Schema for the rows of *query*, from the column types.
+    '''
+    import pyarrow as pa
+    fields = []
+    for c in query.selected_columns:
+        t = c.type
+        if isinstance(t, Float32Array):
+            at = pa.list_(pa.float32())
+        elif isinstance(t, sa.Boolean):
+            at = pa.bool_()
+        elif isinstance(t, sa.SmallInteger):
+            at = pa.int16()
+        elif isinstance(t, sa.BigInteger):
+            at = pa.int64()
+        elif isinstance(t, sa.Integer):
+            at = pa.int32()
+        elif isinstance(t, sa.REAL):
+            at = pa.float32()
+        elif isinstance(t, sa.Float):
+            at = pa.float64()
+        else:
+            at = pa.string()
+        fields.append(pa.field(c.name, at, nullable=c.nullable))
+    return pa.schema(fields)
+
+def _record_batch(schema, cols):
+    import pyarrow as pa
+    arrays = []
+    for f,col in zip(schema, cols):
+        if pa.types.is_list(f.type):
+            col = [None if v is None else np.asarray(v, np.float32) for v in col]
+        arrays.append(pa.array(col, type=f.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def arrow_chunks(batches, schema):
+    import pyarrow as pa
+    sink = _ChunkSink()
+    with pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema) as writer:
+        for names, cols in batches:
+            writer.write_batch(_record_batch(schema, cols))
+            yield sink.take()
+    yield sink.take()
+
+def parquet_chunks(batches, schema):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    sink = _ChunkSink()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema) as writer:
+        for names, cols in batches:
+            # one row group per chunk
+            writer.write_batch(_record_batch(schema, cols))
+            yield sink.take()
+    yield sink.take()
+
+def export_stream(engine, query, fmt, chunk_size=10000):
+    '''
+    Returns a generator of the bytes of the rows of *query* in format *fmt*
+    ('ndjson', 'csv', 'arrow' or 'parquet').  Raises ValueError for an
+    unknown (or, for CSV with array columns, unsuitable) format or a
+    *chunk_size* < 1, and ImportError for 'arrow' or 'parquet' without
+    pyarrow.
+    '''
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError('Unknown format %r; options are %s' % (fmt, ', '.join(EXPORT_FORMATS)))
+    if chunk_size < 1:
+        raise ValueError('Bad chunk size: %r' % chunk_size)
+    batches = iter_column_batches(engine, query, chunk_size=chunk_size)
+    if fmt == 'ndjson':
+        return ndjson_chunks(batches)
+    if fmt == 'csv':
+        if any(isinstance(c.type, Float32Array) for c in query.selected_columns):
+            raise ValueError('Array columns cannot be exported as CSV')
+        return csv_chunks(batches, [c.name for c in query.selected_columns])
+    # (fail now, rather than part-way through the response)
+    import pyarrow
+    import pyarrow.parquet
+    schema = arrow_schema(query)
+    if fmt == 'arrow':
+        return arrow_chunks(batches, schema)
+    return parquet_chunks(batches, schema)
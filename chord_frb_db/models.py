@@ -6,6 +6,8 @@ from sqlalchemy import Table, Column, Integer, String, SmallInteger, BigInteger,
 
 import numpy as np
 
+from chord_frb_db.arrays import Float32Array
+
 class Base(DeclarativeBase):
     pass
 
@@ -15,12 +17,16 @@ class Base(DeclarativeBase):
 #         int32   = Integer
 #         int64   = BigInteger
 
+# Indexes (index=True) are on the columns that the web pages filter, sort or join on.  On
+# PostgreSQL, event_beam is also range-partitioned by month on timestamp_utc -- see
+# chord_frb_db/partitions.py.
+
 class Event(Base):
     __tablename__ = 'event'
     event_id:  Mapped[int] = mapped_column(primary_key=True)
     # ... FRB time at infinite frequency?  What time format?  Seconds since 1970.0
-    timestamp: Mapped[Optional[float]] = mapped_column(Double)
-    is_rfi:    Mapped[bool] = mapped_column(default=False)
+    timestamp: Mapped[Optional[float]] = mapped_column(Double, index=True)
+    is_rfi:    Mapped[bool] = mapped_column(default=False, index=True)
     # matches a known pulsar
     is_known_pulsar:  Mapped[bool] = mapped_column(default=False, server_default='false')
     # is a new event (FRB, incl repeats, new pulsar candidates)
@@ -44,7 +50,7 @@ class Event(Base):
     # multi-beam
     total_snr: Mapped[Optional[float]] = mapped_column(REAL)
 
-    dm:        Mapped[Optional[float]] = mapped_column(REAL)
+    dm:        Mapped[Optional[float]] = mapped_column(REAL, index=True)
     dm_error:  Mapped[Optional[float]] = mapped_column(REAL)
     # in deg
     ra:        Mapped[Optional[float]] = mapped_column(REAL)
@@ -66,7 +72,7 @@ class Event(Base):
     pulse_width:    Mapped[Optional[float]] = mapped_column(REAL)
 
     # Best known source match
-    known_id:       Mapped[Optional[int]] = mapped_column(ForeignKey('known_source.id'))
+    known_id:       Mapped[Optional[int]] = mapped_column(ForeignKey('known_source.id'), index=True)
     known:     Mapped['KnownSource'] = relationship(back_populates='events')
 
     #def __repr__(self) -> str:
@@ -84,7 +90,7 @@ class EventBeam(Base):
 
     snr:  Mapped[float] = mapped_column(REAL)
 
-    timestamp_utc:  Mapped[float] = mapped_column(Double)
+    timestamp_utc:  Mapped[float] = mapped_column(Double, index=True)
     timestamp_fpga: Mapped[int] = mapped_column(BigInteger)
 
     time_error: Mapped[float] = mapped_column(REAL)
@@ -97,10 +103,11 @@ class EventBeam(Base):
     rfi_mask_fraction: Mapped[float] = mapped_column(REAL)
     rfi_clip_fraction: Mapped[float] = mapped_column(REAL)
 
-    # Arrays: https://docs.sqlalchemy.org/en/20/core/type_basics.html#sqlalchemy.types.ARRAY
-    # snr_vs_dm:
-    # snr_vs_tree_index:
-    # snr_vs_spectral_index:
+    # S/N curves from the FRB Search, as float32 NumPy arrays (REAL[] on PostgreSQL, packed
+    # blobs on SQLite) -- see chord_frb_db/arrays.py.
+    snr_vs_dm:             Mapped[Optional[np.ndarray]] = mapped_column(Float32Array)
+    snr_vs_tree_index:     Mapped[Optional[np.ndarray]] = mapped_column(Float32Array)
+    snr_vs_spectral_index: Mapped[Optional[np.ndarray]] = mapped_column(Float32Array)
 
     dm:        Mapped[float] = mapped_column(REAL)
     dm_error:  Mapped[float] = mapped_column(REAL)
@@ -111,7 +118,7 @@ class EventBeam(Base):
     dec:       Mapped[float] = mapped_column(REAL)
     dec_error: Mapped[float] = mapped_column(REAL)
 
-    event_id: Mapped[Optional[int]] = mapped_column(ForeignKey("event.event_id"))
+    event_id: Mapped[Optional[int]] = mapped_column(ForeignKey("event.event_id"), index=True)
     event:     Mapped['Event'] = relationship(back_populates='beams')
 
 class KnownSource(Base):
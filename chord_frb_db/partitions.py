@@ -0,0 +1,87 @@
+'''
+Monthly range partitions for the big tables (PostgreSQL only).
+
+On PostgreSQL, event_beam is partitioned by RANGE on timestamp_utc (Unix
+seconds), one partition per UTC month (event_beam_y2025m01, ...), plus a
+DEFAULT partition that catches anything outside them (see the alembic
+migration a3c9d41f7b20).  Queries with a time range then only touch the
+months they need, and old months can be detached or dropped wholesale.
+
+New months need their partitions created ahead of time -- run this
+regularly (eg, from cron):
+
+    python -m chord_frb_db.partitions --months-ahead 3
+
+On SQLite (or any other database), this is a no-op.
+'''
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+# table name -> column it is partitioned on
+PARTITIONED_TABLES = {
+    'event_beam': 'timestamp_utc',
+}
+
+def month_start(year, month):
+    # Unix time of the start of the given UTC month (month may be > 12).
+    year += (month - 1) // 12
+    month = (month - 1) % 12 + 1
+    return datetime(year, month, 1, tzinfo=timezone.utc).timestamp()
+
+def partition_name(table, year, month):
+    return '%s_y%04im%02i' % (table, year, month)
+
+def create_partition_sql(table, year, month):
+    return ('CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM (%r) TO (%r)' %
+            (partition_name(table, year, month), table,
+             month_start(year, month), month_start(year, month + 1)))
+
+def create_monthly_partitions(conn, table='event_beam', start=None, months_ahead=3):
+    '''
+    Creates the monthly partitions of *table* from the month containing
+    *start* (a datetime; default now) through *months_ahead* months after
+    it, if they don't already exist.  Returns the list of partition names,
+    or [] if *conn* is not PostgreSQL.
+
+    Rows that arrive for a month without a partition land in the DEFAULT
+    partition; PostgreSQL won't create a partition overlapping rows in the
+    DEFAULT, so keep ahead of the data.
+    '''
+    if conn.dialect.name != 'postgresql':
+        return []
+    if table not in PARTITIONED_TABLES:
+        raise ValueError('Table %s is not partitioned' % table)
+    if start is None:
+        start = datetime.now(timezone.utc)
+    names = []
+    for i in range(months_ahead + 1):
+        m = start.month + i
+        year = start.year + (m - 1) // 12
+        month = (m - 1) % 12 + 1
+        conn.execute(text(create_partition_sql(table, year, month)))
+        names.append(partition_name(table, year, month))
+    return names
+
+def main():
+    import argparse
+    from chord_frb_db.utils import get_db_engine
+    parser = argparse.ArgumentParser(description='Create monthly partitions (PostgreSQL)')
+    parser.add_argument('--table', default='event_beam', choices=list(PARTITIONED_TABLES.keys()))
+    parser.add_argument('--start', help='First month (YYYY-MM; default: this month)')
+    parser.add_argument('--months-ahead', type=int, default=3)
+    opt = parser.parse_args()
+    start = None
+    if opt.start is not None:
+        start = datetime.strptime(opt.start, '%Y-%m').replace(tzinfo=timezone.utc)
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        names = create_monthly_partitions(conn, table=opt.table, start=start,
+                                          months_ahead=opt.months_ahead)
+    if len(names) == 0:
+        print('Not PostgreSQL -- no partitions to create.')
+    for n in names:
+        print('Partition', n)
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,106 @@
-def get_db_engine():
-    import os
-    from sqlalchemy import create_engine
-    from chord_frb_db.models import Base
-    db_url = os.environ.get('CHORD_FRB_DB_URL', 'sqlite+pysqlite:///db.sqlite3')
-    print('Using database URL:', db_url)
-    #engine = create_engine(db_url, echo=True)
-    engine = create_engine(db_url, echo=False)
-    if 'sqlite' in db_url:
-        # Make sure database tables exist
-        Base.metadata.create_all(engine)
-    return engine
+'''
+Database engine factory.
+
+get_db_engine() returns a process-wide cached SQLAlchemy Engine (one per
+database URL and set of pool options), so that scripts and workers that call
+it repeatedly share one connection pool, rather than each call making a new
+engine -- and, on SQLite, running create_all -- again.
+
+The pool options default from the environment:
+
+    CHORD_FRB_DB_URL            database URL (default sqlite+pysqlite:///db.sqlite3)
+    CHORD_FRB_DB_POOL_SIZE      connections kept in the pool (default 5)
+    CHORD_FRB_DB_MAX_OVERFLOW   extra connections allowed under load (default 10)
+    CHORD_FRB_DB_POOL_RECYCLE   seconds before a connection is replaced (default 1800)
+
+After a fork (multiprocessing workers, or uwsgi's prefork processes), the
+child must not use the connections it inherited from the parent: the
+cached engines' pools are reset in the child (without closing the parent's
+connections), and new connections are made on first use.
+
+On SQLite, connections use WAL journaling and synchronous=NORMAL, which is
+much faster for the many small transactions of a local replay run.
+'''
+import os
+import threading
+
+from sqlalchemy import create_engine, event
+
+# (url, options) -> Engine
+_engines = {}
+_engines_lock = threading.Lock()
+
+def _env_int(name, default):
+    v = os.environ.get(name)
+    if v is None:
+        return default
+    return int(v)
+
+def engine_options(db_url, pool_size=None, max_overflow=None, pool_recycle=None,
+                   pool_pre_ping=True):
+    '''
+    Returns the create_engine() keyword arguments for *db_url*, with
+    defaults from the environment (see above).  Also used for the web
+    app's SQLALCHEMY_ENGINE_OPTIONS.
+    '''
+    if pool_recycle is None:
+        pool_recycle = _env_int('CHORD_FRB_DB_POOL_RECYCLE', 1800)
+    opts = dict(pool_pre_ping=pool_pre_ping, pool_recycle=pool_recycle)
+    if not db_url.startswith('sqlite'):
+        if pool_size is None:
+            pool_size = _env_int('CHORD_FRB_DB_POOL_SIZE', 5)
+        if max_overflow is None:
+            max_overflow = _env_int('CHORD_FRB_DB_MAX_OVERFLOW', 10)
+        opts.update(pool_size=pool_size, max_overflow=max_overflow)
+    return opts
+
+def _set_sqlite_pragmas(dbapi_conn, conn_record):
+    cursor = dbapi_conn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+def get_db_engine(db_url=None, pool_size=None, max_overflow=None, pool_recycle=None,
+                  pool_pre_ping=True, echo=False):
+    '''
+    Returns the (cached) Engine for *db_url* (default: $CHORD_FRB_DB_URL,
+    or else a local SQLite file).  On SQLite, the tables are created if
+    they don't exist, when the engine is first made.
+    '''
+    if db_url is None:
+        db_url = os.environ.get('CHORD_FRB_DB_URL', 'sqlite+pysqlite:///db.sqlite3')
+    opts = engine_options(db_url, pool_size=pool_size, max_overflow=max_overflow,
+                          pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping)
+    opts['echo'] = echo
+    key = (db_url, tuple(sorted(opts.items())))
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is not None:
+            return engine
+        engine = create_engine(db_url, **opts)
+        print('Using database URL:', engine.url.render_as_string(hide_password=True))
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', _set_sqlite_pragmas)
+            from chord_frb_db.models import Base
+            # Make sure database tables exist
+            Base.metadata.create_all(engine)
+        _engines[key] = engine
+        return engine
+
+def dispose_engines(close=True):
+    '''
+    Disposes of the cached engines' connection pools.  With close=False
+    (as after a fork), the pooled connections are dropped without being
+    closed, since they belong to the parent process.
+    '''
+    for engine in list(_engines.values()):
+        engine.dispose(close=close)
+
+def _after_fork_in_child():
+    # The lock may have been held by another thread at the moment of the fork.
+    global _engines_lock
+    _engines_lock = threading.Lock()
+    dispose_engines(close=False)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
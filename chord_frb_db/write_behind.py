@@ -0,0 +1,322 @@
+'''
+Write-behind database writer for the FRB Sifter.
+
+A WriteBehindWriter takes finished L2EventBatch objects from the pipeline
+(put() never blocks) and writes them to the database from its own thread,
+so a slow commit doesn't hold up processing of the next chunk:
+
+* batches are coalesced into one transaction until there are
+  *max_batch_events* L2 events or the oldest has waited *max_age* seconds;
+* transient errors (lost connections, etc) are retried, with exponential
+  back-off;
+* if the queue is full -- or the database stays down through all the
+  retries -- batches are appended to a local spill file instead, which is
+  replayed into the database when the writer is next started;
+* batches that fail with a non-transient error (eg, an IntegrityError)
+  would fail again on every replay, so they are set aside in a "rejected"
+  file in the spill directory (rejected-<time>-<pid>.dat, in the spill file
+  format) for a human to look at.
+
+    writer = WriteBehindWriter(engine, spill_dir='db-spill')
+    writer.start()      # replays any spilled batches first
+    pipeline.add_stage('DB', writer.put)
+    ...
+    writer.stop()
+'''
+import os
+import glob
+import time
+import queue
+import pickle
+import struct
+import threading
+
+from sqlalchemy import exc
+
+from chord_frb_db.bulk import BulkWriter
+from chord_frb_sifter.events import L2EventBatch, concatenate_l2_batches
+
+# Put into the queue to tell the writer thread to finish up.
+_STOP = object()
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # (someone else's process)
+        pass
+    return True
+
+def is_transient_error(e):
+    # Errors that are worth retrying: the connection dropped or timed out, the database
+    # is restarting, deadlocks and serialization failures...
+    if isinstance(e, exc.DBAPIError) and e.connection_invalidated:
+        return True
+    return isinstance(e, (exc.OperationalError, exc.InterfaceError, exc.TimeoutError))
+
+class SpillFile(object):
+    '''
+    An append-only file of L2EventBatch records, each a length-prefixed
+    pickle of the batch's arrays.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def append(self, batch):
+        data = pickle.dumps(dict(events=batch.events, l1_events=batch.l1_events,
+                                 l1_offsets=batch.l1_offsets,
+                                 beam_activity_lookback=batch.beam_activity_lookback,
+                                 dm_activity_lookback=batch.dm_activity_lookback),
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            with open(self.filename, 'ab') as f:
+                f.write(struct.pack('<Q', len(data)))
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def read(filename):
+        # Yields the batches in *filename*.  A truncated last record (eg, if we crashed
+        # while writing it) is skipped.
+        with open(filename, 'rb') as f:
+            while True:
+                hdr = f.read(8)
+                if len(hdr) < 8:
+                    break
+                n, = struct.unpack('<Q', hdr)
+                data = f.read(n)
+                if len(data) < n:
+                    print('Spill file', filename, ': skipping truncated record')
+                    break
+                d = pickle.loads(data)
+                yield L2EventBatch(d['events'], d['l1_events'], d['l1_offsets'],
+                                   beam_activity_lookback=d['beam_activity_lookback'],
+                                   dm_activity_lookback=d['dm_activity_lookback'])
+
+class WriteBehindWriter(object):
+    '''
+    Parameters
+    ----------
+    engine : sqlalchemy Engine
+    queue_size : int
+        Maximum number of batches waiting to be written; more are spilled.
+    max_batch_events : int
+        Write a transaction once this many L2 events are waiting...
+    max_age : float
+        ... or once the oldest has waited this many seconds.
+    max_retries : int
+        Attempts for each transaction (on transient errors) before spilling it.
+    retry_delay : float
+        Seconds before the first retry; doubled for each further one.
+    spill_dir : str
+        Directory for the spill file (and rejected-batch files).
+    '''
+    def __init__(self, engine, queue_size=64, max_batch_events=10000, max_age=2.0,
+                 max_retries=5, retry_delay=0.5, spill_dir='db-spill'):
+        self.writer = BulkWriter(engine)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_batch_events = max_batch_events
+        self.max_age = max_age
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.spill_dir = spill_dir
+        os.makedirs(spill_dir, exist_ok=True)
+        self.spill = SpillFile(os.path.join(spill_dir, 'spill.dat'))
+        # created on the first rejected batch
+        self.rejected = None
+        self.thread = None
+
+        # Metrics
+        self.stats_lock = threading.Lock()
+        self.n_committed_events = 0
+        self.n_transactions = 0
+        self.n_retries = 0
+        self.n_spilled = 0
+        self.n_replayed = 0
+        self.n_rejected = 0
+        self.last_commit_latency = None
+        self.max_commit_latency = 0.
+        self.total_commit_latency = 0.
+
+    def start(self):
+        self.replay_spill()
+        self.thread = threading.Thread(target=self._run, name='WriteBehindWriter', daemon=True)
+        self.thread.start()
+
+    def put(self, batch):
+        '''
+        Queues *batch* (an L2EventBatch) to be written; never blocks.  If
+        the queue is full, the batch is spilled to disk.
+        '''
+        if batch is None or len(batch) == 0:
+            return
+        try:
+            self.queue.put_nowait((time.monotonic(), batch))
+        except queue.Full:
+            print('WriteBehindWriter: queue full - spilling %i events' % len(batch))
+            self._spill(batch)
+
+    def stop(self, timeout=None):
+        '''
+        Writes everything still queued and stops the writer thread.
+        '''
+        if self.thread is None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        with self.stats_lock:
+            return dict(queue_depth=self.queue.qsize(),
+                        committed_events=self.n_committed_events,
+                        transactions=self.n_transactions,
+                        retries=self.n_retries,
+                        spilled=self.n_spilled,
+                        replayed=self.n_replayed,
+                        rejected=self.n_rejected,
+                        last_commit_latency=self.last_commit_latency,
+                        max_commit_latency=self.max_commit_latency,
+                        mean_commit_latency=(self.total_commit_latency /
+                                             max(self.n_transactions, 1)))
+
+    def _spill(self, batch):
+        self.spill.append(batch)
+        with self.stats_lock:
+            self.n_spilled += len(batch)
+
+    def _reject(self, batch):
+        if self.rejected is None:
+            self.rejected = SpillFile(os.path.join(
+                self.spill_dir, 'rejected-%s-%i.dat' % (time.strftime('%Y%m%d-%H%M%S'),
+                                                        os.getpid())))
+        print('WriteBehindWriter: setting aside %i events in %s' %
+              (len(batch), self.rejected.filename))
+        self.rejected.append(batch)
+        with self.stats_lock:
+            self.n_rejected += len(batch)
+
+    def _failed(self, batch, err):
+        # Spills a batch that couldn't be written (to be retried next time), or sets it
+        # aside if retrying won't help.
+        if is_transient_error(err):
+            self._spill(batch)
+        else:
+            self._reject(batch)
+
+    def _spill_files(self):
+        # The spill file, plus any left by a replay that was interrupted (by a process
+        # that is no longer running -- another process may be replaying right now).
+        spill_fn = os.path.join(self.spill_dir, 'spill.dat')
+        fns = []
+        for fn in sorted(glob.glob(spill_fn + '.replaying-*')):
+            try:
+                pid = int(fn.split('.replaying-')[-1])
+            except ValueError:
+                continue
+            if pid == os.getpid() or not _pid_running(pid):
+                fns.append(fn)
+        if os.path.exists(spill_fn):
+            fns.append(spill_fn)
+        return fns
+
+    def replay_spill(self):
+        '''
+        Writes any spilled batches into the database.  Called by start().
+        '''
+        for fn in self._spill_files():
+            # Move it aside first, so that new spills go to a new file.
+            replay_fn = fn.split('.replaying')[0] + '.replaying-%i' % os.getpid()
+            try:
+                os.rename(fn, replay_fn)
+            except FileNotFoundError:
+                # another process got there first
+                continue
+            batches = list(SpillFile.read(replay_fn))
+            n = sum([len(b) for b in batches])
+            print('WriteBehindWriter: replaying %i spilled events from %s' % (n, fn))
+            for i,b in enumerate(batches):
+                err = self._write(b)
+                if err is None:
+                    with self.stats_lock:
+                        self.n_replayed += len(b)
+                elif not is_transient_error(err):
+                    # This batch will never go in; don't let it block the rest.
+                    self._reject(b)
+                else:
+                    # The database is still down -- spill the rest again, for next time.
+                    print('WriteBehindWriter: replay failed; re-spilling %i batches' %
+                          (len(batches) - i))
+                    for b in batches[i:]:
+                        self.spill.append(b)
+                    os.remove(replay_fn)
+                    return
+            os.remove(replay_fn)
+
+    def _run(self):
+        pending = []
+        npending = 0
+        oldest = None
+        stopping = False
+        while not stopping:
+            timeout = None
+            if oldest is not None:
+                timeout = max(0., self.max_age - (time.monotonic() - oldest))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                stopping = True
+            elif item is not None:
+                t, batch = item
+                if oldest is None:
+                    oldest = t
+                pending.append(batch)
+                npending += len(batch)
+            if len(pending) == 0:
+                continue
+            if (stopping or npending >= self.max_batch_events or
+                time.monotonic() - oldest >= self.max_age):
+                batch = concatenate_l2_batches(pending)
+                pending = []
+                npending = 0
+                oldest = None
+                err = self._write(batch)
+                if err is not None:
+                    self._failed(batch, err)
+
+    def _write(self, batch):
+        # Writes *batch* in one transaction, retrying transient errors.  Returns None if
+        # it was written, else the (last) exception.
+        delay = self.retry_delay
+        nattempts = max(self.max_retries, 1)
+        for attempt in range(nattempts):
+            t0 = time.monotonic()
+            try:
+                self.writer.write(batch)
+            except Exception as e:
+                if not is_transient_error(e) or attempt == nattempts - 1:
+                    print('WriteBehindWriter: failed to write %i events: %s' % (len(batch), e))
+                    return e
+                print('WriteBehindWriter: transient error (retrying in %g sec): %s' % (delay, e))
+                with self.stats_lock:
+                    self.n_retries += 1
+                time.sleep(delay)
+                delay *= 2
+                continue
+            dt = time.monotonic() - t0
+            with self.stats_lock:
+                self.n_committed_events += len(batch)
+                self.n_transactions += 1
+                self.last_commit_latency = dt
+                self.max_commit_latency = max(self.max_commit_latency, dt)
+                self.total_commit_latency += dt
+            return None
@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x10\x66rb_sifter.proto\"\x1d\n\rConfigMessage\x12\x0c\n\x04yaml\x18\x01 \x01(\t\"\x19\n\x0b\x43onfigReply\x12\n\n\x02ok\x18\x01 \x01(\x08\"p\n\x08\x46rbEvent\x12\x0f\n\x07\x62\x65\x61m_id\x18\x01 \x01(\x05\x12\x16\n\x0e\x66pga_timestamp\x18\x02 \x01(\x03\x12\n\n\x02\x64m\x18\x03 \x01(\x02\x12\x10\n\x08\x64m_error\x18\x04 \x01(\x02\x12\x0b\n\x03snr\x18\x05 \x01(\x02\x12\x10\n\x08rfi_prob\x18\x06 \x01(\x02\"t\n\x10\x46rbEventsMessage\x12\x16\n\x0ehas_injections\x18\x01 \x01(\x08\x12\x13\n\x0b\x62\x65\x61m_set_id\x18\x02 \x01(\x05\x12\x18\n\x10\x63hunk_fpga_count\x18\x03 \x01(\x03\x12\x19\n\x06\x65vents\x18\x04 \x03(\x0b\x32\t.FrbEvent\"-\n\x0e\x46rbEventsReply\x12\n\n\x02ok\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t2t\n\tFrbSifter\x12\x34\n\x12\x43heckConfiguration\x12\x0e.ConfigMessage\x1a\x0c.ConfigReply\"\x00\x12\x31\n\tFrbEvents\x12\x11.FrbEventsMessage\x1a\x0f.FrbEventsReply\"\x00\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x10\x66rb_sifter.proto\"0\n\rConfigMessage\x12\x0c\n\x04yaml\x18\x01 \x01(\t\x12\x11\n\tyaml_hash\x18\x02 \x01(\t\"@\n\x10\x43onfigDifference\x12\r\n\x05\x66ield\x18\x01 \x01(\t\x12\x10\n\x08\x65xpected\x18\x02 \x01(\t\x12\x0b\n\x03got\x18\x03 \x01(\t\"e\n\x0b\x43onfigReply\x12\n\n\x02ok\x18\x01 \x01(\x08\x12\x11\n\tneed_yaml\x18\x02 \x01(\x08\x12&\n\x0b\x64ifferences\x18\x03 \x03(\x0b\x32\x11.ConfigDifference\x12\x0f\n\x07message\x18\x04 \x01(\t\"p\n\x08\x46rbEvent\x12\x0f\n\x07\x62\x65\x61m_id\x18\x01 \x01(\x05\x12\x16\n\x0e\x66pga_timestamp\x18\x02 \x01(\x03\x12\n\n\x02\x64m\x18\x03 \x01(\x02\x12\x10\n\x08\x64m_error\x18\x04 \x01(\x02\x12\x0b\n\x03snr\x18\x05 \x01(\x02\x12\x10\n\x08rfi_prob\x18\x06 \x01(\x02\"w\n\x0f\x46rbEventColumns\x12\x0f\n\x07\x62\x65\x61m_id\x18\x01 \x03(\x05\x12\x16\n\x0e\x66pga_timestamp\x18\x02 \x03(\x03\x12\n\n\x02\x64m\x18\x03 \x03(\x02\x12\x10\n\x08\x64m_error\x18\x04 \x03(\x02\x12\x0b\n\x03snr\x18\x05 \x03(\x02\x12\x10\n\x08rfi_prob\x18\x06 \x03(\x02\"6\n\tRawColumn\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\r\n\x05\x64type\x18\x02 \x01(\t\x12\x0c\n\x04\x64\x61ta\x18\x03 \x01(\x0c\"<\n\x0c\x46rbEventsRaw\x12\x0f\n\x07nevents\x18\x01 \x01(\x05\x12\x1b\n\x07\x63olumns\x18\x02 \x03(\x0b\x32\n.RawColumn\"\xc2\x01\n\x10\x46rbEventsMessage\x12\x16\n\x0ehas_injections\x18\x01 \x01(\x08\x12\x13\n\x0b\x62\x65\x61m_set_id\x18\x02 \x01(\x05\x12\x18\n\x10\x63hunk_fpga_count\x18\x03 \x01(\x03\x12\x19\n\x06\x65vents\x18\x04 \x03(\x0b\x32\t.FrbEvent\x12#\n\x07\x63olumns\x18\x05 \x01(\x0b\x32\x10.FrbEventColumnsH\x00\x12\x1c\n\x03raw\x18\x06 \x01(\x0b\x32\r.FrbEventsRawH\x00\x42\t\n\x07payload\"-\n\x0e\x46rbEventsReply\x12\n\n\x02ok\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t2\xaf\x01\n\tFrbSifter\x12\x34\n\x12\x43heckConfiguration\x12\x0e.ConfigMessage\x1a\x0c.ConfigReply\"\x00\x12\x31\n\tFrbEvents\x12\x11.FrbEventsMessage\x1a\x0f.FrbEventsReply\"\x00\x12\x39\n\x0fStreamFrbEvents\x12\x11.FrbEventsMessage\x1a\x0f.FrbEventsReply\"\x00(\x01\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -32,15 +32,23 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'frb_sifter_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
   _globals['_CONFIGMESSAGE']._serialized_start=20
-  _globals['_CONFIGMESSAGE']._serialized_end=49
-  _globals['_CONFIGREPLY']._serialized_start=51
-  _globals['_CONFIGREPLY']._serialized_end=76
-  _globals['_FRBEVENT']._serialized_start=78
-  _globals['_FRBEVENT']._serialized_end=190
-  _globals['_FRBEVENTSMESSAGE']._serialized_start=192
-  _globals['_FRBEVENTSMESSAGE']._serialized_end=308
-  _globals['_FRBEVENTSREPLY']._serialized_start=310
-  _globals['_FRBEVENTSREPLY']._serialized_end=355
-  _globals['_FRBSIFTER']._serialized_start=357
-  _globals['_FRBSIFTER']._serialized_end=473
+  _globals['_CONFIGMESSAGE']._serialized_end=68
+  _globals['_CONFIGDIFFERENCE']._serialized_start=70
+  _globals['_CONFIGDIFFERENCE']._serialized_end=134
+  _globals['_CONFIGREPLY']._serialized_start=136
+  _globals['_CONFIGREPLY']._serialized_end=237
+  _globals['_FRBEVENT']._serialized_start=239
+  _globals['_FRBEVENT']._serialized_end=351
+  _globals['_FRBEVENTCOLUMNS']._serialized_start=353
+  _globals['_FRBEVENTCOLUMNS']._serialized_end=472
+  _globals['_RAWCOLUMN']._serialized_start=474
+  _globals['_RAWCOLUMN']._serialized_end=528
+  _globals['_FRBEVENTSRAW']._serialized_start=530
+  _globals['_FRBEVENTSRAW']._serialized_end=590
+  _globals['_FRBEVENTSMESSAGE']._serialized_start=593
+  _globals['_FRBEVENTSMESSAGE']._serialized_end=787
+  _globals['_FRBEVENTSREPLY']._serialized_start=789
+  _globals['_FRBEVENTSREPLY']._serialized_end=834
+  _globals['_FRBSIFTER']._serialized_start=837
+  _globals['_FRBSIFTER']._serialized_end=1012
 # @@protoc_insertion_point(module_scope)
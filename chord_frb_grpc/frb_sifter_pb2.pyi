@@ -7,16 +7,34 @@ from typing import ClassVar as _ClassVar, Optional as _Optional, Union as _Union
 DESCRIPTOR: _descriptor.FileDescriptor
 
 class ConfigMessage(_message.Message):
-    __slots__ = ("yaml",)
+    __slots__ = ("yaml", "yaml_hash")
     YAML_FIELD_NUMBER: _ClassVar[int]
+    YAML_HASH_FIELD_NUMBER: _ClassVar[int]
     yaml: str
-    def __init__(self, yaml: _Optional[str] = ...) -> None: ...
+    yaml_hash: str
+    def __init__(self, yaml: _Optional[str] = ..., yaml_hash: _Optional[str] = ...) -> None: ...
+
+class ConfigDifference(_message.Message):
+    __slots__ = ("field", "expected", "got")
+    FIELD_FIELD_NUMBER: _ClassVar[int]
+    EXPECTED_FIELD_NUMBER: _ClassVar[int]
+    GOT_FIELD_NUMBER: _ClassVar[int]
+    field: str
+    expected: str
+    got: str
+    def __init__(self, field: _Optional[str] = ..., expected: _Optional[str] = ..., got: _Optional[str] = ...) -> None: ...
 
 class ConfigReply(_message.Message):
-    __slots__ = ("ok",)
+    __slots__ = ("ok", "need_yaml", "differences", "message")
     OK_FIELD_NUMBER: _ClassVar[int]
+    NEED_YAML_FIELD_NUMBER: _ClassVar[int]
+    DIFFERENCES_FIELD_NUMBER: _ClassVar[int]
+    MESSAGE_FIELD_NUMBER: _ClassVar[int]
     ok: bool
-    def __init__(self, ok: bool = ...) -> None: ...
+    need_yaml: bool
+    differences: _containers.RepeatedCompositeFieldContainer[ConfigDifference]
+    message: str
+    def __init__(self, ok: bool = ..., need_yaml: bool = ..., differences: _Optional[_Iterable[_Union[ConfigDifference, _Mapping]]] = ..., message: _Optional[str] = ...) -> None: ...
 
 class FrbEvent(_message.Message):
     __slots__ = ("beam_id", "fpga_timestamp", "dm", "dm_error", "snr", "rfi_prob")
@@ -34,17 +52,55 @@ class FrbEvent(_message.Message):
     rfi_prob: float
     def __init__(self, beam_id: _Optional[int] = ..., fpga_timestamp: _Optional[int] = ..., dm: _Optional[float] = ..., dm_error: _Optional[float] = ..., snr: _Optional[float] = ..., rfi_prob: _Optional[float] = ...) -> None: ...
 
+class FrbEventColumns(_message.Message):
+    __slots__ = ("beam_id", "fpga_timestamp", "dm", "dm_error", "snr", "rfi_prob")
+    BEAM_ID_FIELD_NUMBER: _ClassVar[int]
+    FPGA_TIMESTAMP_FIELD_NUMBER: _ClassVar[int]
+    DM_FIELD_NUMBER: _ClassVar[int]
+    DM_ERROR_FIELD_NUMBER: _ClassVar[int]
+    SNR_FIELD_NUMBER: _ClassVar[int]
+    RFI_PROB_FIELD_NUMBER: _ClassVar[int]
+    beam_id: _containers.RepeatedScalarFieldContainer[int]
+    fpga_timestamp: _containers.RepeatedScalarFieldContainer[int]
+    dm: _containers.RepeatedScalarFieldContainer[float]
+    dm_error: _containers.RepeatedScalarFieldContainer[float]
+    snr: _containers.RepeatedScalarFieldContainer[float]
+    rfi_prob: _containers.RepeatedScalarFieldContainer[float]
+    def __init__(self, beam_id: _Optional[_Iterable[int]] = ..., fpga_timestamp: _Optional[_Iterable[int]] = ..., dm: _Optional[_Iterable[float]] = ..., dm_error: _Optional[_Iterable[float]] = ..., snr: _Optional[_Iterable[float]] = ..., rfi_prob: _Optional[_Iterable[float]] = ...) -> None: ...
+
+class RawColumn(_message.Message):
+    __slots__ = ("name", "dtype", "data")
+    NAME_FIELD_NUMBER: _ClassVar[int]
+    DTYPE_FIELD_NUMBER: _ClassVar[int]
+    DATA_FIELD_NUMBER: _ClassVar[int]
+    name: str
+    dtype: str
+    data: bytes
+    def __init__(self, name: _Optional[str] = ..., dtype: _Optional[str] = ..., data: _Optional[bytes] = ...) -> None: ...
+
+class FrbEventsRaw(_message.Message):
+    __slots__ = ("nevents", "columns")
+    NEVENTS_FIELD_NUMBER: _ClassVar[int]
+    COLUMNS_FIELD_NUMBER: _ClassVar[int]
+    nevents: int
+    columns: _containers.RepeatedCompositeFieldContainer[RawColumn]
+    def __init__(self, nevents: _Optional[int] = ..., columns: _Optional[_Iterable[_Union[RawColumn, _Mapping]]] = ...) -> None: ...
+
 class FrbEventsMessage(_message.Message):
-    __slots__ = ("has_injections", "beam_set_id", "chunk_fpga_count", "events")
+    __slots__ = ("has_injections", "beam_set_id", "chunk_fpga_count", "events", "columns", "raw")
     HAS_INJECTIONS_FIELD_NUMBER: _ClassVar[int]
     BEAM_SET_ID_FIELD_NUMBER: _ClassVar[int]
     CHUNK_FPGA_COUNT_FIELD_NUMBER: _ClassVar[int]
     EVENTS_FIELD_NUMBER: _ClassVar[int]
+    COLUMNS_FIELD_NUMBER: _ClassVar[int]
+    RAW_FIELD_NUMBER: _ClassVar[int]
     has_injections: bool
     beam_set_id: int
     chunk_fpga_count: int
     events: _containers.RepeatedCompositeFieldContainer[FrbEvent]
-    def __init__(self, has_injections: bool = ..., beam_set_id: _Optional[int] = ..., chunk_fpga_count: _Optional[int] = ..., events: _Optional[_Iterable[_Union[FrbEvent, _Mapping]]] = ...) -> None: ...
+    columns: FrbEventColumns
+    raw: FrbEventsRaw
+    def __init__(self, has_injections: bool = ..., beam_set_id: _Optional[int] = ..., chunk_fpga_count: _Optional[int] = ..., events: _Optional[_Iterable[_Union[FrbEvent, _Mapping]]] = ..., columns: _Optional[_Union[FrbEventColumns, _Mapping]] = ..., raw: _Optional[_Union[FrbEventsRaw, _Mapping]] = ...) -> None: ...
 
 class FrbEventsReply(_message.Message):
     __slots__ = ("ok", "message")
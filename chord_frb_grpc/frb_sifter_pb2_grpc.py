@@ -44,6 +44,11 @@ class FrbSifterStub(object):
                 request_serializer=frb__sifter__pb2.FrbEventsMessage.SerializeToString,
                 response_deserializer=frb__sifter__pb2.FrbEventsReply.FromString,
                 _registered_method=True)
+        self.StreamFrbEvents = channel.stream_unary(
+                '/FrbSifter/StreamFrbEvents',
+                request_serializer=frb__sifter__pb2.FrbEventsMessage.SerializeToString,
+                response_deserializer=frb__sifter__pb2.FrbEventsReply.FromString,
+                _registered_method=True)
 
 
 class FrbSifterServicer(object):
@@ -67,6 +72,16 @@ class FrbSifterServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def StreamFrbEvents(self, request_iterator, context):
+        """Report events from a stream of time chunks, over one long-lived call
+        (rather than one call per chunk).  The reply is sent when the client
+        closes the stream.  If the sifter falls behind, it stops reading from
+        the stream, so gRPC flow control makes the client's writes block.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_FrbSifterServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -80,6 +95,11 @@ def add_FrbSifterServicer_to_server(servicer, server):
                     request_deserializer=frb__sifter__pb2.FrbEventsMessage.FromString,
                     response_serializer=frb__sifter__pb2.FrbEventsReply.SerializeToString,
             ),
+            'StreamFrbEvents': grpc.stream_unary_rpc_method_handler(
+                    servicer.StreamFrbEvents,
+                    request_deserializer=frb__sifter__pb2.FrbEventsMessage.FromString,
+                    response_serializer=frb__sifter__pb2.FrbEventsReply.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'FrbSifter', rpc_method_handlers)
@@ -144,3 +164,30 @@ class FrbSifter(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def StreamFrbEvents(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(
+            request_iterator,
+            target,
+            '/FrbSifter/StreamFrbEvents',
+            frb__sifter__pb2.FrbEventsMessage.SerializeToString,
+            frb__sifter__pb2.FrbEventsReply.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -1,46 +1,354 @@
 from chord_frb_grpc import frb_sifter_pb2_grpc
-from chord_frb_grpc.frb_sifter_pb2 import ConfigReply, FrbEventsReply
+from chord_frb_grpc.frb_sifter_pb2 import (ConfigReply, ConfigDifference, FrbEventsReply,
+                                           FrbEventColumns, FrbEventsRaw, RawColumn,
+                                           ConfigMessage)
+from chord_frb_sifter.events import empty_l1_batch
 import queue
+import asyncio
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+import yaml
+
+# FrbEvent field names -> L1 event field names
+FRB_EVENT_FIELDS = {
+    'beam_id': 'beam',
+    'fpga_timestamp': 'timestamp_fpga',
+    'dm': 'dm',
+    'dm_error': 'dm_error',
+    'snr': 'snr',
+    'rfi_prob': 'rfi_prob',
+}
+
+def config_hash(yaml_str):
+    '''
+    The hash of a YAML config that FRB Search nodes send in
+    ConfigMessage.yaml_hash: the SHA-256 of the YAML text, in hex.
+    '''
+    return hashlib.sha256(yaml_str.encode('utf-8')).hexdigest()
+
+def canonical_config_hash(config):
+    # Hash of a parsed config, independent of YAML formatting, key order and comments.
+    s = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+def flatten_config(config, prefix=''):
+    # {'a': {'b': 1}} -> {'a.b': 1}
+    if not isinstance(config, dict):
+        return {prefix: config}
+    flat = {}
+    for k,v in config.items():
+        key = '%s.%s' % (prefix, k) if prefix else str(k)
+        if isinstance(v, dict) and len(v):
+            flat.update(flatten_config(v, key))
+        else:
+            flat[key] = v
+    return flat
+
+def config_differences(expected, got):
+    '''
+    Returns a list of ConfigDifference messages for the fields that differ
+    between parsed configs *expected* and *got*.
+    '''
+    fexp = flatten_config(expected)
+    fgot = flatten_config(got)
+    missing = object()
+    diffs = []
+    for k in sorted(set(fexp.keys()) | set(fgot.keys())):
+        e = fexp.get(k, missing)
+        g = fgot.get(k, missing)
+        if e == g:
+            continue
+        fmt = lambda v: '' if v is missing else yaml.safe_dump(v).strip()
+        diffs.append(ConfigDifference(field=k, expected=fmt(e), got=fmt(g)))
+    return diffs
+
+def check_configuration(stub, yaml_str):
+    '''
+    Client side of the CheckConfiguration handshake: sends the hash of
+    *yaml_str*, and then the YAML itself if the sifter asks for it.
+    Returns the ConfigReply.
+    '''
+    h = config_hash(yaml_str)
+    r = stub.CheckConfiguration(ConfigMessage(yaml_hash=h))
+    if r.need_yaml:
+        r = stub.CheckConfiguration(ConfigMessage(yaml=yaml_str, yaml_hash=h))
+    return r
+
+def frb_events_to_batch(request):
+    '''
+    Converts the events in an FrbEventsMessage into an L1 batch
+    (see chord_frb_sifter.events).  The events can be sent as FrbEvent
+    messages, packed columns, or raw byte columns -- only one of them.
+
+    Raises ValueError for malformed columns, or more than one form.
+    '''
+    payload = request.WhichOneof('payload')
+    if payload is not None and len(request.events):
+        raise ValueError('FrbEventsMessage: has both events and %s' % payload)
+    if payload == 'raw':
+        batch = raw_columns_to_batch(request.raw)
+    elif payload == 'columns':
+        batch = packed_columns_to_batch(request.columns)
+    else:
+        events = request.events
+        batch = empty_l1_batch(len(events))
+        batch['beam']           = [e.beam_id        for e in events]
+        batch['timestamp_fpga'] = [e.fpga_timestamp for e in events]
+        batch['dm']             = [e.dm             for e in events]
+        batch['dm_error']       = [e.dm_error       for e in events]
+        batch['snr']            = [e.snr            for e in events]
+        batch['rfi_prob']       = [e.rfi_prob       for e in events]
+    batch['chunk_fpga'] = request.chunk_fpga_count
+    # FIXME -- FPGA count to UTC conversion; for now, ASSUME 2.56 microseconds per FPGA sample
+    # from FPGA count zero.
+    batch['chunk_utc'] = batch['chunk_fpga'] * 2.56
+    batch['timestamp_utc'] = batch['timestamp_fpga'] * 2.56
+    return batch
+
+def packed_columns_to_batch(columns):
+    n = len(columns.beam_id)
+    batch = empty_l1_batch(n)
+    for k,l1k in FRB_EVENT_FIELDS.items():
+        col = getattr(columns, k)
+        if len(col) != n:
+            raise ValueError('FrbEventColumns: column %s has %i elements, expected %i' %
+                             (k, len(col), n))
+        batch[l1k] = col
+    return batch
+
+def raw_columns_to_batch(raw):
+    n = raw.nevents
+    batch = empty_l1_batch(n)
+    names = [col.name for col in raw.columns]
+    missing = [k for k in FRB_EVENT_FIELDS if not k in names]
+    if len(missing):
+        raise ValueError('FrbEventsRaw: missing columns %s' % ', '.join(missing))
+    if len(set(names)) != len(names):
+        raise ValueError('FrbEventsRaw: duplicate columns')
+    for col in raw.columns:
+        k = FRB_EVENT_FIELDS.get(col.name)
+        if k is None:
+            raise ValueError('FrbEventsRaw: unknown column "%s"' % col.name)
+        try:
+            dtype = np.dtype(col.dtype)
+        except TypeError:
+            raise ValueError('FrbEventsRaw: column %s has unknown dtype "%s"' %
+                             (col.name, col.dtype))
+        if len(col.data) != n * dtype.itemsize:
+            raise ValueError('FrbEventsRaw: column %s has %i bytes, expected %i x %s' %
+                             (col.name, len(col.data), n, col.dtype))
+        # a view of the message bytes; the only copy is into the batch
+        batch[k] = np.frombuffer(col.data, dtype=dtype)
+    return batch
+
+def frb_event_columns(beam_id, fpga_timestamp, dm, dm_error, snr, rfi_prob):
+    '''
+    Client side: packs arrays of event fields into an FrbEventColumns
+    message (for FrbEventsMessage.columns).
+    '''
+    # (protobuf is much faster at converting lists than NumPy arrays)
+    return FrbEventColumns(beam_id=np.asarray(beam_id).tolist(),
+                           fpga_timestamp=np.asarray(fpga_timestamp).tolist(),
+                           dm=np.asarray(dm).tolist(),
+                           dm_error=np.asarray(dm_error).tolist(),
+                           snr=np.asarray(snr).tolist(),
+                           rfi_prob=np.asarray(rfi_prob).tolist())
+
+def frb_events_raw(**columns):
+    '''
+    Client side: packs NumPy arrays (keyword arguments named by FrbEvent
+    field; all six are required by the server) into an FrbEventsRaw
+    message (for FrbEventsMessage.raw), as little-endian bytes.
+    '''
+    cols = []
+    n = None
+    for k,v in columns.items():
+        v = np.asarray(v)
+        v = v.astype(v.dtype.newbyteorder('<'), copy=False)
+        if n is None:
+            n = len(v)
+        assert(len(v) == n)
+        cols.append(RawColumn(name=k, dtype=v.dtype.str, data=v.tobytes()))
+    return FrbEventsRaw(nevents=n or 0, columns=cols)
 
 
 class FrbSifter(frb_sifter_pb2_grpc.FrbSifterServicer):
-    def __init__(self, injections):
-        # SimpleQueue is thread-safe
-        self.message_queue = queue.SimpleQueue()
+    '''
+    The FrbSifter gRPC service: received events are converted to L1 batches
+    and put on *message_queue* -- a chord_frb_sifter.pipeline.Pipeline (see
+    create_pipeline), or anything else with a put(item, timeout=None) method.
+    If the pipeline is full, FrbEvents calls block until there is room.  By
+    default, a queue.Queue is created for the caller to get() batches from;
+    it is unbounded unless *queue_size* is given (so that it can't fill up
+    and block the server if nothing is reading from it).
+
+    If *liveness* (a chord_frb_sifter.liveness.LivenessMap) is given, the
+    beam set and chunk of every FrbEventsMessage (including empty ones) are
+    recorded in it.
+
+    The first config that a node sends (in CheckConfiguration) becomes the
+    config that all others must match.  Parsed configs are cached by the
+    hash of their YAML text (up to *config_cache_size* of them), so nodes
+    can send just the hash.
+    '''
+    def __init__(self, injections, message_queue=None, queue_size=0, liveness=None,
+                 config_cache_size=256):
+        if message_queue is None:
+            # Queue is thread-safe
+            message_queue = queue.Queue(maxsize=queue_size)
+        self.message_queue = message_queue
         self.injections = injections
+        self.liveness = liveness
+        # The parsed config that all nodes must match, and its canonical hash
         self.config = None
+        self.config_canonical_hash = None
+        # YAML text hash -> (parsed config, canonical hash)
+        self.config_cache = OrderedDict()
+        self.config_cache_size = config_cache_size
+        # The gRPC server calls CheckConfiguration from multiple threads.
+        self.config_lock = threading.Lock()
 
     def CheckConfiguration(self, request, context):
-        conf = request.yaml
-        print('CheckConfiguration: context', context)
-        print('  peer:', context.peer())
-        print('Received YAML config: "%s"' % conf)
-        ok = True
-        if self.config is None:
-            self.config = conf
-        else:
-            if self.config == conf:
-                pass
-            else:
-                print('YAML config mismatch!')
-                ok = False
-        r = ConfigReply(ok=ok)
-        return r
+        print('CheckConfiguration: peer:', context.peer())
+        h = request.yaml_hash
+        with self.config_lock:
+            cached = self.config_cache.get(h) if h else None
+        if cached is None:
+            if not request.yaml:
+                # We haven't seen this config -- ask for the whole thing.
+                print('  config hash', h, 'not in cache; asking for YAML')
+                return ConfigReply(ok=False, need_yaml=True)
+            print('Received YAML config: "%s"' % request.yaml)
+            if h and h != config_hash(request.yaml):
+                return ConfigReply(ok=False, message='yaml_hash does not match the YAML text')
+            try:
+                conf = yaml.safe_load(request.yaml)
+            except yaml.YAMLError as e:
+                return ConfigReply(ok=False, message='Failed to parse YAML config: %s' % e)
+            cached = (conf, canonical_config_hash(conf))
+            with self.config_lock:
+                self.config_cache[config_hash(request.yaml)] = cached
+                while len(self.config_cache) > self.config_cache_size:
+                    self.config_cache.popitem(last=False)
+        conf, chash = cached
+        with self.config_lock:
+            if self.config is None:
+                self.config = conf
+                self.config_canonical_hash = chash
+                return ConfigReply(ok=True)
+            if chash == self.config_canonical_hash:
+                return ConfigReply(ok=True)
+            diffs = config_differences(self.config, conf)
+        print('YAML config mismatch!')
+        for d in diffs:
+            print('  %s: expected %s, got %s' % (d.field, d.expected or '(missing)',
+                                                 d.got or '(missing)'))
+        return ConfigReply(ok=False, differences=diffs,
+                           message='%i config fields differ' % len(diffs))
+
+    def check_injections(self, request):
+        # Returns an error message if the request went to the wrong FRB Sifter, else None.
+        if request.has_injections == self.injections:
+            return None
+        print('Received FRB Events %s injections, but this FRB Sifter is%s handling injections!' % ('with' if request.has_injections else 'without', '' if self.injections else ' not'))
+        return 'Expected has_injections=%s, got %s - are you sending to the wrong FRB Sifter (injection vs prod)?' % (self.injections, request.has_injections)
+
+    def record_liveness(self, request):
+        if self.liveness is not None:
+            self.liveness.record(request.beam_set_id, request.chunk_fpga_count)
 
     def FrbEvents(self, request, context):
         print('FRB Events')
-        if request.has_injections != self.injections:
-            print('Received FRB Events %s injections, but this FRB Sifter is%s handling injections!' % ('with' if request.has_injections else 'without', '' if self.injections else ' not'))
-            return FrbEventsReply(ok=False, message='Expected has_injections=%s, got %s - are you sending to the wrong FRB Sifter (injection vs prod)?' % (self.injections, request.has_injections))
+        err = self.check_injections(request)
+        if err is not None:
+            return FrbEventsReply(ok=False, message=err)
         msg = ''
         ok = True
 
-        print('beam-set', request.beam_set_id, 'chunk FPGA', request.chunk_fpga_count, 'with', len(request.events), 'events')
-        for e in request.events:
-            print('  event', e)
-        
+        try:
+            batch = frb_events_to_batch(request)
+            # (raises ValueError for an unknown beam_set_id)
+            self.record_liveness(request)
+        except ValueError as e:
+            print('FRB Events:', e)
+            return FrbEventsReply(ok=False, message=str(e))
+        print('beam-set', request.beam_set_id, 'chunk FPGA', request.chunk_fpga_count, 'with', len(batch), 'events')
+        self.message_queue.put(batch)
+
         return FrbEventsReply(ok=ok, message=msg)
 
+    def StreamFrbEvents(self, request_iterator, context):
+        print('FRB Events stream from', context.peer())
+        nchunks = 0
+        for request in request_iterator:
+            err = self.check_injections(request)
+            if err is not None:
+                return FrbEventsReply(ok=False, message=err)
+            try:
+                batch = frb_events_to_batch(request)
+                self.record_liveness(request)
+            except ValueError as e:
+                return FrbEventsReply(ok=False, message=str(e))
+            # Blocks if the pipeline is behind; we stop reading the stream meanwhile.
+            self.message_queue.put(batch)
+            nchunks += 1
+        print('FRB Events stream from', context.peer(), 'finished:', nchunks, 'chunks')
+        return FrbEventsReply(ok=True, message='%i chunks' % nchunks)
+
+class AioFrbSifter(FrbSifter):
+    '''
+    The FrbSifter service for a grpc.aio server (see serve_aio).  All the
+    calls run in one asyncio event loop thread, so each FRB Search node can
+    keep a StreamFrbEvents call open without tying up a thread.
+    '''
+    async def CheckConfiguration(self, request, context):
+        return super().CheckConfiguration(request, context)
+
+    async def FrbEvents(self, request, context):
+        err = self.check_injections(request)
+        if err is not None:
+            return FrbEventsReply(ok=False, message=err)
+        try:
+            batch = frb_events_to_batch(request)
+            self.record_liveness(request)
+        except ValueError as e:
+            return FrbEventsReply(ok=False, message=str(e))
+        await self.put_batch(batch)
+        return FrbEventsReply(ok=True, message='')
+
+    async def StreamFrbEvents(self, request_iterator, context):
+        print('FRB Events stream from', context.peer())
+        nchunks = 0
+        async for request in request_iterator:
+            err = self.check_injections(request)
+            if err is not None:
+                return FrbEventsReply(ok=False, message=err)
+            try:
+                batch = frb_events_to_batch(request)
+                self.record_liveness(request)
+            except ValueError as e:
+                return FrbEventsReply(ok=False, message=str(e))
+            await self.put_batch(batch)
+            nchunks += 1
+        print('FRB Events stream from', context.peer(), 'finished:', nchunks, 'chunks')
+        return FrbEventsReply(ok=True, message='%i chunks' % nchunks)
+
+    async def put_batch(self, batch):
+        # Flow control: if the pipeline is behind, wait (without blocking the event loop)
+        # until it has room.  Meanwhile we don't read from the stream, so gRPC stops
+        # granting the client HTTP/2 window and its writes block.
+        delay = 0.001
+        while True:
+            try:
+                self.message_queue.put(batch, timeout=0)
+                return
+            except queue.Full:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.1)
+
 def serve(sifter, port=50051, max_threads=10):
     import grpc
     from concurrent import futures
@@ -55,10 +363,104 @@ def serve(sifter, port=50051, max_threads=10):
     server.start()
     return server
 
+async def serve_aio(sifter, port=50051):
+    '''
+    Starts a grpc.aio server for *sifter* (an AioFrbSifter); must be called
+    from within an asyncio event loop.
+    '''
+    import grpc
+    server = grpc.aio.server()
+    frb_sifter_pb2_grpc.add_FrbSifterServicer_to_server(sifter, server)
+    server.add_insecure_port('[::]:' + str(port))
+    print('Server (asyncio) started, listening on', port)
+    await server.start()
+    return server
+
+def actor_config(config, name):
+    # The constructor arguments for actor *name* from a pipeline config file (dropping
+    # the settings for the old frb_common worker processes).
+    conf = dict(config['specifics'].get(name) or {})
+    for k in ['io', 'log', 'use_pickle', 'timeout', 'periodic_update']:
+        conf.pop(k, None)
+    return conf
+
+def create_pipeline(output, configfn='drao_epsilon_pipeline_local.yaml'):
+    '''
+    Returns a Pipeline (not yet started) that runs BeamBuffer ->
+    BeamGrouper -> SimpleLocalizer, configured from *configfn* in
+    chord_frb_sifter/config, passing its output L2 event batches to
+    *output* (eg, WriteBehindWriter.put).
+    '''
+    import importlib.resources
+    from chord_frb_sifter.pipeline import Pipeline
+    from chord_frb_sifter.actors.beam_buffer import BeamBuffer
+    from chord_frb_sifter.actors.beam_grouper import BeamGrouper
+    from chord_frb_sifter.actors.simple_localizer import SimpleLocalizer
+
+    fn = importlib.resources.files('chord_frb_sifter.config').joinpath(configfn)
+    config = yaml.safe_load(fn.read_text())
+    pipeline = Pipeline(output=output)
+    for name,clz in [('BeamBuffer', BeamBuffer),
+                     ('BeamGrouper', BeamGrouper),
+                     ('Localizer', SimpleLocalizer)]:
+        pipeline.add_stage(name, clz(**actor_config(config, name)))
+    return pipeline
+
+async def main_aio(sifter):
+    server = await serve_aio(sifter)
+    try:
+        await server.wait_for_termination()
+    finally:
+        # (on Ctrl-C, asyncio.run cancels us)
+        await server.stop(5)
+
 if __name__ == '__main__':
+    import argparse
     import logging
+    from chord_frb_db.utils import get_db_engine
+    from chord_frb_db.write_behind import WriteBehindWriter
+    from chord_frb_sifter.liveness import LivenessMap
+    parser = argparse.ArgumentParser(description='Runs the FRB Sifter gRPC server')
+    parser.add_argument('--aio', action='store_true', default=False,
+                        help='Use the asyncio server (one event loop for all the streams)')
+    parser.add_argument('--liveness-dir', default='liveness',
+                        help='Directory for the daily beam-set liveness files (default: %(default)s)')
+    parser.add_argument('--no-liveness', dest='liveness', action='store_false', default=True,
+                        help='Do not record beam-set liveness')
+    opt = parser.parse_args()
     logging.basicConfig()
     is_injections = False
-    sifter = FrbSifter(is_injections)
-    server = serve(sifter)
-    server.wait_for_termination()
+
+    liveness = None
+    if opt.liveness:
+        # Which beam sets reported in each chunk (see scripts/beam-liveness.py)
+        liveness = LivenessMap(opt.liveness_dir)
+        print('Recording beam-set liveness in', opt.liveness_dir)
+
+    # Received events go through the sifter pipeline and into the database.
+    writer = WriteBehindWriter(get_db_engine())
+    writer.start()
+    pipeline = create_pipeline(writer.put)
+    pipeline.start()
+    try:
+        if opt.aio:
+            sifter = AioFrbSifter(is_injections, message_queue=pipeline, liveness=liveness)
+            asyncio.run(main_aio(sifter))
+        else:
+            sifter = FrbSifter(is_injections, message_queue=pipeline, liveness=liveness)
+            server = serve(sifter)
+            try:
+                server.wait_for_termination()
+            finally:
+                server.stop(5).wait()
+    except KeyboardInterrupt:
+        print('Shutting down')
+    finally:
+        # Drain the pipeline (flushing the chunks and groups the actors are holding) into
+        # the writer, then write everything out.
+        pipeline.stop()
+        print('Pipeline:', pipeline.stats())
+        writer.stop()
+        print('Database writer:', writer.stats())
+        if liveness is not None:
+            liveness.close()
@@ -0,0 +1,93 @@
+import time
+import queue
+import asyncio
+import threading
+
+import grpc
+from chord_frb_grpc.frb_sifter_server import AioFrbSifter, serve_aio
+from chord_frb_grpc.frb_sifter_pb2 import FrbEventsMessage, FrbEvent
+from chord_frb_grpc.frb_sifter_pb2_grpc import FrbSifterStub
+
+# Streams chunks of events to an asyncio FRB Sifter server, whose "pipeline" (a small
+# queue with a slow consumer) can't keep up, to check that the client gets slowed down
+# rather than the queue growing.
+
+def run_server(sifter, port, started, stop):
+    async def main():
+        server = await serve_aio(sifter, port=port)
+        started.set()
+        while not stop.is_set():
+            await asyncio.sleep(0.1)
+        await server.stop(1.)
+    asyncio.run(main())
+
+def slow_pipeline(q, received, nchunks, dt):
+    for i in range(nchunks):
+        batch = q.get()
+        received.append(len(batch))
+        time.sleep(dt)
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig()
+    port = 50052
+    injections = False
+    fpga_counts_per_sec = 390625
+    nchunks = 60
+    nevents = 10000
+    # seconds per chunk for the pipeline to process
+    dt = 0.1
+    # chunks the client may get ahead of the pipeline: the queue, plus the chunk the
+    # server is waiting to put, plus what fits in the gRPC / HTTP/2 buffers -- a fixed
+    # number, well short of the whole stream
+    max_in_flight = nchunks // 2
+
+    q = queue.Queue(maxsize=2)
+    sifter = AioFrbSifter(injections, message_queue=q)
+    started = threading.Event()
+    stop = threading.Event()
+    server_thread = threading.Thread(target=run_server, args=(sifter, port, started, stop))
+    server_thread.start()
+    started.wait()
+
+    received = []
+    pipeline_thread = threading.Thread(target=slow_pipeline, args=(q, received, nchunks, dt))
+    pipeline_thread.start()
+
+    # number of chunks sent but not yet taken by the pipeline, as each chunk is sent
+    in_flight = []
+    def chunks():
+        for c in range(nchunks):
+            chunk_fpga = fpga_counts_per_sec * 10 * (c + 1)
+            events = [FrbEvent(beam_id=b, fpga_timestamp=chunk_fpga, dm=100., dm_error=1.0,
+                               snr=8., rfi_prob=0.1) for b in range(nevents)]
+            in_flight.append(c - len(received))
+            yield FrbEventsMessage(has_injections=injections, beam_set_id=1,
+                                   chunk_fpga_count=chunk_fpga, events=events)
+
+    ch = grpc.insecure_channel('localhost:' + str(port))
+    stub = FrbSifterStub(ch)
+    t0 = time.time()
+    r = stub.StreamFrbEvents(chunks())
+    t1 = time.time()
+    print('Got FRB events stream reply:', r.ok, r.message)
+    assert(r.ok)
+    pipeline_thread.join()
+    print('Streamed %i chunks in %.2f sec; pipeline received %i chunks; max in flight %i' %
+          (nchunks, t1-t0, len(received), max(in_flight)))
+    assert(len(received) == nchunks)
+    # The stream can only finish once the pipeline has taken all but the last few chunks
+    # (queued, or held by the server waiting for room), so the client must have been held
+    # back to the pipeline's pace...
+    assert(t1 - t0 >= (nchunks - q.maxsize - 2) * dt)
+    # ... and could never get far ahead of it.
+    assert(max(in_flight) <= max_in_flight)
+
+    # Wrong injections flag
+    r = stub.StreamFrbEvents(iter([FrbEventsMessage(has_injections=not(injections))]))
+    print('Got FRB events stream reply:', r.ok, r.message)
+    assert(not(r.ok))
+
+    ch.close()
+    stop.set()
+    server_thread.join()
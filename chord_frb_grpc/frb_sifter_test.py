@@ -1,5 +1,8 @@
 import yaml
-from chord_frb_grpc.frb_sifter_server import FrbSifter, serve
+import numpy as np
+from chord_frb_grpc.frb_sifter_server import (FrbSifter, serve, frb_events_to_batch,
+                                              frb_event_columns, frb_events_raw,
+                                              check_configuration, config_hash)
 
 import grpc
 from chord_frb_grpc.frb_sifter_pb2 import ConfigMessage, FrbEventsMessage, FrbEvent
@@ -31,11 +34,19 @@ if __name__ == '__main__':
     print('Got config check result:', r1.ok)
     assert(r1.ok)
 
+    # Hash-only handshake: the sifter has seen this config, so no need to send the YAML.
+    r1 = stub1.CheckConfiguration(ConfigMessage(yaml_hash=config_hash(yaml_config_str)))
+    print('Got config check result (hash only):', r1.ok, r1.need_yaml)
+    assert(r1.ok and not(r1.need_yaml))
+
     # FRB Search node 2
     ch2 = grpc.insecure_channel(sifter_addr)
     stub2 = FrbSifterStub(ch2)
-    msg = ConfigMessage(yaml=yaml_config_str)
-    r2 = stub2.CheckConfiguration(msg)
+    # Same config, formatted differently: hash miss, so the YAML gets sent.
+    r2 = stub2.CheckConfiguration(ConfigMessage(yaml_hash=config_hash('# node 2\n' +
+                                                                      yaml_config_str)))
+    assert(r2.need_yaml)
+    r2 = check_configuration(stub2, '# node 2\n' + yaml_config_str)
     print('Got config check result:', r2.ok)
     assert(r2.ok)
 
@@ -45,10 +56,12 @@ if __name__ == '__main__':
     # FRB Search node 3
     ch3 = grpc.insecure_channel(sifter_addr)
     stub3 = FrbSifterStub(ch3)
-    msg = ConfigMessage(yaml=yaml_2)
-    r3 = stub3.CheckConfiguration(msg)
-    print('Got config check result:', r3.ok)
+    r3 = check_configuration(stub3, yaml_2)
+    print('Got config check result:', r3.ok, r3.message)
+    for d in r3.differences:
+        print('  %s: expected "%s", got "%s"' % (d.field, d.expected, d.got))
     assert(not(r3.ok))
+    assert([d.field for d in r3.differences] == ['another_thing'])
 
     # FRB events
     events = []
@@ -86,6 +99,68 @@ if __name__ == '__main__':
     t2 = time.process_time()
     print('Serialized FRB message for %i events: length %i bytes' % (len(events), len(s)))
     print('Encoding took %.3f sec, decoding took %.3f sec' % (t1-t0, t2-t1))
+    b0 = sifter.message_queue.get()
+
+    # The same events, as packed columns and as raw bytes.
+    beam_id = np.arange(1000, dtype=np.int32)
+    cols = dict(beam_id=beam_id,
+                fpga_timestamp=np.full(1000, chunk_fpga, np.int64),
+                dm=np.full(1000, 100., np.float32),
+                dm_error=np.full(1000, 1.0, np.float32),
+                snr=np.full(1000, 8., np.float32),
+                rfi_prob=np.full(1000, 0.1, np.float32))
+    msgs = [('FrbEvent', lambda: msg),
+            ('packed', lambda: FrbEventsMessage(has_injections=injections, beam_set_id=1,
+                                                chunk_fpga_count=chunk_fpga,
+                                                columns=frb_event_columns(**cols))),
+            ('raw', lambda: FrbEventsMessage(has_injections=injections, beam_set_id=1,
+                                             chunk_fpga_count=chunk_fpga,
+                                             raw=frb_events_raw(**cols)))]
+    nrep = 100
+    for name,make_msg in msgs:
+        t0 = time.process_time()
+        for i in range(nrep):
+            s = make_msg().SerializeToString()
+        t1 = time.process_time()
+        for i in range(nrep):
+            m2 = FrbEventsMessage()
+            m2.ParseFromString(s)
+            batch = frb_events_to_batch(m2)
+        t2 = time.process_time()
+        print('%-8s: %i bytes; build+encode %.2f ms, decode+to-batch %.2f ms' %
+              (name, len(s), 1e3*(t1-t0)/nrep, 1e3*(t2-t1)/nrep))
+        r = stub1.FrbEvents(make_msg())
+        assert(r.ok)
+        b = sifter.message_queue.get()
+        assert(np.all(b == b0))
+
+    # Bad raw column
+    bad = FrbEventsMessage(has_injections=injections, beam_set_id=1,
+                           chunk_fpga_count=chunk_fpga,
+                           raw=frb_events_raw(snr=np.zeros(10, np.float32)))
+    bad.raw.nevents = 11
+    r = stub1.FrbEvents(bad)
+    print('Got FRB events reply:', r.ok, r.message)
+    assert(not(r.ok))
+
+    # Raw columns must be exactly the FrbEvent fields
+    for bad_cols in [dict([(k,v) for k,v in cols.items() if k != 'beam_id']),
+                     dict(cols, chunk_utc=np.zeros(1000))]:
+        bad = FrbEventsMessage(has_injections=injections, beam_set_id=1,
+                               chunk_fpga_count=chunk_fpga, raw=frb_events_raw(**bad_cols))
+        r = stub1.FrbEvents(bad)
+        print('Got FRB events reply:', r.ok, r.message)
+        assert(not(r.ok))
+
+    # Only one form of events per message
+    both = FrbEventsMessage(has_injections=injections, beam_set_id=1,
+                            chunk_fpga_count=chunk_fpga, events=msg.events,
+                            columns=frb_event_columns(**cols))
+    r = stub1.FrbEvents(both)
+    print('Got FRB events reply:', r.ok, r.message)
+    assert(not(r.ok))
+    m2 = FrbEventsMessage(columns=frb_event_columns(**cols), raw=frb_events_raw(**cols))
+    assert(m2.WhichOneof('payload') == 'raw')
 
     ch1.close()
     ch2.close()
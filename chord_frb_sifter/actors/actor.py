@@ -1,13 +1,45 @@
+import threading
 
 class Actor(object):
     def __init__(self, **kwargs):
-        pass
+        # perform_action() and perform_update() may be called from different threads
+        self.lock = threading.RLock()
     def perform_action(self, item):
         try:
-            return self._perform_action(item)
+            with self.lock:
+                return self._perform_action(item)
         except:
             import traceback
             traceback.print_exc()
             raise
     def _perform_action(self, item):
         raise RuntimeError('not implemented')
+    def perform_update(self):
+        '''
+        Called periodically, whether or not new items have arrived, so that
+        actors can do time-based work (eg, flushing on a timeout).  Returns a
+        list of output items, like perform_action().
+        '''
+        try:
+            with self.lock:
+                return self._update()
+        except:
+            import traceback
+            traceback.print_exc()
+            raise
+    def _update(self):
+        return []
+    def perform_flush(self):
+        '''
+        Called when the pipeline is shutting down: returns a list of any
+        items the actor is still holding on to.
+        '''
+        try:
+            with self.lock:
+                return self._flush()
+        except:
+            import traceback
+            traceback.print_exc()
+            raise
+    def _flush(self):
+        return []
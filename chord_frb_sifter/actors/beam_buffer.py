@@ -11,82 +11,139 @@ import numpy as np
 import msgpack
 
 import time
+from collections import deque
 
 from chord_frb_sifter.actors.actor import Actor
+from chord_frb_sifter.events import as_l1_batch
+
+class ChunkSlot(object):
+    """
+    The events buffered by BeamBuffer for one chunk of data.
+    """
+    def __init__(self, chunk, start_time):
+        self.chunk = chunk
+        # time.monotonic() when this chunk's first events arrived
+        self.start_time = start_time
+        # beams that have reported
+        self.beams = set()
+        # list of L1 batches, concatenated when flushed
+        self.events = []
+        self.n_events = 0
+        # all the expected beams have reported (but an earlier chunk is still open)
+        self.complete = False
+
+    def append(self, beams, events):
+        self.beams.update(beams)
+        if len(events):
+            self.events.append(events)
+            self.n_events += len(events)
+
+    def flush(self):
+        if len(self.events) == 0:
+            return None
+        events = np.concatenate(self.events)
+        self.events = []
+        self.n_events = 0
+        return events
 
 class BeamBuffer(Actor):
     """
     The purpose of this class is to accumulate events from individual beams
     into a single frame, such that events may be grouped.
+
+    Input and output are L1 batches (see chord_frb_sifter.events); each
+    flush produces one batch.  An input batch may contain events from any
+    number of beams and chunks (in any order); it is split by chunk, and each
+    chunk's events are buffered as a single slice.
+
+    Up to *max_open_chunks* chunks are buffered at once, each in its own
+    ChunkSlot, so events from several chunks can arrive interleaved (eg, from
+    different FRB Search nodes).  Each chunk is flushed on its own when all
+    the beams we expect have reported, or -- from perform_update(), which
+    should be called periodically, as a Pipeline does -- when
+    *flush_timeout* seconds (wall-clock) have passed since its first events
+    arrived.  If a new chunk arrives when all slots are in use, the oldest
+    chunk is flushed.  The beams we expect are the beams that reported in the
+    last completed (or timed-out) chunk, so a dead beam delays at most one
+    chunk.
+
+    Chunks are output in chunk order: a chunk that completes while an
+    earlier chunk is still open is held until the earlier one is flushed
+    (and flushing a chunk for any other reason flushes the earlier ones
+    first).  Late events are the exception -- they are for a chunk that has
+    already been output, so they come after later chunks' events.
+
+    Parameters
+    ----------
+    flush_timeout : float or None
+        Seconds to wait for all beams to report before flushing a chunk.
+    max_buffered_events : int or None
+        Flush the oldest chunk's buffered events early if more than this
+        many events are buffered in total.
+    late_events : str
+        What to do with events for a chunk that has already been flushed:
+        'merge' them into a batch of the same chunk being output in the same
+        call (or else output them as a separate batch), output them as a
+        'separate' batch immediately, or 'drop' them (counted in
+        ``n_late_dropped``).
+    max_open_chunks : int
+        Number of chunks that can be buffered at once.
     """
-    def __init__(self, **kwargs):
+    def __init__(self, flush_timeout=None, max_buffered_events=None, late_events='merge',
+                 max_open_chunks=3, **kwargs):
         super().__init__(**kwargs)
-        self.pipe_id = 0
+        if late_events not in ['merge', 'separate', 'drop']:
+            raise ValueError('BeamBuffer: unknown late_events policy "%s"' % late_events)
+        self.flush_timeout = flush_timeout
+        self.max_buffered_events = max_buffered_events
+        self.late_events = late_events
+        self.max_open_chunks = max_open_chunks
 
-        self.current_chunk = None
-        self.previous_chunk = None
-        self.buffered_events = []
+        self.pipe_id = 0
 
-        self.slowpoke_events = []
+        # chunk -> ChunkSlot
+        self.open_chunks = {}
+        # total number of events in open_chunks
+        self.n_buffered = 0
+        # recently flushed chunks, for recognizing late events
+        self.flushed_chunks = deque(maxlen=4 * max_open_chunks)
 
         # FIXME -- for CHORD, we could do this at the node level instead.
-        self.current_beams = set()
         self.expecting_beams = None
 
+        # Counters
+        self.n_late_events = 0
+        self.n_late_dropped = 0
+        self.n_timeout_flushes = 0
+        self.n_overflow_flushes = 0
+        self.n_evicted_chunks = 0
+
     def _perform_action(self, events):
+        # L1 batch (see chord_frb_sifter.events)
+        events = as_l1_batch(events)
 
         # for debugging purposes, tag events...
         tnow = time.monotonic()
-        for e in events:
-            e['pipeline_timestamp'] = tnow
-            e['pipeline_id'] = self.pipe_id
-            self.pipe_id += 1
-        
-        # First, group events into per-timestamp, per-beam event groups.  This makes life easier below.
-        event_sets = []
-        current_chunk = None
-        current_beam = None
-        current_events = None
-        for e in events:
-            chunk = e['chunk_utc']
-            beam = e['beam']
-            if current_chunk is None:
-                current_chunk = chunk
-                current_beam = beam
-                current_events = [e]
-            elif (chunk != current_chunk) or (beam != current_beam):
-                # flush
-                event_sets.append((current_chunk, current_beam, current_events))
-                current_chunk = chunk
-                current_beam = beam
-                current_events = [e]
-            else:
-                current_events.append(e)
-        if current_chunk is not None:
-            event_sets.append((current_chunk, current_beam, current_events))
+        events['pipeline_timestamp'] = tnow
+        events['pipeline_id'] = self.pipe_id + np.arange(len(events))
+        self.pipe_id += len(events)
 
+        # First, split events into per-chunk event sets (slices of the batch), each with
+        # the set of beams that reported.  Sort by (chunk, beam) so that each chunk is a
+        # contiguous slice.  This makes life easier below.
+        order = np.lexsort((events['beam'], events['chunk_utc']))
+        events = events[order]
+        chunks,starts = np.unique(events['chunk_utc'], return_index=True)
+        event_sets = []
+        for chunk,chunk_events in zip(chunks, np.split(events, starts[1:])):
+            # Beams that reported, including beams that only sent a null event.
+            beams = set(np.unique(chunk_events['beam']).tolist())
+            chunk_events = chunk_events[np.logical_not(chunk_events['null_event'])]
+            event_sets.append((chunk, beams, chunk_events))
 
         rtn = []
-        def _flush_events():
-            if len(self.slowpoke_events):
-                print('Flushing', len(self.slowpoke_events), 'slow-pokes')
-                rtn.append(self.slowpoke_events)
-                self.slowpoke_events = []
-            if len(self.buffered_events):
-                print('Flushing', len(self.buffered_events), 'events')
-                rtn.append(self.buffered_events)
-                self.buffered_events = []
-            self.expecting_beams = self.current_beams
-            self.current_beams = set()
-            self.previous_chunk = self.current_chunk
-
-        def _append_events(lst, evts):
-            for e in evts:
-                if not e.get('null_event', False):
-                    lst.append(e)
-
-        for chunk, beam, events in event_sets:
-            if chunk == self.previous_chunk:
+        for chunk, beams, events in event_sets:
+            if self._is_late(chunk):
                 # slowpoke -- at startup, or when replaying from a file, you could get:
                 #  chunk 0, beam 1
                 #
@@ -99,49 +156,172 @@ class BeamBuffer(Actor):
                 #  chunk 2, beam 1 --> flush!
                 #
                 #  etc.
-                self.expecting_beams.add(beam)
-                # FIXME -- append to previous event set?
-                print('Got slow-poke event: chunk', chunk, 'current', self.current_chunk,
-                      'previous', self.previous_chunk, 'beam:', beam)
-                if len(rtn):
-                    print('adding to last batch')
-                    _append_events(rtn[-1], events)
-                else:
-                    print('adding to slow-pokes')
-                    _append_events(self.slowpoke_events, events)
+                self._late_events(chunk, beams, events, rtn)
                 continue
 
-            if self.current_chunk is None:
-                self.current_chunk = chunk
-                print('Starting new batch: chunk', chunk, 'expecting beams:', self.expecting_beams)
-                if len(self.slowpoke_events):
-                    print('Flushing', len(self.slowpoke_events), 'slow-pokes')
-                    rtn.append(self.slowpoke_events)
-                    self.slowpoke_events = []
-
-            if chunk > self.current_chunk:
-                # We got the first event from a new chunk -- flush our current event list!
-                print('New chunk - flushing %i events for chunk %s; beams %s' %
-                      (len(self.buffered_events), self.current_chunk, self.current_beams))
-                _flush_events()
-                self.current_chunk = chunk
-
-            if chunk < self.current_chunk:
-                # FIXME -- very slow event... do something??
-                print('Ignoring old events: chunk', chunk, 'but current is', self.current_chunk,
-                      'and previous was', self.previous_chunk, '; events are', events)
-                continue
+            slot = self.open_chunks.get(chunk)
+            if slot is None:
+                if self.expecting_beams is None:
+                    # At startup, we don't know which beams to expect: the first event
+                    # from a new chunk flushes the older chunks.
+                    for c in sorted(self.open_chunks.keys()):
+                        if c < chunk:
+                            print('New chunk - flushing %i events for chunk %s; %i beams' %
+                                  (self.open_chunks[c].n_events, c,
+                                   len(self.open_chunks[c].beams)))
+                            self._finish_chunk(c, rtn)
+                if len(self.open_chunks) >= self.max_open_chunks:
+                    oldest = min(self.open_chunks.keys())
+                    if chunk < oldest:
+                        # Older than everything we're buffering -- treat as late.
+                        self._late_events(chunk, beams, events, rtn)
+                        continue
+                    print('All %i chunk slots in use - flushing %i events for chunk %s' %
+                          (len(self.open_chunks), self.open_chunks[oldest].n_events, oldest))
+                    self.n_evicted_chunks += 1
+                    self._finish_chunk(oldest, rtn, update_beams=False)
+                print('Starting new batch: chunk', chunk, 'expecting beams:',
+                      None if self.expecting_beams is None else len(self.expecting_beams),
+                      'open chunks:', len(self.open_chunks))
+                slot = ChunkSlot(chunk, tnow)
+                self.open_chunks[chunk] = slot
 
-            self.current_beams.add(beam)
-            _append_events(self.buffered_events, events)
+            slot.append(beams, events)
+            self.n_buffered += len(events)
 
             if self.expecting_beams is not None:
-                if self.current_beams.issuperset(self.expecting_beams):
-                    # All expected beams have been received -- flush our current event list!
-                    print('Got all beams (%s) - expected beams (%s) - flushing %i events for chunk %s' %
-                          (self.current_beams, self.expecting_beams, len(self.buffered_events), self.current_chunk))
-                    _flush_events()
-                    self.current_chunk = None
-                    print('Next chunk, will expect beams %s' % self.expecting_beams)
+                if slot.beams.issuperset(self.expecting_beams):
+                    # All expected beams have been received -- flush this chunk's events!
+                    print('Got all beams (%i) - expected beams (%i) - flushing %i events for chunk %s' %
+                          (len(slot.beams), len(self.expecting_beams), slot.n_events, chunk))
+                    self._complete_chunk(chunk, rtn)
+                    print('Next chunk, will expect %i beams' % len(self.expecting_beams))
+                    continue
+
+            if (self.max_buffered_events is not None and
+                self.n_buffered >= self.max_buffered_events):
+                # Bound our memory use: pass on what we have so far for the oldest chunk
+                # (but keep waiting for the rest of it).
+                oldest = self.open_chunks[min(self.open_chunks.keys())]
+                print('Buffer full - flushing %i events for chunk %s' %
+                      (oldest.n_events, oldest.chunk))
+                self.n_overflow_flushes += 1
+                if oldest.n_events:
+                    self._flush_slot(oldest, rtn)
+                else:
+                    # The events are in complete chunks waiting behind this one -- give up
+                    # on it to let them go.
+                    self._finish_chunk(oldest.chunk, rtn, update_beams=False)
+
+        return rtn
 
+    def _update(self):
+        tnow = time.monotonic()
+        rtn = []
+        if self.flush_timeout is not None:
+            for chunk in sorted(self.open_chunks.keys()):
+                slot = self.open_chunks.get(chunk)
+                if slot is None:
+                    # (flushed along with a later chunk)
+                    continue
+                if tnow - slot.start_time > self.flush_timeout:
+                    missing = (set() if self.expecting_beams is None else
+                               self.expecting_beams - slot.beams)
+                    print('Timed out waiting for %i beams - flushing %i events for chunk %s' %
+                          (len(missing), slot.n_events, chunk))
+                    self.n_timeout_flushes += 1
+                    self._finish_chunk(chunk, rtn)
+        return rtn
+
+    def _flush(self):
+        rtn = []
+        for chunk in sorted(self.open_chunks.keys()):
+            if chunk not in self.open_chunks:
+                continue
+            print('Shutting down - flushing %i events for chunk %s' %
+                  (self.open_chunks[chunk].n_events, chunk))
+            self._finish_chunk(chunk, rtn)
         return rtn
+
+    def _is_late(self, chunk):
+        # Is this chunk one that we have already flushed?
+        if len(self.flushed_chunks) == 0:
+            return False
+        return (chunk in self.flushed_chunks) or (chunk < min(self.flushed_chunks))
+
+    def _late_events(self, chunk, beams, events, rtn):
+        if chunk in self.flushed_chunks and self.expecting_beams is not None:
+            # These beams are alive, just slow.
+            self.expecting_beams.update(beams)
+        print('Got late events: chunk', chunk, 'open chunks', sorted(self.open_chunks.keys()),
+              'beams:', len(beams))
+        if len(events) == 0:
+            return
+        self.n_late_events += len(events)
+        if self.late_events == 'drop':
+            print('Dropping', len(events), 'late events')
+            self.n_late_dropped += len(events)
+        elif self.late_events == 'separate':
+            print('Sending', len(events), 'late events separately')
+            rtn.append(events)
+        else:
+            # Merge into a batch for the same chunk, if we're outputting one.
+            for i in range(len(rtn)-1, -1, -1):
+                if len(rtn[i]) and np.all(rtn[i]['chunk_utc'] == chunk):
+                    print('adding to batch for chunk', chunk)
+                    rtn[i] = np.concatenate([rtn[i], events])
+                    return
+            print('No batch for chunk', chunk, '- sending', len(events), 'late events separately')
+            rtn.append(events)
+
+    def _flush_slot(self, slot, rtn):
+        n = slot.n_events
+        events = slot.flush()
+        if events is not None:
+            print('Flushing', n, 'events')
+            rtn.append(events)
+            self.n_buffered -= n
+
+    def _complete_chunk(self, chunk, rtn):
+        # All the expected beams have reported for this chunk: flush it, unless an earlier
+        # chunk is still open, in which case it waits for that one.
+        slot = self.open_chunks[chunk]
+        slot.complete = True
+        self.expecting_beams = slot.beams
+        if chunk != min(self.open_chunks.keys()):
+            print('Holding chunk %s until earlier chunk %s is flushed' %
+                  (chunk, min(self.open_chunks.keys())))
+        self._flush_completed(rtn)
+
+    def _flush_completed(self, rtn):
+        # Flush the complete chunks that are no longer behind an open one.
+        while len(self.open_chunks):
+            oldest = min(self.open_chunks.keys())
+            if not self.open_chunks[oldest].complete:
+                break
+            self._close_chunk(oldest, rtn)
+
+    def _close_chunk(self, chunk, rtn):
+        # Flush everything we have for this chunk, and close its slot.
+        slot = self.open_chunks.pop(chunk)
+        self._flush_slot(slot, rtn)
+        self.flushed_chunks.append(chunk)
+        return slot
+
+    def _finish_chunk(self, chunk, rtn, update_beams=True):
+        # Flush this chunk -- and first, any earlier chunks, to keep the output in chunk
+        # order -- then any complete chunks that were waiting behind it.
+        for c in sorted(self.open_chunks.keys()):
+            if c > chunk:
+                break
+            slot = self._close_chunk(c, rtn)
+            if slot.complete:
+                # (expecting_beams was set when it completed)
+                continue
+            if c != chunk:
+                print('Flushed earlier chunk %s (%i beams) first' % (c, len(slot.beams)))
+            if (c == chunk and update_beams) or self.expecting_beams is None:
+                self.expecting_beams = slot.beams
+            else:
+                self.expecting_beams.update(slot.beams)
+        self._flush_completed(rtn)
@@ -11,9 +11,12 @@ import traceback
 import pickle as pickle
 from subprocess import check_output
 from collections import deque
+import multiprocessing
 
 import numpy as np
 from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import msgpack
 
 #from frb_common import ActorBaseClass
@@ -21,49 +24,56 @@ import msgpack
 #from frb_common.events import L1Event
 
 from chord_frb_sifter.actors.actor import Actor
+from chord_frb_sifter.shm_transport import ShmRing
+from chord_frb_sifter.events import (L2EventBatch, L2_EVENT_DTYPE, L2_COPIED_FIELDS,
+                                     L2_MAX_FIELDS)
 
 __author__ = "CHIME FRB Group"
 __developers__ = "Alex Josephy"
 __email__ = "alexander.josephy@mail.mcgill.ca"
 
 # This incorporates steps that used to be in the EventMaker actor.
-def create_l2_event(l1_events, **kwargs):
-    print('Creating L2 event from L1 events:')
-    for e in l1_events:
-        print('  ', e)
-    from collections import Counter
-    print('Beam counts:', Counter([e['beam'] for e in l1_events]))
+def create_l2_events(l1_events, ngroups, labels, beam_activity_lookback=None,
+                     dm_activity_lookback=None, **kwargs):
+    """
+    Creates the L2 events for all the groups of L1 events in a chunk at once.
+
+    *l1_events* is an L1 batch and *labels* gives the group number (0 to
+    ngroups-1) of each event.  Each L2 event is initialized from the max-SNR
+    L1 event in its group, and only the max-SNR L1 event in each beam is kept.
+    Additional *kwargs* are set as L2 fields (for all groups).
+
+    Returns an ``L2EventBatch``.
+    """
+    snr = l1_events['snr']
+    # Keep only the max-SNR event for each beam: sort by group, then beam, then by
+    # decreasing SNR, and take the first event for each (group, beam).
+    order = np.lexsort((-snr, l1_events['beam'], labels))
+    groups = labels[order]
+    beams = l1_events['beam'][order]
+    first = np.ones(len(order), bool)
+    first[1:] = (groups[1:] != groups[:-1]) | (beams[1:] != beams[:-1])
+    keep = order[first]
+    # "keep" is sorted by group.
+    nbeams = np.bincount(labels[keep], minlength=ngroups)
+    l1_offsets = np.append(0, np.cumsum(nbeams))
+    # The max-SNR event in each group: sort the kept events by group then decreasing
+    # SNR, and take the first in each group.
+    best = keep[np.lexsort((-snr[keep], labels[keep]))[l1_offsets[:-1]]]
     #
-    # Keep only the max-SNR event for each beam.
-    beam_maxsnr = {}
-    for e in l1_events:
-        beam = e['beam']
-        snr = e['snr']
-        if beam in beam_maxsnr:
-            (oldsnr,_) = beam_maxsnr[beam]
-            if snr > oldsnr:
-                beam_maxsnr[beam] = (snr,e)
-        else:
-            beam_maxsnr[beam] = (snr, e)
     # Initialize L2 elements from the max-SNR event
-    keep = []
-    best_event = None
-    best_snr = 0.
-    for snr,e in beam_maxsnr.values():
-        keep.append(e)
-        if snr > best_snr:
-            best_snr = snr
-            best_event = e
-    l1_events = keep
-    # FIXME - this is silly
-    l2_event = best_event.copy()
-    for k in ['beam_grid_x', 'beam_grid_y', 'beam_dra', 'beam_ddec', 'snr']:
-        l2_event['max_' + k] = best_event[k]
-        del l2_event[k]
+    l2_events = np.zeros(ngroups, L2_EVENT_DTYPE)
+    for k in L2_COPIED_FIELDS:
+        l2_events[k] = l1_events[k][best]
+    for k in L2_MAX_FIELDS:
+        l2_events['max_' + k] = l1_events[k][best]
+    l2_events['nbeams'] = nbeams
     #
-    l2_event.update(kwargs)
-    l2_event['l1_events'] = l1_events
-    return l2_event
+    for k,v in kwargs.items():
+        l2_events[k] = v
+    return L2EventBatch(l2_events, l1_events[keep], l1_offsets,
+                        beam_activity_lookback=beam_activity_lookback,
+                        dm_activity_lookback=dm_activity_lookback)
 
 class BeamGrouper(Actor):
     """
@@ -76,6 +86,45 @@ class BeamGrouper(Actor):
     ----------
     t_thr, dm_thr, ra_thr, dec_thr : float
         Thresholds in ms, pc cm :sup:`-3`, and beam separation
+    engine : str
+        'kdtree' to find neighbouring events with a KD-tree over the whole
+        chunk, or 'sweep' to sort the events by time and only compare events
+        within *t_thr* of each other, so that memory scales with the number of
+        events in a time window rather than in the chunk.  Both produce the
+        same groups.
+    merge_across_chunks : bool
+        Group events across chunk boundaries.  Groups with events within
+        *t_thr* of the latest event are held until the next chunk arrives;
+        the held events within *t_thr* of the boundary are grouped along with
+        the new chunk's events, and groups they link are merged.  A group is
+        emitted once it can no longer grow.  Chunks may arrive out of order:
+        a group is also held while a chunk within *t_thr* of its events has
+        not arrived yet (until it is *max_chunk_lag* chunks old).  Events
+        that arrive after a group they belong to has been emitted cannot be
+        merged into it; they are grouped on their own, and counted in
+        ``n_late_unmerged``.
+    chunk_seconds : float or None
+        Length of a chunk in seconds, for *merge_across_chunks*; if None, it
+        is taken as the smallest spacing between the chunk_utc values seen
+        (which is too long until two neighbouring chunks have arrived).
+    max_chunk_lag : int
+        With *merge_across_chunks*, a chunk that has not arrived by the time
+        a chunk *max_chunk_lag* chunks later has arrived is not waited for.
+    hold_timeout : float or None
+        Seconds (wall-clock) after which held groups are emitted anyway, from
+        perform_update() or when the next chunk arrives.
+    nprocs : int
+        Number of worker processes to cluster with.  With *nprocs* > 1, the
+        events of a chunk are split into *nprocs* bands in beam-grid y
+        (Dec-like), each extended by *dec_thr* on both sides, and the bands
+        are clustered in parallel.  Events in the overlaps belong to groups
+        in two bands, which are then merged, so the groups are the same as
+        with *nprocs* = 1.  The scaled coordinates are passed to the workers
+        (and the labels back) through shared memory.
+    shard_min_events : int
+        Chunks with fewer events than this are clustered in this process.
+    start_method : str
+        multiprocessing start method for the worker processes.
     **kwargs : dict, optional
         Additional parameters are used to initialize superclass
         (``ActorBaseClass``).
@@ -119,82 +168,446 @@ class BeamGrouper(Actor):
 
     [3] `Chebyshev Metric <https://en.wikipedia.org/wiki/Chebyshev_distance>`_
     """
-    def __init__(self, t_thr, dm_thr, ra_thr, dec_thr, **kwargs):
+    def __init__(self, t_thr, dm_thr, ra_thr, dec_thr, engine='kdtree',
+                 merge_across_chunks=False, chunk_seconds=None, max_chunk_lag=2,
+                 hold_timeout=None, nprocs=1,
+                 shard_min_events=10000, start_method='spawn', **kwargs):
         super().__init__(**kwargs)
+        if engine not in ['kdtree', 'sweep']:
+            raise ValueError('BeamGrouper: unknown grouping engine "%s"' % engine)
+        self.engine = engine
         self.thresholds = [t_thr, dm_thr, ra_thr, dec_thr]
         self.dm_activity_lookback = deque([0] * 10, maxlen=10)
         self.beam_activity_lookback = deque([0] * 10, maxlen=10)
+        self.activity = {}
+
+        self.merge_across_chunks = merge_across_chunks
+        self.hold_timeout = hold_timeout
+        # Events in groups that may still grow with the next chunk's events
+        self.held_events = None
+        # group number (0 to N-1) of each held event
+        self.held_groups = None
+        # time.monotonic() when each held event arrived
+        self.held_times = None
+        # latest event timestamp seen (micro-seconds)
+        self.boundary = None
+        # Chunks (chunk_utc, micro-seconds) seen: the first, the latest, and the recent ones
+        self.chunk_ref = None
+        self.newest_chunk = None
+        self.seen_chunks = set()
+        # chunk length (micro-seconds)
+        self.chunk_dt = None if chunk_seconds is None else chunk_seconds * 1e6
+        self.chunk_seconds = chunk_seconds
+        self.max_chunk_lag = max_chunk_lag
+        # Recently emitted events, for recognizing late events that belong in them
+        self.recent_events = None
+        # Counters
+        self.n_out_of_order_events = 0
+        self.n_late_unmerged = 0
+
+        self.nprocs = nprocs
+        self.shard_min_events = shard_min_events
+        self.start_method = start_method
+        # created when first needed: the worker processes, and the shared memory that the
+        # coordinates and labels are passed in (re-created, with the pool, if a chunk
+        # doesn't fit)
+        self.pool = None
+        self.ring = None
 
     def _perform_action(self, events):
         """Pipeline function that groups L1 events.
 
         Parameters
         ----------
+        events : L1 batch
+            All the events from one chunk, from ``BeamBuffer``.
 
         Returns
         -------
-        list of ``L2Event``
+        list containing one ``L2EventBatch`` (or an empty list if there
+        are no finished groups)
         """
         print('Beam grouper: %i events' % len(events))
-        print('First event:', events[0])
-        groups = self._cluster(events)
+        if len(events) == 0:
+            return []
 
-        beam_activity = len(set([e['beam'] for e in events]))
-        dm_activity = len(set([e['dm'] for e in events]))
-        avg_l1_grade = np.mean([e['rfi_grade_level1'] for e in events])
+        beam_activity = len(np.unique(events['beam']))
+        dm_activity = len(np.unique(events['dm']))
+        avg_l1_grade = np.mean(events['rfi_grade_level1'])
         self.dm_activity_lookback.append(dm_activity)
         self.beam_activity_lookback.append(beam_activity)
+        self.activity = dict(beam_activity=beam_activity,
+                             dm_activity=dm_activity,
+                             avg_l1_grade=avg_l1_grade)
+
+        if not self.merge_across_chunks:
+            ngroups, labels = self._cluster(events)
+            return [self._make_l2_batch(events, ngroups, labels)]
+
+        events, ngroups, labels, times = self._cluster_streaming(events)
+        return self._emit_finished_groups(events, ngroups, labels, times)
+
+    def _update(self):
+        # Don't hold on to groups forever (eg, if no new chunks arrive).
+        if (self.held_events is None or self.hold_timeout is None or
+            time.monotonic() - self.held_times.min() <= self.hold_timeout):
+            return []
+        print('Beam grouper: hold timeout - emitting %i held events' % len(self.held_events))
+        return self._emit_held()
+
+    def _flush(self):
+        self.close()
+        if self.held_events is None:
+            return []
+        print('Beam grouper: shutting down - emitting %i held events' % len(self.held_events))
+        return self._emit_held()
+
+    def close(self):
+        # Shuts down the worker processes and frees their shared memory, if any.
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.ring is not None:
+            self.ring.unlink()
+            self.ring = None
+
+    def _emit_held(self):
+        events = self.held_events
+        ngroups = self.held_groups.max() + 1
+        labels = self.held_groups
+        self.held_events = self.held_groups = self.held_times = None
+        self._remember_emitted(events)
+        return [self._make_l2_batch(events, ngroups, labels)]
+
+    def _note_chunks(self, events):
+        # Records the chunks that *events* are from.
+        chunks = np.unique(events['chunk_utc'])
+        if self.chunk_ref is None:
+            self.chunk_ref = chunks[0]
+            self.newest_chunk = chunks[-1]
+        self.newest_chunk = max(self.newest_chunk, chunks[-1])
+        self.seen_chunks.update(chunks.tolist())
+        if self.chunk_seconds is None:
+            spacing = np.diff(sorted(self.seen_chunks))
+            spacing = spacing[spacing > 0]
+            if len(spacing):
+                dt = spacing.min()
+                self.chunk_dt = dt if self.chunk_dt is None else min(self.chunk_dt, dt)
+        if self.chunk_dt is not None:
+            # Forget the chunks that are too old to matter.
+            oldest = self.newest_chunk - self.max_chunk_lag * self.chunk_dt
+            self.seen_chunks = set(c for c in self.seen_chunks if c >= oldest)
+
+    def _missing_chunk_near(self, tlo, thi):
+        # For time ranges [tlo, thi] (arrays, micro-seconds): could events from a chunk
+        # that hasn't arrived yet (and is still worth waiting for) fall in the range?
+        if self.chunk_dt is None:
+            # Only one chunk seen so far: an earlier chunk may be on its way.
+            return (tlo < self.chunk_ref) & (self.max_chunk_lag > 1)
+        ref = self.chunk_ref
+        dt = self.chunk_dt
+        newest = int(np.round((self.newest_chunk - ref) / dt))
+        klo = np.floor((tlo - ref) / dt)
+        khi = np.floor((thi - ref) / dt)
+        seen = set(int(np.round((c - ref) / dt)) for c in self.seen_chunks)
+        # Later chunks...
+        missing = (khi > newest)
+        # ... and earlier ones that are overdue, but not too late.
+        for k in range(newest - self.max_chunk_lag + 1, newest):
+            if k not in seen:
+                missing |= (klo <= k) & (khi >= k)
+        return missing
+
+    def _check_late(self, events):
+        # Counts the events in *events* that are from chunks older than the newest one we
+        # have seen, and those that are grouped with events we have already emitted (so
+        # cannot be merged into their groups).
+        if self.newest_chunk is None:
+            return
+        old = np.flatnonzero(events['chunk_utc'] < self.newest_chunk)
+        if len(old) == 0:
+            return
+        self.n_out_of_order_events += len(old)
+        print('Beam grouper: %i events from earlier chunks' % len(old))
+        if self.recent_events is None:
+            return
+        t_thr = self.thresholds[0] * 1e3
+        t = events['timestamp_utc'][old]
+        te = self.recent_events['timestamp_utc']
+        near = np.flatnonzero((te >= t.min() - t_thr) & (te <= t.max() + t_thr))
+        if len(near) == 0:
+            return
+        n = len(old)
+        _, labels = self._cluster(np.concatenate((events[old], self.recent_events[near])))
+        unmerged = np.isin(labels[:n], labels[n:])
+        nun = np.sum(unmerged)
+        if nun:
+            self.n_late_unmerged += nun
+            print('Beam grouper: %i late events belong in groups already emitted -' % nun,
+                  'grouping them separately (%i so far)' % self.n_late_unmerged)
+
+    def _remember_emitted(self, events):
+        # Keeps emitted events for as long as late events could still belong with them.
+        if self.recent_events is not None:
+            events = np.concatenate((self.recent_events, events))
+        if self.chunk_dt is not None:
+            t_thr = self.thresholds[0] * 1e3
+            tlo = self.boundary - (self.max_chunk_lag + 1) * self.chunk_dt - t_thr
+            events = events[events['timestamp_utc'] >= tlo]
+        self.recent_events = events if len(events) else None
 
-        # tnow = time.monotonic()
-        # for g in groups:
-        #     try:
-        #         tmin = min(g['pipeline_timestamp'])
-        #         pid = g['pipeline_id']
-        #         self.print('BeamGrouper: Elapsed Time for %i: %.3f sec (pipeline timestamp: %s)' %
-        #                    (pid, tnow - tmin, tmin))
-        #     except:
-        #         pass
+    def _cluster_streaming(self, events):
+        # Groups the new *events* together with the held events, incrementally: only the
+        # "tail" of held events (within t_thr of the latest event we have seen) can be
+        # neighbours of the new events, so only those get clustered again.  Held groups
+        # that are linked (via their tail events) to new groups get merged with them.
+        # Batches can arrive out of time order, so the tail is the held events within t_thr
+        # of the new events' time range.
+        #
+        # Returns (all_events, ngroups, labels) for the held plus new events.
+        tnow = time.monotonic()
+        t_thr = self.thresholds[0] * 1e3
+        tmin = events['timestamp_utc'].min()
+        tmax = events['timestamp_utc'].max()
+        self._check_late(events)
+        self._note_chunks(events)
+        self.boundary = tmax if self.boundary is None else max(self.boundary, tmax)
+        if self.held_events is None:
+            ngroups, labels = self._cluster(events)
+            return events, ngroups, labels, np.full(len(events), tnow)
 
+        held_t = self.held_events['timestamp_utc']
+        tail = np.flatnonzero((held_t >= tmin - t_thr) & (held_t <= tmax + t_thr))
+        ntail = len(tail)
+        nnew, new_labels = self._cluster(np.concatenate((self.held_events[tail], events)))
+        # Graph whose nodes are the new groups (0 to nnew-1) and the held groups (nnew and
+        # up), with edges from each tail event's held group to its new group.
+        nheld = self.held_groups.max() + 1
+        nodes = nnew + nheld
+        graph = coo_matrix((np.ones(ntail, bool),
+                            (new_labels[:ntail], nnew + self.held_groups[tail])),
+                           shape=(nodes, nodes))
+        ngroups, comp = connected_components(graph, directed=False)
+        all_events = np.concatenate((self.held_events, events))
+        labels = np.concatenate((comp[nnew + self.held_groups], comp[new_labels[ntail:]]))
+        times = np.append(self.held_times, np.full(len(events), tnow))
+        return all_events, ngroups, labels, times
+
+    def _emit_finished_groups(self, events, ngroups, labels, times):
+        # Emits groups that can no longer grow -- those with no events within t_thr of
+        # the latest event, or of a chunk we are still waiting for -- and holds on to the
+        # rest.
+        t_thr = self.thresholds[0] * 1e3
+        tlast = np.full(ngroups, -np.inf)
+        np.maximum.at(tlast, labels, events['timestamp_utc'])
+        tstart = np.full(ngroups, np.inf)
+        np.minimum.at(tstart, labels, events['timestamp_utc'])
+        is_open = ((tlast >= self.boundary - t_thr) |
+                   self._missing_chunk_near(tstart - t_thr, tlast + t_thr))
+        if self.hold_timeout is not None:
+            tfirst = np.full(ngroups, np.inf)
+            np.minimum.at(tfirst, labels, times)
+            is_open[time.monotonic() - tfirst > self.hold_timeout] = False
+        held = is_open[labels]
+        if np.any(held):
+            self.held_events = events[held]
+            _, self.held_groups = np.unique(labels[held], return_inverse=True)
+            self.held_times = times[held]
+        else:
+            self.held_events = self.held_groups = self.held_times = None
+        print('Beam grouper: holding %i events in %i groups that may grow' %
+              (np.sum(held), np.sum(is_open)))
+        done = np.logical_not(held)
+        if not np.any(done):
+            return []
+        events = events[done]
+        self._remember_emitted(events)
+        ngroups, labels = np.unique(labels[done], return_inverse=True)
+        return [self._make_l2_batch(events, len(ngroups), labels)]
+
+    def _make_l2_batch(self, events, ngroups, labels):
         #"dm_std": coh_events.dm.std(),
-        l2_events = []
-        for group in groups:
-            l2_event = create_l2_event(group,
-                                       beam_activity=beam_activity,
-                                       dm_activity=dm_activity,
-                                       beam_activity_lookback=self.beam_activity_lookback,
-                                       dm_activity_lookback=self.dm_activity_lookback,
-                                       avg_l1_grade=avg_l1_grade,
-                                       )
-            l2_events.append(l2_event)
-        return l2_events
+        print('Beam grouper: creating %i L2 events from %i L1 events' % (ngroups, len(events)))
+        return create_l2_events(events, ngroups, labels,
+                                beam_activity_lookback=list(self.beam_activity_lookback),
+                                dm_activity_lookback=list(self.dm_activity_lookback),
+                                **self.activity)
 
     def _cluster(self, events):
-        """ Performs event clustering via DBSCAN algorithm """
+        """ Performs event clustering via DBSCAN algorithm.
+
+        Returns (ngroups, labels), where *labels* is an integer array giving
+        the group number (0 to ngroups-1) of each event.
+        """
+        tdmxy = self._scaled_coords(events)
+        if self.nprocs > 1 and len(events) >= max(self.shard_min_events, self.nprocs):
+            return self._cluster_sharded(tdmxy)
+        return _cluster_coords(tdmxy, self.engine)
+
+    def _scaled_coords(self, events):
         # make a new (time, dm, x, y) array that will be scaled by thresholds
         tdmxy = np.empty((len(events), 4), np.float32)
-        times = np.array([e['timestamp_utc'] for e in events])
-        times = (times - min(times)) / 1e3
+        times = events['timestamp_utc']
+        times = (times - times.min()) / 1e3
         tdmxy[:, 0] = times
-        tdmxy[:, 1] = np.array([e['dm'] for e in events])
-        tdmxy[:, 2] = np.array([e['beam_grid_x'] for e in events]) # x (RA--like) in beam grid
-        tdmxy[:, 3] = np.array([e['beam_grid_y'] for e in events]) # y (Dec-like) in beam grid
+        tdmxy[:, 1] = events['dm']
+        tdmxy[:, 2] = events['beam_grid_x'] # x (RA--like) in beam grid
+        tdmxy[:, 3] = events['beam_grid_y'] # y (Dec-like) in beam grid
         tdmxy /= self.thresholds
+        return tdmxy
+
+    def _cluster_sharded(self, tdmxy):
+        # Sort the events by y and split them into nprocs bands with equal numbers of
+        # events.  Each band is extended by 1 (ie, dec_thr, in scaled coordinates) on both
+        # sides, so that every pair of neighbouring events lands together in at least one
+        # band.  The bands are contiguous ranges of the y-sorted events.
+        n = len(tdmxy)
+        order = np.argsort(tdmxy[:, 3], kind='stable')
+        y = tdmxy[order, 3]
+        cuts = np.linspace(0, n, self.nprocs + 1).astype(int)
+        # The band edges, as y values
+        ylo = y[cuts[:-1]]
+        yhi = y[cuts[1:] - 1]
+        los = np.searchsorted(y, ylo - 1., side='left')
+        his = np.searchsorted(y, yhi + 1., side='right')
+        out_offsets = np.append(0, np.cumsum(his - los))
+        nout = out_offsets[-1]
+        print('Beam grouper: clustering %i events in %i bands (%i with overlaps)' %
+              (n, self.nprocs, nout))
+
+        self._start_pool(max(tdmxy.nbytes, nout * 4))
+        # The ring has two slots: the y-sorted coordinates, read by every band's worker,
+        # and the labels, which each worker writes for its band (and we read back).
+        try:
+            cdesc = self.ring.put(tdmxy[order], nreaders=self.nprocs)
+            ldesc = self.ring.put(np.empty(nout, np.int32), nreaders=self.nprocs + 1)
+            args = [(cdesc, ldesc, lo, hi, off, self.engine)
+                    for lo,hi,off in zip(los, his, out_offsets)]
+            band_ngroups = self.pool.map(_cluster_band, args)
+            band_labels = self.ring.copy(ldesc)
+        except:
+            # A failed worker leaves its slots in use -- start again next time.
+            self.close()
+            raise
+
+        # Merge the bands' groups: a graph whose nodes are the (sorted) events followed by
+        # all the bands' groups, with an edge from each event to each of its groups.
+        events = np.concatenate([np.arange(lo, hi) for lo,hi in zip(los, his)])
+        group_offsets = np.append(0, np.cumsum(band_ngroups))
+        groups = band_labels + np.repeat(group_offsets[:-1], his - los)
+        nodes = n + group_offsets[-1]
+        graph = coo_matrix((np.ones(nout, bool), (events, n + groups)), shape=(nodes, nodes))
+        _, comp = connected_components(graph, directed=False)
+        ngroups, sorted_labels = np.unique(comp[:n], return_inverse=True)
+        labels = np.empty(n, int)
+        labels[order] = sorted_labels
+        return len(ngroups), labels
 
+    def _start_pool(self, nbytes):
+        # Starts the worker processes, with a ring whose slots hold at least *nbytes*.  The
+        # ring is handed to the workers when they start, so if a chunk outgrows it, the
+        # pool is re-started with a bigger one (sized to twice the high-water mark).
+        if self.ring is not None and nbytes <= self.ring.slot_bytes:
+            return
+        slot_bytes = 2 * max(nbytes, self.shard_min_events * 4 * 4)
+        if self.ring is not None:
+            print('Beam grouper: chunk of %i bytes does not fit in shared memory (%i bytes); '
+                  'restarting workers with %i bytes' % (nbytes, self.ring.slot_bytes, slot_bytes))
+            self.close()
+        ctx = multiprocessing.get_context(self.start_method)
+        self.ring = ShmRing(2, slot_bytes, lock=ctx.Lock())
+        self.pool = ctx.Pool(self.nprocs, initializer=_init_band_worker, initargs=(self.ring,))
+
+    @staticmethod
+    def _cluster_kdtree(tdmxy):
+        # Find all pairs of events within distance 1 (Chebyshev metric), as a sparse
+        # adjacency matrix, and label its connected components.
         tree = cKDTree(tdmxy)
-        neighbors = tree.query_ball_tree(tree, r=1.0, p=np.infty)
-
-        groups = {}
-        visiting = []
-        undiscovered = set(range(len(events)))
-        while undiscovered:
-            root = undiscovered.pop()
-            visiting.append(root)
-            while visiting:
-                event = visiting.pop()
-                groups.setdefault(root, []).append(event)
-                for new in set(neighbors[event]).intersection(undiscovered):
-                    undiscovered.remove(new)
-                    visiting.append(new)
-
-        #print('group indices:', [g for g in list(groups.values())])
-        return [[events[gi] for gi in g] for g in list(groups.values())]
+        pairs = tree.query_pairs(r=1.0, p=np.inf, output_type='ndarray')
+        n = len(tdmxy)
+        adjacency = coo_matrix((np.ones(len(pairs), bool), (pairs[:, 0], pairs[:, 1])),
+                               shape=(n, n))
+        ngroups, labels = connected_components(adjacency, directed=False)
+        return ngroups, labels
+
+    @staticmethod
+    def _cluster_sweep(tdmxy):
+        # Sort by time and cut the events into time blocks one t_thr wide.  Any pair of
+        # events within distance 1 is in the same block or in adjacent blocks, so we sweep
+        # through the blocks, finding pairs within the window of the current block plus
+        # the next one, and merge groups with a union-find (over time-sorted indices).
+        order = np.argsort(tdmxy[:, 0], kind='stable')
+        tdmxy = tdmxy[order]
+        n = len(tdmxy)
+        blocks,starts = np.unique(np.floor(tdmxy[:, 0]).astype(np.int64), return_index=True)
+        ends = np.append(starts[1:], n)
+        parent = np.arange(n)
+        for i in range(len(blocks)):
+            lo = starts[i]
+            mid = ends[i]
+            hi = mid
+            if i+1 < len(blocks) and blocks[i+1] == blocks[i] + 1:
+                hi = ends[i+1]
+            tree = cKDTree(tdmxy[lo:hi])
+            pairs = tree.query_pairs(r=1.0, p=np.inf, output_type='ndarray')
+            # Pairs entirely within the next block get found in the next window.
+            pairs = pairs[np.minimum(pairs[:, 0], pairs[:, 1]) < (mid - lo)]
+            if len(pairs) == 0:
+                continue
+            _union_pairs(parent, lo + pairs)
+        roots = _find_roots(parent, np.arange(n))
+        _, sorted_labels = np.unique(roots, return_inverse=True)
+        labels = np.empty(n, int)
+        labels[order] = sorted_labels
+        return sorted_labels.max() + 1, labels
+
+def _cluster_coords(tdmxy, engine):
+    if engine == 'sweep':
+        return BeamGrouper._cluster_sweep(tdmxy)
+    return BeamGrouper._cluster_kdtree(tdmxy)
+
+# The worker processes' ShmRing (see BeamGrouper._start_pool)
+_band_ring = None
+
+def _init_band_worker(ring):
+    global _band_ring
+    _band_ring = ring
+
+def _cluster_band(args):
+    # Runs in a worker process: clusters the y-sorted events [lo, hi) from the ring's
+    # coordinates slot, and writes their group labels into its labels slot at *out_offset*.
+    cdesc, ldesc, lo, hi, out_offset, engine = args
+    coords = _band_ring.get(cdesc)
+    ngroups, labels = _cluster_coords(coords[lo:hi], engine)
+    out = _band_ring.get(ldesc)
+    out[out_offset:out_offset + hi - lo] = labels
+    del coords, out
+    _band_ring.release(cdesc)
+    _band_ring.release(ldesc)
+    return ngroups
+
+def _find_roots(parent, idx):
+    # Union-find "find" for an array of indices, with path compression.
+    root = parent[idx]
+    while True:
+        up = parent[root]
+        if np.array_equal(up, root):
+            break
+        root = up
+    parent[idx] = root
+    return root
+
+def _union_pairs(parent, pairs):
+    # Union-find "union" for an (N,2) array of index pairs.  The current roots of the
+    # pairs form a graph whose connected components are the merged groups; each
+    # component is re-rooted at its smallest root.
+    roots = _find_roots(parent, pairs.ravel()).reshape(pairs.shape)
+    uroots, inv = np.unique(roots, return_inverse=True)
+    inv = inv.reshape(pairs.shape)
+    nr = len(uroots)
+    graph = coo_matrix((np.ones(len(inv), bool), (inv[:, 0], inv[:, 1])), shape=(nr, nr))
+    _, comp = connected_components(graph, directed=False)
+    newroot = np.full(comp.max() + 1, len(parent))
+    np.minimum.at(newroot, comp, uroots)
+    parent[uroots] = newroot[comp]
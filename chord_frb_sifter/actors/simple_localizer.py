@@ -22,35 +22,51 @@ def xyz_to_radec(xyz):
     dec = np.arcsin(xyz[:,2] / norm)
     return np.rad2deg(ra), np.rad2deg(dec)
 
+def localize_groups(dra, ddec, snr, offsets):
+    '''
+    SNR-weighted average positions for groups of L1 events, all at once.
+
+    *dra*, *ddec* (in deg) and *snr* are flat arrays over the L1 events,
+    sorted by group; the events for group i are [offsets[i], offsets[i+1]).
+
+    Returns (dra, ddec) arrays with one element per group.  Single-event
+    groups just get their event's position.
+    '''
+    offsets = np.asarray(offsets)
+    ngroups = len(offsets) - 1
+    out_dra = np.zeros(ngroups)
+    out_ddec = np.zeros(ngroups)
+    if ngroups == 0:
+        return out_dra, out_ddec
+    starts = offsets[:-1]
+    single = (np.diff(offsets) == 1)
+    out_dra[single] = dra[starts[single]]
+    out_ddec[single] = ddec[starts[single]]
+    multi = np.logical_not(single)
+    if not np.any(multi):
+        return out_dra, out_ddec
+    # Take the SNR-weighted average position -- in xyz unit-sphere coords
+    xyz_snr = radec_to_xyz(dra, ddec) * snr[:, np.newaxis]
+    sum_xyz = np.add.reduceat(xyz_snr, starts, axis=0)[multi]
+    sum_snr = np.add.reduceat(snr, starts)[multi]
+    out_dra[multi], out_ddec[multi] = xyz_to_radec(sum_xyz / sum_snr[:, np.newaxis])
+    return out_dra, out_ddec
+
 class SimpleLocalizer(Actor):
     '''
     Averages the "L1" individual events, weighting by S/N, to get the "L2" localization.
+
+    Input and output are L2EventBatch objects (see chord_frb_sifter.events);
+    all the L2 events in a batch are localized in one vectorized call.
     '''
     def __init__(self, **kwargs):
-        pass
-
-    def _perform_action(self, item):
-        #print('SimpleLocalizer: got', item)
-        l1_events = item['l1_events']
-        if len(l1_events) == 1:
-            item['average_dra'] = item['max_beam_dra']
-            item['average_ddec'] = item['max_beam_ddec']
-            return item
-        else:
-            print('Averaging L1 positions to get L2 position')
-            #print(item)
-            # Take the SNR-weighted average position -- in xyz unit-sphere coords
-            xyz_snr = 0.
-            sum_snr = 0.
-            for e in l1_events:
-                print('  snr %.1f: dra,ddec %.2f, %.2f' % (e['snr'], e['beam_dra'], e['beam_ddec']))
-                xyz = radec_to_xyz(e['beam_dra'], e['beam_ddec'])
-                snr = e['snr']
-                xyz_snr = xyz_snr + xyz * snr
-                sum_snr += snr
-            xyz_snr /= sum_snr
-            dra,ddec = xyz_to_radec(xyz_snr)
-            print('  -> average dra,ddec %.2f, %.2f' % (dra,ddec))
-            item['average_dra'] = dra
-            item['average_ddec'] = ddec
-            return item
+        super().__init__(**kwargs)
+
+    def _perform_action(self, batch):
+        l1 = batch.l1_events
+        dra,ddec = localize_groups(l1['beam_dra'], l1['beam_ddec'], l1['snr'], batch.l1_offsets)
+        batch.events['average_dra'] = dra
+        batch.events['average_ddec'] = ddec
+        print('SimpleLocalizer: localized %i L2 events (%i multi-beam)' %
+              (len(batch), np.sum(batch.group_sizes() > 1)))
+        return [batch]
@@ -0,0 +1,177 @@
+"""
+Columnar representations of the events that flow through the FRB Sifter.
+
+Rather than passing lists of per-event dicts between actors, we pass
+"batches": NumPy structured arrays with one element per event.  L1 events
+(single-beam detections from the FRB Search) use L1_EVENT_DTYPE.  Groups of L1
+events (candidate L2 events) are passed as an L2EventBatch, which holds an
+L2_EVENT_DTYPE array plus the L1 events that make up each group.
+"""
+
+import numpy as np
+
+# Lengths of the per-event S/N curves.  These are set by the bonsai config
+# (the CHIME/FRB values are used here).
+N_SNR_VS_DM = 17
+N_SNR_VS_TREE_INDEX = 5
+N_SNR_VS_SPECTRAL_INDEX = 2
+
+L1_EVENT_DTYPE = np.dtype([
+    ('beam', np.int32),
+    # FPGA count and UTC (in micro-seconds) of the time chunk of data
+    ('chunk_fpga', np.int64),
+    ('chunk_utc', np.float64),
+    ('frame0_nano', np.int64),
+    ('timestamp_fpga', np.int64),
+    # in micro-seconds
+    ('timestamp_utc', np.float64),
+    ('time_error', np.float32),
+    ('tree_index', np.uint8),
+    ('snr', np.float32),
+    ('snr_scale', np.float32),
+    ('dm', np.float32),
+    ('dm_error', np.float32),
+    ('spectral_index', np.uint8),
+    ('scattering_measure', np.uint8),
+    ('level1_nhits', np.float64),
+    ('rfi_grade_level1', np.uint8),
+    ('rfi_prob', np.float32),
+    ('rfi_mask_fraction', np.float32),
+    ('rfi_clip_fraction', np.float32),
+    ('snr_vs_dm', np.float32, (N_SNR_VS_DM,)),
+    ('snr_vs_tree_index', np.float32, (N_SNR_VS_TREE_INDEX,)),
+    ('snr_vs_spectral_index', np.float32, (N_SNR_VS_SPECTRAL_INDEX,)),
+    # beam position, in units of beam spacing (used by BeamGrouper)
+    ('beam_grid_x', np.float32),
+    ('beam_grid_y', np.float32),
+    # beam position offset, in deg (used by SimpleLocalizer)
+    ('beam_dra', np.float64),
+    ('beam_ddec', np.float64),
+    # a beam reported in, but found no events
+    ('null_event', bool),
+    # for debugging purposes, set by BeamBuffer
+    ('pipeline_timestamp', np.float64),
+    ('pipeline_id', np.int64),
+])
+
+# L1 fields that get copied from the max-S/N L1 event into its L2 event.
+L2_COPIED_FIELDS = ['beam', 'chunk_fpga', 'chunk_utc', 'timestamp_fpga', 'timestamp_utc',
+                    'time_error', 'tree_index', 'dm', 'dm_error', 'rfi_grade_level1',
+                    'rfi_prob', 'pipeline_timestamp', 'pipeline_id']
+# L1 fields that get copied from the max-S/N L1 event into "max_" + field.
+L2_MAX_FIELDS = ['beam_grid_x', 'beam_grid_y', 'beam_dra', 'beam_ddec', 'snr']
+
+L2_EVENT_DTYPE = np.dtype(
+    [(k, L1_EVENT_DTYPE[k]) for k in L2_COPIED_FIELDS] +
+    [('max_' + k, L1_EVENT_DTYPE[k]) for k in L2_MAX_FIELDS] +
+    [('nbeams', np.int32),
+     ('beam_activity', np.int32),
+     ('dm_activity', np.int32),
+     ('avg_l1_grade', np.float32),
+     # set by SimpleLocalizer
+     ('average_dra', np.float64),
+     ('average_ddec', np.float64),
+     ])
+
+def empty_l1_batch(n=0):
+    return np.zeros(n, L1_EVENT_DTYPE)
+
+def as_l1_batch(events, rename=None):
+    '''
+    Converts *events* into an L1 batch (array of L1_EVENT_DTYPE).
+
+    *events* can be an L1 batch (returned as-is), any structured array with
+    (some of) the L1 fields, eg as read from a FITS table, or a list of
+    per-event dicts.  Fields are copied column-by-column; fields that are not
+    part of L1_EVENT_DTYPE are dropped.  *rename* is an optional dict mapping
+    input to output field names.
+    '''
+    if isinstance(events, np.ndarray) and events.dtype == L1_EVENT_DTYPE:
+        return events
+    if rename is None:
+        rename = {}
+    if isinstance(events, np.ndarray):
+        n = len(events)
+        names = events.dtype.names
+        get_column = lambda k: events[k]
+    else:
+        events = list(events)
+        n = len(events)
+        names = set()
+        for e in events:
+            names.update(e.keys())
+        get_column = lambda k: [e.get(k, 0) for e in events]
+    batch = empty_l1_batch(n)
+    for k in names:
+        k_out = rename.get(k, k)
+        if k_out in L1_EVENT_DTYPE.names:
+            batch[k_out] = get_column(k)
+    return batch
+
+def batch_to_dicts(batch):
+    '''
+    Converts a structured array into a list of per-event dicts (for
+    debugging and printing).
+    '''
+    names = batch.dtype.names
+    return [dict(zip(names, row.tolist())) for row in batch]
+
+def concatenate_l2_batches(batches):
+    '''
+    Concatenates a list of L2EventBatch objects into one.  The lookbacks
+    are taken from the last batch.
+    '''
+    if len(batches) == 1:
+        return batches[0]
+    offsets = [np.zeros(1, int)]
+    n = 0
+    for b in batches:
+        offsets.append(n + b.l1_offsets[1:])
+        n += b.l1_offsets[-1]
+    last = batches[-1]
+    return L2EventBatch(np.concatenate([b.events for b in batches]),
+                        np.concatenate([b.l1_events for b in batches]),
+                        np.concatenate(offsets),
+                        beam_activity_lookback=last.beam_activity_lookback,
+                        dm_activity_lookback=last.dm_activity_lookback)
+
+class L2EventBatch(object):
+    '''
+    The L2 events (groups of L1 events) from one chunk of data.
+
+    *events* is an array of L2_EVENT_DTYPE, one element per group.
+
+    *l1_events* is an L1 batch containing the L1 events that make up the
+    groups, sorted by group: the L1 events for group *i* are
+    l1_events[l1_offsets[i] : l1_offsets[i+1]].
+    '''
+    def __init__(self, events, l1_events, l1_offsets,
+                 beam_activity_lookback=None, dm_activity_lookback=None):
+        assert(len(l1_offsets) == len(events) + 1)
+        self.events = events
+        self.l1_events = l1_events
+        self.l1_offsets = np.asarray(l1_offsets)
+        self.beam_activity_lookback = beam_activity_lookback
+        self.dm_activity_lookback = dm_activity_lookback
+
+    def __len__(self):
+        return len(self.events)
+
+    def group_sizes(self):
+        return np.diff(self.l1_offsets)
+
+    def group_l1_events(self, i):
+        return self.l1_events[self.l1_offsets[i] : self.l1_offsets[i+1]]
+
+    def to_dicts(self):
+        '''
+        Returns a list of L2 event dicts, each with an 'l1_events' list of
+        L1 event dicts -- the format used by the CHIME/FRB actors.
+        '''
+        rtn = []
+        for i,e in enumerate(batch_to_dicts(self.events)):
+            e['l1_events'] = batch_to_dicts(self.group_l1_events(i))
+            e['beam_activity_lookback'] = self.beam_activity_lookback
+            e['dm_activity_lookback'] = self.dm_activity_lookback
+            rtn.append(e)
+        return rtn
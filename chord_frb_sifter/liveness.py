@@ -0,0 +1,210 @@
+"""
+Beam liveness / exposure accounting.
+
+The FRB Search nodes send an FrbEventsMessage for every chunk of data, for
+each beam set, even if it has no events.  LivenessMap records which beam
+sets reported in each chunk as a bitmap -- one row per chunk, one bit per
+beam set -- in memory-mapped files, one per (UTC) day, like the exposure
+files the CHIME/FRB BeamBuffer used to write.  Bits are only ever set, so
+the files are effectively append-only: a day's file is created (sparse,
+all zeros) when its first chunk arrives, and rows are filled in as chunks
+arrive.
+
+The exposure (fraction of beams live) over any time range can then be
+computed from the bitmaps alone -- for the default 1024 beam sets, a day
+is 8640 rows of 128 bytes -- without touching the event tables.
+
+    liveness = LivenessMap('liveness')
+    liveness.record(beam_set_id, chunk_fpga)
+    ...
+    frac = liveness.fraction_live(t0, t1)
+"""
+
+import os
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+SECONDS_PER_DAY = 86400
+
+# Number of bits set in each byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], np.uint8)
+
+LIVENESS_HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('max_beam_sets', '<u4'),
+    ('fpga_per_chunk', '<u8'),
+    ('day', '<i8'),
+    ('padding', 'V32'),
+])
+LIVENESS_MAGIC = b'FRBLIVE1'
+
+class LivenessMap(object):
+    '''
+    Per-beam-set, per-chunk liveness bitmaps, in one file per day in
+    *directory*.
+
+    Parameters
+    ----------
+    directory : str
+        Where to write (and read) the daily files.
+    max_beam_sets : int
+        Beam set ids must be in [0, max_beam_sets).
+    fpga_per_chunk : int
+        FPGA counts per chunk of data (10 seconds at 2.56 micro-seconds per
+        FPGA count).
+    fpga_seconds : float
+        Seconds per FPGA count.
+    fpga0_unix : float
+        Unix time of FPGA count zero.  FIXME -- like frb_events_to_batch, for
+        now, assume FPGA count zero is the Unix epoch.
+    '''
+    def __init__(self, directory, max_beam_sets=1024, fpga_per_chunk=3906250,
+                 fpga_seconds=2.56e-6, fpga0_unix=0., max_open_files=4):
+        self.directory = directory
+        self.max_beam_sets = max_beam_sets
+        self.row_bytes = (max_beam_sets + 7) // 8
+        self.fpga_per_chunk = fpga_per_chunk
+        self.fpga_seconds = fpga_seconds
+        self.fpga0_unix = fpga0_unix
+        self.chunk_seconds = fpga_per_chunk * fpga_seconds
+        self.chunks_per_day = int(np.ceil(SECONDS_PER_DAY / self.chunk_seconds))
+        self.max_open_files = max_open_files
+        # day -> memmap of the day's bitmap, most recently used last
+        self.open_days = {}
+        # record() is called from the gRPC server threads
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def chunk_index(self, chunk_fpga):
+        # Global chunk number (chunks since the Unix epoch).
+        t = self.fpga0_unix + np.asarray(chunk_fpga) * self.fpga_seconds
+        return np.floor(t / self.chunk_seconds + 1e-6).astype(np.int64)
+
+    def filename(self, day):
+        d = datetime.fromtimestamp(day * SECONDS_PER_DAY, tz=timezone.utc)
+        return os.path.join(self.directory, 'liveness-%s.dat' % d.strftime('%Y%m%d'))
+
+    def _day_rows(self, day, create):
+        # Returns the memmap of *day*'s bitmap rows, or None if it doesn't exist (and
+        # not *create*).
+        rows = self.open_days.pop(day, None)
+        if rows is None:
+            fn = self.filename(day)
+            if not os.path.exists(fn):
+                if not create:
+                    return None
+                self._create_file(fn, day)
+            hdr = np.fromfile(fn, LIVENESS_HEADER_DTYPE, count=1)[0]
+            if (hdr['magic'] != LIVENESS_MAGIC or
+                hdr['max_beam_sets'] != self.max_beam_sets or
+                hdr['fpga_per_chunk'] != self.fpga_per_chunk):
+                raise ValueError('Liveness file %s does not match this LivenessMap '
+                                 '(max_beam_sets %i, fpga_per_chunk %i)' %
+                                 (fn, self.max_beam_sets, self.fpga_per_chunk))
+            rows = np.memmap(fn, np.uint8, mode='r+' if create else 'r',
+                             offset=LIVENESS_HEADER_DTYPE.itemsize,
+                             shape=(self.chunks_per_day, self.row_bytes))
+            while len(self.open_days) >= self.max_open_files:
+                # close the least recently used
+                old = self.open_days.pop(next(iter(self.open_days)))
+                if old.mode == 'r+':
+                    old.flush()
+        elif create and rows.mode != 'r+':
+            # re-open for writing
+            return self._day_rows(day, create)
+        self.open_days[day] = rows
+        return rows
+
+    def _create_file(self, fn, day):
+        hdr = np.zeros(1, LIVENESS_HEADER_DTYPE)
+        hdr['magic'] = LIVENESS_MAGIC
+        hdr['version'] = 1
+        hdr['max_beam_sets'] = self.max_beam_sets
+        hdr['fpga_per_chunk'] = self.fpga_per_chunk
+        hdr['day'] = day
+        tmpfn = fn + '.tmp'
+        with open(tmpfn, 'wb') as f:
+            hdr.tofile(f)
+            # sparse -- the rows read as zeros until written
+            f.truncate(LIVENESS_HEADER_DTYPE.itemsize + self.chunks_per_day * self.row_bytes)
+        os.rename(tmpfn, fn)
+
+    def record(self, beam_set_id, chunk_fpga):
+        '''
+        Records that beam set *beam_set_id* reported for the chunk starting
+        at FPGA count *chunk_fpga*.
+        '''
+        if beam_set_id < 0 or beam_set_id >= self.max_beam_sets:
+            raise ValueError('LivenessMap: beam set id %i out of range [0, %i)' %
+                             (beam_set_id, self.max_beam_sets))
+        chunk = int(self.chunk_index(chunk_fpga))
+        day,row = divmod(chunk, self.chunks_per_day)
+        with self.lock:
+            rows = self._day_rows(day, True)
+            rows[row, beam_set_id // 8] |= np.uint8(1 << (beam_set_id % 8))
+
+    def flush(self):
+        with self.lock:
+            for rows in self.open_days.values():
+                if rows.mode == 'r+':
+                    rows.flush()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.open_days = {}
+
+    def live_counts(self, t0, t1, beams_per_set=None):
+        '''
+        Returns (chunk_start_times, nlive) for the chunks starting in Unix
+        time range [*t0*, *t1*): the number of live beam sets in each chunk,
+        or, given *beams_per_set* (an array with one element per beam set
+        id), the number of live beams.
+        '''
+        c0 = int(np.ceil(t0 / self.chunk_seconds - 1e-6))
+        c1 = int(np.ceil(t1 / self.chunk_seconds - 1e-6))
+        nchunks = max(c1 - c0, 0)
+        nlive = np.zeros(nchunks, np.float64 if beams_per_set is not None else np.int64)
+        if beams_per_set is not None:
+            weights = np.zeros(self.row_bytes * 8)
+            weights[:len(beams_per_set)] = beams_per_set
+        for day in range(c0 // self.chunks_per_day, (c1 - 1) // self.chunks_per_day + 1):
+            d0 = day * self.chunks_per_day
+            lo = max(c0, d0)
+            hi = min(c1, d0 + self.chunks_per_day)
+            if hi <= lo:
+                continue
+            with self.lock:
+                rows = self._day_rows(day, False)
+                if rows is None:
+                    # No file -- nothing reported that day.
+                    continue
+                rows = np.array(rows[lo - d0 : hi - d0])
+            if beams_per_set is None:
+                nlive[lo - c0 : hi - c0] = _POPCOUNT[rows].sum(axis=1)
+            else:
+                bits = np.unpackbits(rows, axis=1, bitorder='little')
+                nlive[lo - c0 : hi - c0] = bits @ weights
+        times = (c0 + np.arange(nchunks)) * self.chunk_seconds
+        return times, nlive
+
+    def fraction_live(self, t0, t1, n_beam_sets=None, beams_per_set=None):
+        '''
+        Returns the fraction of beams live over Unix time range [*t0*, *t1*):
+        the live beam-set-chunks divided by *n_beam_sets* (default
+        *max_beam_sets*) times the number of chunks -- or, given
+        *beams_per_set*, weighted by the number of beams in each beam set.
+        '''
+        times, nlive = self.live_counts(t0, t1, beams_per_set=beams_per_set)
+        if len(times) == 0:
+            return 0.
+        if beams_per_set is not None:
+            total = np.sum(beams_per_set)
+        elif n_beam_sets is not None:
+            total = n_beam_sets
+        else:
+            total = self.max_beam_sets
+        return np.sum(nlive) / (float(total) * len(times))
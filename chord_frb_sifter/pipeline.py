@@ -0,0 +1,208 @@
+"""
+A simple multi-threaded runner for the FRB Sifter pipeline.
+
+Each stage wraps an Actor and has its own worker thread(s), reading items
+from a bounded input queue and putting the actor's outputs into the next
+stage's queue.  Since the queues are bounded, a slow stage (eg, database
+writes) makes the stages before it block, all the way back to
+Pipeline.put(), rather than letting queues grow without limit.  Meanwhile,
+stages run concurrently, so (for example) DB writes for one chunk overlap
+with grouping the next one.
+
+    pipeline = Pipeline()
+    pipeline.add_stage('BeamBuffer', BeamBuffer(**conf))
+    pipeline.add_stage('BeamGrouper', BeamGrouper(**conf))
+    pipeline.add_stage('Localizer', SimpleLocalizer, workers=4)
+    pipeline.start()
+    for events in ...:
+        pipeline.put(events)
+    pipeline.stop()
+"""
+
+import queue
+import threading
+import time
+
+from chord_frb_sifter.actors.actor import Actor
+
+# Put into a stage's queue (once per worker) to tell its workers to finish up.
+_STOP = object()
+
+class CallbackActor(Actor):
+    '''
+    An Actor that calls *func(item)* for each item; *func* returns a list
+    of output items, or None.  Useful for pipeline sinks (eg, DB writes).
+    '''
+    def __init__(self, func, **kwargs):
+        super().__init__(**kwargs)
+        self.func = func
+    def _perform_action(self, item):
+        return self.func(item)
+
+class Stage(object):
+    '''
+    One stage of a Pipeline: a bounded input queue plus one or more worker
+    threads, each with its own Actor.
+    '''
+    def __init__(self, name, actors, queue_size, update_period):
+        self.name = name
+        self.actors = actors
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.update_period = update_period
+        # the next stage, or None for the last stage
+        self.next_stage = None
+        # called with each output item of the last stage
+        self.output = None
+        self.threads = []
+        self.abort = threading.Event()
+        self.n_items = 0
+        self.n_errors = 0
+        self.count_lock = threading.Lock()
+
+    def start(self):
+        for i,actor in enumerate(self.actors):
+            t = threading.Thread(target=self._worker, args=(actor,),
+                                 name='%s-%i' % (self.name, i), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def put(self, item, timeout=None):
+        self.queue.put(item, timeout=timeout)
+
+    def close(self):
+        # Ask the workers to finish the items already queued, flush their actors, and exit.
+        for t in self.threads:
+            self.queue.put(_STOP)
+        for t in self.threads:
+            t.join()
+
+    def _send(self, items):
+        if items is None:
+            return
+        for item in items:
+            if item is None:
+                continue
+            if self.next_stage is not None:
+                # Blocks if the next stage is full -- backpressure.
+                while True:
+                    try:
+                        self.next_stage.put(item, timeout=self.update_period)
+                        break
+                    except queue.Full:
+                        if self.abort.is_set():
+                            return
+            elif self.output is not None:
+                self.output(item)
+
+    def _worker(self, actor):
+        last_update = time.monotonic()
+        while not self.abort.is_set():
+            try:
+                item = self.queue.get(timeout=self.update_period)
+            except queue.Empty:
+                item = None
+            try:
+                if item is _STOP:
+                    self._send(actor.perform_flush())
+                    break
+                if item is not None:
+                    self._send(actor.perform_action(item))
+                    with self.count_lock:
+                        self.n_items += 1
+                tnow = time.monotonic()
+                if tnow - last_update >= self.update_period:
+                    last_update = tnow
+                    self._send(actor.perform_update())
+            except Exception:
+                # The actor has already printed the traceback; keep going.
+                with self.count_lock:
+                    self.n_errors += 1
+                print('Pipeline stage', self.name, ': error processing item; continuing')
+
+class Pipeline(object):
+    '''
+    A chain of Stages connected by bounded queues.
+
+    Parameters
+    ----------
+    queue_size : int
+        Default maximum number of items waiting in each stage's input queue.
+    update_period : float
+        Seconds between calls to each actor's perform_update() (for
+        timeouts, eg in BeamBuffer).
+    output : callable or None
+        Called (from a worker thread of the last stage) with each output item
+        of the last stage.
+    '''
+    def __init__(self, queue_size=16, update_period=1.0, output=None):
+        self.queue_size = queue_size
+        self.update_period = update_period
+        self.output = output
+        self.stages = []
+        self.running = False
+
+    def add_stage(self, name, actor, workers=1, queue_size=None):
+        '''
+        Adds a stage running *actor* (an Actor, or a function taking an item
+        and returning a list of output items).  For *workers* > 1, *actor*
+        must instead be a factory (eg, an Actor class) that is called to
+        create one Actor per worker thread -- items may then be processed
+        out of order.
+        '''
+        assert(not self.running)
+        if workers == 1:
+            if not isinstance(actor, Actor):
+                actor = CallbackActor(actor)
+            actors = [actor]
+        else:
+            assert(not isinstance(actor, Actor))
+            actors = [actor() for i in range(workers)]
+        if queue_size is None:
+            queue_size = self.queue_size
+        stage = Stage(name, actors, queue_size, self.update_period)
+        if len(self.stages):
+            self.stages[-1].next_stage = stage
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        assert(len(self.stages))
+        self.stages[-1].output = self.output
+        for stage in self.stages:
+            stage.start()
+        self.running = True
+
+    def put(self, item, timeout=None):
+        '''
+        Feeds an item to the first stage.  Blocks if the pipeline is behind
+        (or raises queue.Full after *timeout* seconds).
+        '''
+        self.stages[0].put(item, timeout=timeout)
+
+    def queue_sizes(self):
+        return dict([(s.name, s.queue.qsize()) for s in self.stages])
+
+    def stats(self):
+        return dict([(s.name, dict(queued=s.queue.qsize(), items=s.n_items, errors=s.n_errors))
+                     for s in self.stages])
+
+    def stop(self, drain=True):
+        '''
+        Shuts down the pipeline.  With *drain*, each stage in turn finishes
+        all its queued items and flushes whatever its actors are holding on
+        to (eg, partially-filled chunks in BeamBuffer) down the pipeline
+        before the next stage is shut down.  Otherwise, queued items are
+        dropped.
+        '''
+        if not self.running:
+            return
+        if drain:
+            for stage in self.stages:
+                stage.close()
+        else:
+            for stage in self.stages:
+                stage.abort.set()
+            for stage in self.stages:
+                for t in stage.threads:
+                    t.join()
+        self.running = False
@@ -0,0 +1,207 @@
+"""
+Shared-memory hand-off of event batches between processes.
+
+Pickling a batch of L1 events to send it through a multiprocessing.Queue (or
+a ZMQ socket, as the CHIME/FRB pipeline did) costs a serialization, a copy
+through a pipe, and a deserialization at every hop.  Instead, a ShmRing is a
+shared-memory segment divided into fixed-size slots: the sender copies a
+batch into a free slot and sends only a small BatchDescriptor (slot number,
+generation, dtype and length) through the queue; the receiver gets a
+zero-copy NumPy view of the slot.
+
+Each slot has a reference count (the number of receivers that have not yet
+released it) and a generation number, which is incremented each time the
+slot is re-used.  A slot is only re-used once its count drops to zero, and
+a descriptor whose generation does not match its slot (ie, one that has
+already been released) is rejected, so a stale descriptor can never read
+another batch's data.
+
+    ring = ShmRing(nslots=8, slot_bytes=64 << 20)
+    # ... pass *ring* to the receiving process, eg as a Process argument
+    desc = ring.put(events)        # sender; blocks while all slots are busy
+    queue.put(desc)
+
+    desc = queue.get()             # receiver
+    events = ring.get(desc)        # a view into shared memory
+    ...
+    del events
+    ring.release(desc)
+
+The ring can be passed to child processes (it pickles as the segment name
+plus its lock), but only at process creation -- eg as a Process argument or
+Pool initializer -- since the lock cannot be sent through a queue.  The
+process that created the ring should call unlink() when done.
+"""
+
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from chord_frb_sifter.events import L1_EVENT_DTYPE, L2_EVENT_DTYPE
+
+# Well-known dtypes are sent by name rather than pickled with each descriptor.
+DTYPES = {
+    'l1': L1_EVENT_DTYPE,
+    'l2': L2_EVENT_DTYPE,
+}
+
+# Slots (and the header) start on cache-line boundaries.
+_ALIGN = 64
+
+class ShmRingStale(RuntimeError):
+    '''
+    Raised when a descriptor refers to a slot that has since been released.
+    '''
+    pass
+
+class BatchDescriptor(object):
+    '''
+    The message sent in place of a batch: where it is in the ring, and
+    how to interpret it.
+    '''
+    __slots__ = ['slot', 'generation', 'dtype', 'shape']
+
+    def __init__(self, slot, generation, dtype, shape):
+        self.slot = slot
+        self.generation = generation
+        # name from DTYPES, or a np.dtype
+        self.dtype = dtype
+        self.shape = shape
+
+    def __getstate__(self):
+        return (self.slot, self.generation, self.dtype, self.shape)
+
+    def __setstate__(self, state):
+        self.slot, self.generation, self.dtype, self.shape = state
+
+    def __repr__(self):
+        return 'BatchDescriptor(slot=%i, generation=%i, dtype=%s, shape=%s)' % (
+            self.slot, self.generation, self.dtype if isinstance(self.dtype, str) else '...',
+            self.shape)
+
+    def get_dtype(self):
+        if isinstance(self.dtype, str):
+            return DTYPES[self.dtype]
+        return self.dtype
+
+def _dtype_key(dtype):
+    for k,v in DTYPES.items():
+        if v == dtype:
+            return k
+    return dtype
+
+class ShmRing(object):
+    '''
+    A ring of *nslots* shared-memory slots, each holding one batch of up to
+    *slot_bytes* bytes.
+    '''
+    def __init__(self, nslots, slot_bytes, lock=None, name=None):
+        self.nslots = nslots
+        self.slot_bytes = -(-slot_bytes // _ALIGN) * _ALIGN
+        header_bytes = -(-nslots * 2 * 8 // _ALIGN) * _ALIGN
+        self.header_bytes = header_bytes
+        size = header_bytes + nslots * self.slot_bytes
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        if lock is None:
+            lock = multiprocessing.Lock()
+        # Guards the header (generations and reference counts)
+        self.lock = lock
+        # [generation, refcount] for each slot
+        self.header = np.ndarray((nslots, 2), np.int64, buffer=self.shm.buf)
+        if self.owner:
+            self.header[:] = 0
+        # Where to start looking for a free slot
+        self.next_slot = 0
+
+    def __reduce__(self):
+        return (ShmRing, (self.nslots, self.slot_bytes, self.lock, self.shm.name))
+
+    def _slot_view(self, slot, dtype, shape):
+        offset = self.header_bytes + slot * self.slot_bytes
+        return np.ndarray(shape, dtype, buffer=self.shm.buf, offset=offset)
+
+    def put(self, batch, nreaders=1, timeout=None):
+        '''
+        Copies the array *batch* into a free slot, to be read by *nreaders*
+        receivers, and returns its BatchDescriptor.  Waits for a slot to
+        be released if they are all in use (raising TimeoutError after
+        *timeout* seconds).
+        '''
+        batch = np.ascontiguousarray(batch)
+        if batch.nbytes > self.slot_bytes:
+            raise ValueError('ShmRing: batch of %i bytes does not fit in a %i-byte slot' %
+                             (batch.nbytes, self.slot_bytes))
+        t0 = time.monotonic()
+        while True:
+            slot = self._claim_slot(nreaders)
+            if slot is not None:
+                break
+            if timeout is not None and time.monotonic() - t0 > timeout:
+                raise TimeoutError('ShmRing: no free slots after %g sec' % timeout)
+            time.sleep(0.0005)
+        # We own the slot until we hand out the descriptor, so no need for the lock here.
+        self._slot_view(slot, batch.dtype, batch.shape)[...] = batch
+        return BatchDescriptor(slot, int(self.header[slot, 0]), _dtype_key(batch.dtype),
+                               batch.shape)
+
+    def _claim_slot(self, nreaders):
+        with self.lock:
+            for i in range(self.nslots):
+                slot = (self.next_slot + i) % self.nslots
+                if self.header[slot, 1] == 0:
+                    self.header[slot, 0] += 1
+                    self.header[slot, 1] = nreaders
+                    self.next_slot = (slot + 1) % self.nslots
+                    return slot
+        return None
+
+    def _check(self, desc):
+        if self.header[desc.slot, 0] != desc.generation or self.header[desc.slot, 1] <= 0:
+            raise ShmRingStale('ShmRing: stale descriptor %r (slot generation %i, refcount %i)'
+                               % (desc, self.header[desc.slot, 0], self.header[desc.slot, 1]))
+
+    def get(self, desc):
+        '''
+        Returns a zero-copy view of the batch described by *desc*.  The view
+        is only valid until release(*desc*).
+        '''
+        with self.lock:
+            self._check(desc)
+        return self._slot_view(desc.slot, desc.get_dtype(), desc.shape)
+
+    def copy(self, desc):
+        '''
+        Returns a copy of the batch described by *desc*, and releases it.
+        '''
+        batch = self.get(desc).copy()
+        self.release(desc)
+        return batch
+
+    def release(self, desc):
+        '''
+        Called by each receiver when it is done with the batch.
+        '''
+        with self.lock:
+            self._check(desc)
+            self.header[desc.slot, 1] -= 1
+
+    def nfree(self):
+        with self.lock:
+            return int(np.sum(self.header[:, 1] == 0))
+
+    def close(self):
+        # Views returned by get() must be deleted first.
+        self.header = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
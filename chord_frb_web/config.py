@@ -1,5 +1,9 @@
 import os
 
+from chord_frb_db.utils import engine_options
+
 class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('CHORD_FRB_DB_URL')
+    # pool size, pre-ping and recycle, as for chord_frb_db.utils.get_db_engine
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI or 'sqlite://')
     TEMPLATES_AUTO_RELOAD = True
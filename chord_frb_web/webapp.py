@@ -1,11 +1,19 @@
-from flask import Flask, request, make_response
+from flask import Flask, request, make_response, Response
 from .config import Config
 from flask import render_template
 import sys
+import os
+import tempfile
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import numpy as np
 
 from flask_sqlalchemy import SQLAlchemy
 
-from chord_frb_db.models import Event, EventBeam
+from chord_frb_db.models import Event, EventBeam, KnownSource
 
 import sqlalchemy as sa
 
@@ -16,101 +24,300 @@ app = Flask(__name__)
 app.config.from_object(Config)
 db = SQLAlchemy(app)
 
+# Fields shown on the event detail page
+EVENT_FIELDS = ['event_id', 'timestamp', 'rfi_grade', 'total_snr', 'dm', 'ra', 'dec', 'nbeams']
+L1_EVENT_FIELDS = ['beam', 'snr', 'timestamp_utc', 'timestamp_fpga']
+# Rendered event pages are cached for this long (popular candidates get many views
+# during follow-up)...
+EVENT_PAGE_CACHE_SECONDS = 30.
+# ... up to this many pages.
+EVENT_PAGE_CACHE_SIZE = 1000
+
+# event_id -> (time, html), least recently used first
+_event_page_cache = OrderedDict()
+_event_page_cache_lock = threading.Lock()
+
+def get_event_details(event_id):
+    '''
+    Returns (event, known_source_name, l1_events) -- dicts of the listed
+    fields -- for *event_id*, or None if there is no such event.  This is a
+    single query: the event, LEFT JOINed to its known source and its beams,
+    one row per beam.
+    '''
+    ev = Event.__table__.c
+    l1 = EventBeam.__table__.c
+    query = (sa.select(*[ev[f] for f in EVENT_FIELDS],
+                       KnownSource.name.label('known_name'),
+                       l1.id.label('l1_id'),
+                       *[l1[f].label('l1_' + f) for f in L1_EVENT_FIELDS])
+             .select_from(Event)
+             .outerjoin(KnownSource, Event.known_id == KnownSource.id)
+             .outerjoin(EventBeam, EventBeam.event_id == Event.event_id)
+             .where(Event.event_id == event_id)
+             .order_by(EventBeam.snr.desc()))
+    rows = db.session.execute(query).mappings().all()
+    if len(rows) == 0:
+        return None
+    event = dict([(f, rows[0][f]) for f in EVENT_FIELDS])
+    known = rows[0]['known_name']
+    l1_events = [dict([(f, r['l1_' + f]) for f in L1_EVENT_FIELDS])
+                 for r in rows if r['l1_id'] is not None]
+    return event, known, l1_events
+
 @app.route('/l1-events/<int:event_id>')
 def l1_event_list(event_id):
-    query = sa.select(EventBeam).filter_by(event_id=event_id)
-    r = db.session.execute(query).scalars()
-    print('r:', r)
+    now = time.monotonic()
+    with _event_page_cache_lock:
+        cached = _event_page_cache.get(event_id)
+        if cached is not None and now - cached[0] < EVENT_PAGE_CACHE_SECONDS:
+            _event_page_cache.move_to_end(event_id)
+            return cached[1]
+
+    details = get_event_details(event_id)
+    if details is None:
+        return make_response('No such event: %i\n' % event_id, 404)
+    event, known, l1_events = details
+    html = render_template('l1_event_list.html', event_id=event_id,
+                           event=event, event_fields=EVENT_FIELDS, known=known,
+                           l1_events=l1_events, fields=L1_EVENT_FIELDS)
+
+    with _event_page_cache_lock:
+        _event_page_cache[event_id] = (now, html)
+        _event_page_cache.move_to_end(event_id)
+        while len(_event_page_cache) > EVENT_PAGE_CACHE_SIZE:
+            _event_page_cache.popitem(last=False)
+    return html
+
+# Events per page on the event list
+EVENTS_PER_PAGE = 20
+# How long to keep the (estimated) total number of events
+COUNT_CACHE_SECONDS = 60.
 
-    query = sa.select(Event).filter_by(event_id=event_id)
-    event = db.session.execute(query).scalar_one()
-    print('event:', event)
+_event_count = dict(time=0., count=None)
 
-    fields = ['beam', 'snr', 'timestamp_utc', 'timestamp_fpga']
-    return render_template('l1_event_list.html', event_id=event_id,
-                           event=event, l1_events=r, fields=fields)
+def event_count():
+    '''
+    The total number of events, for the event list.  COUNT(*) has to scan the
+    whole table, so on PostgreSQL this uses the planner's estimate
+    (pg_class.reltuples, kept up to date by autovacuum/ANALYZE); either way
+    the result is cached for COUNT_CACHE_SECONDS.
+    '''
+    now = time.monotonic()
+    if _event_count['count'] is not None and now - _event_count['time'] < COUNT_CACHE_SECONDS:
+        return _event_count['count']
+    n = -1
+    if db.engine.dialect.name == 'postgresql':
+        n = db.session.execute(sa.text(
+            "SELECT reltuples::bigint FROM pg_class WHERE relname = 'event'")).scalar()
+        if n is None:
+            n = -1
+    if n < 0:
+        # not PostgreSQL, or the table has never been analyzed
+        n = db.session.execute(sa.select(sa.func.count()).select_from(Event)).scalar()
+    _event_count.update(time=now, count=n)
+    return n
+
+def int_arg(name):
+    try:
+        return int(request.args.get(name))
+    except (TypeError, ValueError):
+        return None
 
 @app.route('/')
 def event_list(): #(name=None):
-    query = sa.select(Event).order_by(Event.event_id)#.desc())
-    #order_by(Event.timestamp.desc())
+    # Keyset ("cursor") pagination on event_id: the next page is the events with event_id
+    # after the last one shown, the previous page those before the first one shown.  Each
+    # page is an index range scan on the primary key, so deep pages cost the same as the
+    # first (unlike OFFSET, which reads and discards all the preceding rows).
+    after = int_arg('after')
+    before = int_arg('before')
+    last = request.args.get('last') is not None
+    n = EVENTS_PER_PAGE
+
+    query = sa.select(Event)
+    events = None
+    if before is not None or last:
+        # fetch backwards, then reverse
+        if before is not None:
+            query = query.where(Event.event_id < before)
+        query = query.order_by(Event.event_id.desc()).limit(n + 1)
+        events = list(db.session.execute(query).scalars())
+        has_prev = len(events) > n
+        events = events[:n][::-1]
+        has_next = not last
+        if before is not None and len(events) < n:
+            # Less than a page before this one: show the (full) first page instead.
+            events = None
+            after = None
+            query = sa.select(Event)
+    if events is None:
+        if after is not None:
+            query = query.where(Event.event_id > after)
+        query = query.order_by(Event.event_id).limit(n + 1)
+        events = list(db.session.execute(query).scalars())
+        has_next = len(events) > n
+        events = events[:n]
+        has_prev = after is not None
+    if len(events) == 0:
+        has_prev = has_next = False
     print('Query:', query)
-    #print(dir(query))
-
-    # #print('Count:', query.count())
-    # #count_query = query.statement.with_only_columns([sa.func.count()]).order_by(None)
-    # #count = q.session.execute(count_query).scalar()
-    # count = sa.select(sa.func.count(Event.event_id))#.scalar()
-    # print('Count:', type(count), count)
-    # r = db.session.execute(count).scalar()
-    # print(type(r), r)
-    # n_events = r
-
-    page = request.args.get("page")
-    #print('page:', page)
-    try:
-        page = int(page)
-    except:
-        page = 1
-    
-    event_pager = db.paginate(query, page=page, per_page=20, error_out=False)
-    events = event_pager.items
+
+    pager = dict(total=event_count(),
+                 first=events[0].event_id if len(events) else None,
+                 last=events[-1].event_id if len(events) else None,
+                 has_prev=has_prev, has_next=has_next)
     
     fields = [ 'event_id', 'timestamp', 'rfi_grade', 'total_snr', 'dm', 'ra', 'dec', 'nbeams', 'dm_ne2001', 'dm_ymw2016', 'flux', 'fluence', 'pulse_width' ]
 
-    return render_template('event_list.html', event_pager=event_pager, events=events, fields=fields)
+    return render_template('event_list.html', event_pager=pager, events=events, fields=fields)
+
 
 
+# Number of (most recent) events in the plot
+PLOT_NEVENTS = 1000
+# Where rendered plots are kept, so that the uwsgi worker processes can share them
+PLOT_CACHE_DIR = os.environ.get('CHORD_FRB_PLOT_CACHE_DIR',
+                                os.path.join(tempfile.gettempdir(), 'chord-frb-web-plots'))
+
+class EventPlotCache(object):
+    '''
+    The events.png plot, cached by the newest event_id.  Only the events added
+    since the last render are queried -- as arrays of (event_id, timestamp,
+    dm, rfi_grade), not ORM objects -- and appended to the ones we already
+    have.  Rendered PNGs are also written to PLOT_CACHE_DIR, named by the
+    newest event_id, so each plot is only rendered once between all the
+    worker processes.
+    '''
+    def __init__(self, nevents=PLOT_NEVENTS, cache_dir=PLOT_CACHE_DIR):
+        self.nevents = nevents
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # columns: event_id, timestamp, dm, rfi_grade
+        self.events = np.zeros((0, 4))
+        self.newest_id = None
+        self.png = None
+        self.mtime = None
+
+    def filename(self, newest_id):
+        return os.path.join(self.cache_dir, 'events-%i.png' % newest_id)
+
+    def get(self, newest_id):
+        '''
+        Returns (png bytes, modification time) of the plot for the events up to
+        *newest_id*.
+        '''
+        with self.lock:
+            if newest_id == self.newest_id and self.png is not None:
+                return self.png, self.mtime
+            fn = self.filename(newest_id)
+            if os.path.exists(fn):
+                # rendered by another process
+                with open(fn, 'rb') as f:
+                    png = f.read()
+                return png, os.path.getmtime(fn)
+            self.update(newest_id)
+            self.png = self.render()
+            tmpfn = '%s.tmp-%i' % (fn, os.getpid())
+            with open(tmpfn, 'wb') as f:
+                f.write(self.png)
+            os.rename(tmpfn, fn)
+            self.mtime = os.path.getmtime(fn)
+            self.newest_id = newest_id
+            self.cleanup(keep=fn)
+            return self.png, self.mtime
+
+    def update(self, newest_id):
+        # Fetch the events after the ones we have (all of them, if events were deleted).
+        query = sa.select(Event.event_id, Event.timestamp, Event.dm, Event.rfi_grade)
+        if self.newest_id is not None and newest_id >= self.newest_id:
+            query = query.where(Event.event_id > self.newest_id)
+        else:
+            self.events = np.zeros((0, 4))
+        query = query.where(Event.event_id <= newest_id)
+        query = query.order_by(Event.event_id.desc()).limit(self.nevents)
+        rows = db.session.execute(query).all()
+        new = np.array(rows, dtype=float).reshape(-1, 4)[::-1]
+        print('Event plot: %i new events' % len(new))
+        self.events = np.vstack((self.events, new))[-self.nevents:]
+
+    def render(self):
+        from io import BytesIO
+        from matplotlib.figure import Figure
+
+        ts = self.events[:,1]
+        ok = np.isfinite(ts)
+        xx = (ts[ok] * 1e6).astype('datetime64[us]')
+        yy = self.events[ok,2]
+        cc = self.events[ok,3]
+
+        fig = Figure()
+        ax = fig.subplots()
+        scat = ax.scatter(xx, yy, c=cc, s=4, vmin=0, vmax=10, cmap='inferno')#copper')
+        ax.set_yscale('log')
+        ax.set_xlabel('Date (UTC)')
+        ax.set_ylabel('DM')
+        ax.set_facecolor('0.6')
+        cb = fig.colorbar(scat, cax=None, ax=ax)
+        cb.set_label('RFI grade')
+        buf = BytesIO()
+        fig.savefig(buf, format="png")
+        return buf.getvalue()
+
+    def cleanup(self, keep):
+        # Remove older plots from the cache directory
+        for fn in os.listdir(self.cache_dir):
+            fn = os.path.join(self.cache_dir, fn)
+            if fn != keep and fn.endswith('.png'):
+                try:
+                    if os.path.getmtime(fn) < self.mtime - 60:
+                        os.remove(fn)
+                except OSError:
+                    pass
+
+_event_plot_cache = None
 
 @app.route('/events.png')
 def event_plot():
-    from datetime import datetime
+    global _event_plot_cache
+    if _event_plot_cache is None:
+        _event_plot_cache = EventPlotCache()
+    newest_id = db.session.execute(sa.select(sa.func.max(Event.event_id))).scalar()
+    if newest_id is None:
+        newest_id = 0
+    etag = 'events-%i' % newest_id
+    # browsers must check back (with If-None-Match) each time; mostly that gets a 304,
+    # which we can answer without reading (or rendering) the plot.
+    if request.if_none_match.contains(etag):
+        resp = make_response('', 304)
+        resp.set_etag(etag)
+        resp.cache_control.no_cache = True
+        return resp
+    png, mtime = _event_plot_cache.get(newest_id)
 
-    query = sa.select(Event).order_by(Event.event_id.desc()).limit(1000)
-    print('Query:', query)
-    r = db.session.execute(query)#.scalar()
-    print('Result:', r)
-
-    xx = []
-    yy = []
-    cc = []
-
-    for e in r:
-        (e,) = e
-        #print('  event:', e)
-        d = datetime.fromtimestamp(e.timestamp)
-        print('timestamp:', e.timestamp, '-> date', d)
-        xx.append(d)
-        #xx.append(e.timestamp)
-        #xx.append(e.event_id)
-        yy.append(e.dm)
-        cc.append(e.rfi_grade)
-
-
-    from io import BytesIO
-    from matplotlib.figure import Figure
-    from mpl_toolkits.axes_grid1 import make_axes_locatable
-    
-    fig = Figure()
-    ax = fig.subplots()
-    scat = ax.scatter(xx, yy, c=cc, s=4, vmin=0, vmax=10, cmap='inferno')#copper')
-    ax.set_yscale('log')
-    ax.set_xlabel('Date')
-    ax.set_ylabel('DM')
-    ax.set_facecolor('0.6')
-    #divider = make_axes_locatable(0)
-    #cax = divider.append_axes('right', size='5%', pad=0.05)
-    #fig.colorbar(scat, cax=cax, orientation='vertical')
-    cb = fig.colorbar(scat, cax=None, ax=ax)
-    cb.set_label('RFI grade')
-    buf = BytesIO()
-    fig.savefig(buf, format="png")
-    #buf = buf.getbuffer()
-    buf = buf.getvalue()
-
-    resp = make_response(buf)
+    resp = make_response(png)
     resp.headers['Content-type'] = 'image/png'
-    return resp
+    resp.set_etag(etag)
+    resp.last_modified = datetime.fromtimestamp(mtime, tz=timezone.utc)
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+@app.route('/export/<table>.<fmt>')
+def export(table, fmt):
+    # Streaming exports: eg /export/events.csv?t0=1736000000&dm_min=100&is_rfi=0
+    # See chord_frb_db/export.py for the filters.
+    from chord_frb_db.export import export_query, export_stream, EXPORT_FORMATS
+    try:
+        query = export_query(table, request.args)
+        chunk_size = int(request.args.get('chunk', 10000))
+        data = export_stream(db.engine, query, fmt, chunk_size=chunk_size)
+    except ValueError as e:
+        return make_response('Bad request: %s\n' % e, 400)
+    except ImportError:
+        return make_response('Format %s needs pyarrow, which is not installed\n' % fmt, 501)
+    mimetype, ext = EXPORT_FORMATS[fmt]
+    return Response(data, mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename="%s.%s"' % (table, ext)})
 
 #if __name__ == '__main__':
     
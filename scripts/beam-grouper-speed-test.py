@@ -0,0 +1,170 @@
+'''
+Speed test for BeamGrouper clustering, at 10^3 to 10^6 L1 events per chunk.
+
+Events are simulated over a CHIME-like 4 x 256 beam grid in one 10-second
+chunk; a fraction of them (--rfi) are packed into a low-DM, short-time "RFI
+storm", which is when the grouper falls behind.
+
+Both grouping engines ("kdtree" and "sweep") are timed, and their groups are
+checked against each other.  The original clustering (query_ball_tree
+neighbour lists plus a set-based walk) is also included for comparison.  It
+is only run up to --max-old events, since it gets very slow (and
+memory-hungry) in storms.
+
+With --nprocs N, the kdtree engine is also timed sharded across N worker
+processes by beam-grid region (BeamGrouper's nprocs option).
+
+With --fits, the engines are instead compared on each chunk of the given
+CHIME replay files (events/events-*.fits, as used by load-chime-events.py).
+
+    python scripts/beam-grouper-speed-test.py
+    python scripts/beam-grouper-speed-test.py --rfi 0.9 --max-old 100000
+    python scripts/beam-grouper-speed-test.py --nprocs 8
+    python scripts/beam-grouper-speed-test.py --fits events/events-00*.fits
+'''
+import sys
+import time
+import argparse
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from chord_frb_sifter.events import empty_l1_batch, as_l1_batch
+from chord_frb_sifter.actors.beam_grouper import BeamGrouper
+
+def make_chunk_events(n, rfi_fraction=0.5, seed=42):
+    rng = np.random.RandomState(seed)
+    events = empty_l1_batch(n)
+    x = rng.randint(0, 4, size=n)
+    y = rng.randint(0, 256, size=n)
+    events['beam'] = x * 1000 + y
+    events['beam_grid_x'] = x
+    events['beam_grid_y'] = y
+    # micro-seconds within a 10-second chunk
+    events['timestamp_utc'] = rng.uniform(0, 10e6, size=n)
+    events['dm'] = rng.uniform(0, 3000, size=n)
+    events['snr'] = rng.uniform(7, 20, size=n)
+    # RFI storm: low DM, within one second
+    nrfi = int(n * rfi_fraction)
+    events['timestamp_utc'][:nrfi] = rng.uniform(3e6, 4e6, size=nrfi)
+    events['dm'][:nrfi] = rng.uniform(0, 50, size=nrfi)
+    return events
+
+def old_cluster(grouper, events):
+    # The original BeamGrouper._cluster, returning group labels.
+    tdmxy = np.empty((len(events), 4), np.float32)
+    times = events['timestamp_utc']
+    tdmxy[:, 0] = (times - times.min()) / 1e3
+    tdmxy[:, 1] = events['dm']
+    tdmxy[:, 2] = events['beam_grid_x']
+    tdmxy[:, 3] = events['beam_grid_y']
+    tdmxy /= grouper.thresholds
+    tree = cKDTree(tdmxy)
+    neighbors = tree.query_ball_tree(tree, r=1.0, p=np.inf)
+    labels = np.zeros(len(events), int)
+    ngroups = 0
+    visiting = []
+    undiscovered = set(range(len(events)))
+    while undiscovered:
+        root = undiscovered.pop()
+        visiting.append(root)
+        while visiting:
+            event = visiting.pop()
+            labels[event] = ngroups
+            for new in set(neighbors[event]).intersection(undiscovered):
+                undiscovered.remove(new)
+                visiting.append(new)
+        ngroups += 1
+    return ngroups, labels
+
+def same_partition(labels_a, labels_b):
+    # Two labellings describe the same groups iff the (a,b) label pairs are one-to-one.
+    pairs = np.unique(np.vstack((labels_a, labels_b)), axis=1)
+    return (len(np.unique(pairs[0])) == pairs.shape[1] and
+            len(np.unique(pairs[1])) == pairs.shape[1])
+
+def read_fits_chunks(fn):
+    # Read a CHIME replay file and split it into chunks (see load-chime-events.py).
+    import fitsio
+    events = as_l1_batch(fitsio.read(fn), rename={'fpga': 'chunk_fpga'})
+    # ASSUME 2.56 microseconds per FPGA sample
+    events['timestamp_utc'] = events['frame0_nano']/1000. + events['timestamp_fpga'] * 2.56
+    events['beam_grid_x'] = events['beam'] // 1000
+    events['beam_grid_y'] = events['beam'] % 1000
+    for chunk in np.unique(events['chunk_fpga']):
+        yield chunk, events[events['chunk_fpga'] == chunk]
+
+def compare_fits(fns, engines):
+    for fn in fns:
+        for chunk,events in read_fits_chunks(fn):
+            labels = []
+            for grouper in engines.values():
+                _, lab = grouper._cluster(events)
+                labels.append(lab)
+            same = all([same_partition(labels[0], lab) for lab in labels[1:]])
+            print('%s chunk %i: %i events, %i groups: %s' %
+                  (fn, chunk, len(events), len(np.unique(labels[0])),
+                   'same' if same else 'DIFFERENT'))
+            if not same:
+                sys.exit(-1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rfi', type=float, default=0.5,
+                        help='Fraction of events in the RFI storm')
+    parser.add_argument('--max-old', type=int, default=30000,
+                        help='Largest number of events to run the old clustering on')
+    parser.add_argument('--sizes', type=int, nargs='*',
+                        default=[1000, 3000, 10000, 30000, 100000, 300000, 1000000])
+    parser.add_argument('--nprocs', type=int, default=1,
+                        help='Also time the kdtree engine sharded across this many processes')
+    parser.add_argument('--fits', nargs='*', help='Compare engines on CHIME replay files')
+    opt = parser.parse_args()
+
+    # Thresholds from drao_epsilon_pipeline_local.yaml
+    engines = dict([(engine, BeamGrouper(t_thr=64., dm_thr=3.5, ra_thr=3.1, dec_thr=2.1,
+                                         engine=engine))
+                    for engine in ['kdtree', 'sweep']])
+    if opt.nprocs > 1:
+        engines['sharded'] = BeamGrouper(t_thr=64., dm_thr=3.5, ra_thr=3.1, dec_thr=2.1,
+                                         nprocs=opt.nprocs, shard_min_events=0)
+        # start up the worker processes before timing, with shared memory big enough for
+        # the largest chunk (coordinates are 16 bytes per event), so they aren't restarted
+        engines['sharded']._start_pool(16 * max(opt.sizes))
+        engines['sharded']._cluster(make_chunk_events(1000))
+
+    if opt.fits:
+        compare_fits(opt.fits, engines)
+        return
+
+    print('%10s %10s %12s %12s %12s %12s' % ('events', 'groups', 'kdtree (sec)', 'sweep (sec)',
+                                             'sharded (sec)', 'old (sec)'))
+    for n in opt.sizes:
+        events = make_chunk_events(n, rfi_fraction=opt.rfi)
+        times = {}
+        labels = {}
+        for name,grouper in engines.items():
+            t0 = time.perf_counter()
+            ngroups, labels[name] = grouper._cluster(events)
+            times[name] = time.perf_counter() - t0
+        for name in labels.keys():
+            if not same_partition(labels['kdtree'], labels[name]):
+                print('Groups differ between the kdtree and %s engines for %i events!' %
+                      (name, n))
+                sys.exit(-1)
+        t_old = np.nan
+        if n <= opt.max_old:
+            t0 = time.perf_counter()
+            _, old_labels = old_cluster(engines['kdtree'], events)
+            t_old = time.perf_counter() - t0
+            if not same_partition(labels['kdtree'], old_labels):
+                print('Groups differ from the old clustering for %i events!' % n)
+                sys.exit(-1)
+        print('%10i %10i %12.3f %12.3f %12.3f %12.3f' % (n, ngroups, times['kdtree'],
+                                                         times['sweep'],
+                                                         times.get('sharded', np.nan), t_old))
+    if 'sharded' in engines:
+        engines['sharded'].close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+'''
+Reports the fraction of beams live (the exposure) over a range of UTC dates,
+from the daily liveness files written by the FRB Sifter server (see
+chord_frb_sifter/liveness.py).
+
+    python scripts/beam-liveness.py --dir liveness --start 2025-01-01 --end 2025-04-01
+    python scripts/beam-liveness.py --dir liveness --start 2025-01-01 --end 2025-01-02 --per-hour
+'''
+import argparse
+from datetime import datetime, timezone
+
+import numpy as np
+
+from chord_frb_sifter.liveness import LivenessMap
+
+def parse_date(s):
+    return datetime.fromisoformat(s).replace(tzinfo=timezone.utc).timestamp()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='liveness', help='Directory of liveness files')
+    parser.add_argument('--start', required=True, help='UTC start date/time (ISO format)')
+    parser.add_argument('--end', required=True, help='UTC end date/time (ISO format)')
+    parser.add_argument('--max-beam-sets', type=int, default=1024)
+    parser.add_argument('--n-beam-sets', type=int, default=None,
+                        help='Number of beam sets in the system (default: --max-beam-sets)')
+    parser.add_argument('--per-hour', action='store_true', help='Also print hourly fractions')
+    opt = parser.parse_args()
+
+    liveness = LivenessMap(opt.dir, max_beam_sets=opt.max_beam_sets)
+    t0 = parse_date(opt.start)
+    t1 = parse_date(opt.end)
+    n_beam_sets = opt.n_beam_sets or opt.max_beam_sets
+    times, nlive = liveness.live_counts(t0, t1)
+    if opt.per_hour:
+        hours = np.floor((times - t0) / 3600.).astype(int)
+        nchunks = np.bincount(hours)
+        live = np.bincount(hours, weights=nlive)
+        for h in range(len(nchunks)):
+            if nchunks[h] == 0:
+                continue
+            t = datetime.fromtimestamp(t0 + h * 3600., tz=timezone.utc)
+            print('%s  %.4f' % (t.strftime('%Y-%m-%d %H:%M'), live[h] / (nchunks[h] * n_beam_sets)))
+    frac = np.sum(nlive) / (float(n_beam_sets) * max(len(times), 1))
+    print('Fraction of beams live from %s to %s: %.4f (%i chunks)' %
+          (opt.start, opt.end, frac, len(times)))
+
+if __name__ == '__main__':
+    main()
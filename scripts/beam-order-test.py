@@ -0,0 +1,155 @@
+'''
+Checks that the BeamBuffer outputs chunks in chunk order when their events
+arrive out of order, and that the BeamGrouper (with merge_across_chunks)
+finds the same groups whatever order the chunks arrive in.
+
+    python scripts/beam-order-test.py
+'''
+import numpy as np
+
+from chord_frb_sifter.events import empty_l1_batch
+from chord_frb_sifter.actors.beam_buffer import BeamBuffer
+from chord_frb_sifter.actors.beam_grouper import BeamGrouper
+
+CHUNK = 10e6
+
+def make_events(chunk, beams, t=None):
+    events = empty_l1_batch(len(beams))
+    events['chunk_utc'] = chunk
+    events['beam'] = beams
+    events['beam_grid_x'] = np.array(beams) // 1000
+    events['beam_grid_y'] = np.array(beams) % 1000
+    events['timestamp_utc'] = chunk + 1e6 if t is None else t
+    events['dm'] = 100.
+    events['snr'] = 10.
+    return events
+
+def batch_chunks(batches):
+    # The chunk of each output batch (which must be from a single chunk)
+    chunks = []
+    for b in batches:
+        c = np.unique(b['chunk_utc'])
+        assert len(c) == 1, 'batch with events from chunks %s' % c
+        chunks.append(int(c[0]))
+    return chunks
+
+def test_buffer_order():
+    bb = BeamBuffer(flush_timeout=0., max_open_chunks=3)
+    out = []
+    out += bb.perform_action(make_events(0, [1, 2]))
+    # chunk 10e6 is missing beam 2 ... while chunk 20e6 is complete
+    out += bb.perform_action(make_events(10e6, [1]))
+    assert batch_chunks(out) == [0], batch_chunks(out)
+    out += bb.perform_action(make_events(20e6, [1, 2]))
+    # ... but has to wait until chunk 10e6 times out.
+    assert batch_chunks(out) == [0], batch_chunks(out)
+    out += bb.perform_update()
+    assert batch_chunks(out) == [0, 10e6, 20e6], batch_chunks(out)
+    print('BeamBuffer: chunks output in order:', batch_chunks(out))
+
+def test_buffer_late_merge():
+    # chunk 20e6 is held behind chunk 10e6 ... which completes, flushing both; then
+    # late events for chunk 20e6 in the same batch are merged into its batch.
+    bb = BeamBuffer(flush_timeout=None, max_open_chunks=3)
+    bb.perform_action(make_events(0, [1, 2]))
+    bb.perform_action(make_events(10e6, [1]))
+    bb.perform_action(make_events(20e6, [1, 2]))
+    batch = np.concatenate([make_events(10e6, [2]), make_events(20e6, [3])])
+    out = bb.perform_action(batch)
+    assert batch_chunks(out) == [10e6, 20e6], batch_chunks(out)
+    assert [len(b) for b in out] == [2, 3], [len(b) for b in out]
+    print('BeamBuffer: late events merged only into their own chunk')
+
+def make_grouper(**kwargs):
+    kwargs.setdefault('chunk_seconds', CHUNK / 1e6)
+    return BeamGrouper(t_thr=64., dm_thr=3.5, ra_thr=3.1, dec_thr=2.1,
+                       merge_across_chunks=True, **kwargs)
+
+def run_grouper(grouper, batches):
+    # Returns the groups found, as a set of frozensets of (unique) beam numbers
+    out = []
+    for b in batches:
+        out += grouper.perform_action(b)
+    out += grouper.perform_flush()
+    groups = set()
+    for l2 in out:
+        for i in range(len(l2)):
+            groups.add(frozenset(l2.group_l1_events(i)['beam'].tolist()))
+    return groups
+
+def grouper_events(times):
+    # One event per timestamp, each with its own beam number, all at the same DM and
+    # position (so only the times matter).
+    events = empty_l1_batch(len(times))
+    times = np.array(times, float)
+    events['timestamp_utc'] = times
+    events['chunk_utc'] = np.floor(times / CHUNK) * CHUNK
+    events['beam'] = np.arange(len(times))
+    events['dm'] = 100.
+    events['snr'] = 10.
+    return events
+
+def split_chunks(events):
+    chunks = np.unique(events['chunk_utc'])
+    return [events[events['chunk_utc'] == c] for c in chunks]
+
+def test_grouper_late_chunk():
+    # Groups straddling the chunk 0 / chunk 1 boundary: chunk 1 arrives first.
+    events = grouper_events([9.99e6, 10.00e6, 19.99e6])
+    chunk0, chunk1 = split_chunks(events)
+    # (with the chunk length given, or inferred)
+    for secs in [CHUNK / 1e6, None]:
+        in_order = run_grouper(make_grouper(chunk_seconds=secs), [chunk0, chunk1])
+        out_of_order = run_grouper(make_grouper(chunk_seconds=secs), [chunk1, chunk0])
+        assert len(in_order) == 2, in_order
+        assert out_of_order == in_order, (out_of_order, in_order)
+    print('BeamGrouper: late chunk merged:', sorted(sorted(g) for g in out_of_order))
+
+def test_grouper_shuffled(nchunks=8, nevents=400, seed=42):
+    # Random events, many of them near chunk boundaries; the chunks are delivered in a
+    # shuffled order, but never more than max_chunk_lag-1 chunks late.  The groups must
+    # match those of clustering all the events at once.
+    rng = np.random.RandomState(seed)
+    bounds = rng.randint(1, nchunks, size=nevents) * CHUNK
+    times = np.where(rng.uniform(size=nevents) < 0.5,
+                     bounds + rng.normal(scale=100e3, size=nevents),
+                     rng.uniform(0, nchunks * CHUNK, size=nevents))
+    events = grouper_events(np.clip(times, 0, nchunks * CHUNK - 1))
+    g = make_grouper()
+    ngroups, labels = g._cluster(events)
+    expected = set(frozenset(events['beam'][labels == i].tolist()) for i in range(ngroups))
+    chunks = split_chunks(events)
+    for trial in range(20):
+        # swap some (non-overlapping) pairs of neighbouring chunks
+        order = list(range(len(chunks)))
+        i = 0
+        while i < len(order) - 1:
+            if rng.uniform() < 0.5:
+                order[i], order[i+1] = order[i+1], order[i]
+                i += 1
+            i += 1
+        for maxlag in [2, 3]:
+            g = make_grouper(max_chunk_lag=maxlag)
+            groups = run_grouper(g, [chunks[i] for i in order])
+            assert groups == expected, (order, len(groups), len(expected))
+            assert g.n_late_unmerged == 0
+    print('BeamGrouper: shuffled chunks give the same %i groups' % len(expected))
+
+def test_grouper_too_late():
+    # A chunk arriving more than max_chunk_lag chunks late can't be merged; its events are
+    # counted.
+    events = grouper_events([9.99e6, 10.00e6, 25e6, 35e6])
+    chunks = split_chunks(events)
+    g = make_grouper(max_chunk_lag=2)
+    groups = run_grouper(g, chunks[1:] + chunks[:1])
+    assert len(groups) == 4, groups
+    assert g.n_late_unmerged == 1, g.n_late_unmerged
+    print('BeamGrouper: too-late chunk counted:', g.n_late_unmerged)
+
+if __name__ == '__main__':
+    test_buffer_order()
+    test_buffer_late_merge()
+    test_grouper_late_chunk()
+    test_grouper_shuffled()
+    test_grouper_too_late()
+    print('All OK')
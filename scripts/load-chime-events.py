@@ -11,6 +11,7 @@ from copy import deepcopy
 from frb_common.events.l1_event.dtypes import L1_EVENT_DTYPE
 
 from chord_frb_db.utils import get_db_engine
+from chord_frb_sifter.events import as_l1_batch
 
 def read_fits_events(fn):
     from frb_common.events import L1Event
@@ -44,9 +45,6 @@ def send_to_db(session, outputs):
     # spectral_index
     # scattering_measure
     # level1_nhits
-    # snr_vs_dm
-    # snr_vs_tree_index
-    # snr_vs_spectral_index
     # is_incoherent
     # snr_vs_dm_x
     # snr_vs_tree_index_x
@@ -67,6 +65,9 @@ def send_to_db(session, outputs):
         'pos_ra_error_deg': 'ra_error',
         'pos_dec_deg': 'dec',
         'pos_dec_error_deg': 'dec_error',
+        'snr_vs_dm': True,
+        'snr_vs_tree_index': True,
+        'snr_vs_spectral_index': True,
     }
 
     # Not setting:
@@ -346,14 +347,19 @@ def setup():
 # Start creating a parallel version of the pipeline, porting stuff over while
 # simplifying!
 
-def simple_create_pipeline():
+def simple_create_pipeline(output):
+    '''
+    Returns a Pipeline (not yet started) whose output L2 event batches are
+    passed to *output* (eg, WriteBehindWriter.put).
+    '''
     from frb_common import pipeline_tools
 
+    from chord_frb_sifter.pipeline import Pipeline
     from chord_frb_sifter.actors.beam_buffer import BeamBuffer
     from chord_frb_sifter.actors.beam_grouper import BeamGrouper
     from chord_frb_sifter.actors.simple_localizer import SimpleLocalizer
 
-    pipeline = []
+    pipeline = Pipeline(output=output)
     for name,clz in [('BeamBuffer', BeamBuffer),
                      ('BeamGrouper', BeamGrouper),
                      # ('EventMaker', EventMaker),
@@ -371,30 +377,10 @@ def simple_create_pipeline():
         conf.pop('timeout')
         conf.pop('periodic_update')
         p = clz(**conf)
-        pipeline.append(p)
+        pipeline.add_stage(name, p)
     return pipeline
 
 #def simple_process_events(pipeline, fpga, beam, events):
-def simple_process_events(pipeline, events):
-    #print('events:', type(events), events)
-
-    input_events = [events]
-    output_events = []
-    for actor in pipeline:
-        output_events = []
-        for in_item in input_events:
-            items = actor.perform_action(in_item)
-            if items is None:
-                continue
-            for item in items:
-                if item is None:
-                    continue
-                output_events.append(item)
-        if len(output_events) == 0:
-            break
-        input_events = output_events
-
-    return output_events
     # Event keys: dict_keys(['beam_no', 'timestamp_utc', 'timestamp_fpga',
     # 'tree_index', 'snr', 'snr_scale', 'dm', 'spectral_index',
     # 'scattering_measure', 'level1_nhits', 'rfi_grade_level1',
@@ -468,10 +454,17 @@ def chime_beam_numbers_to_dra_ddec(beams):
     return dra,ddec
 
     
-def simple_process_events_file(engine, pipeline, fn,
-                               beam_to_dradec={}, beam_to_xygrid={}):
-    from sqlalchemy.orm import Session
+def simple_process_events_file(pipeline, fn):
     fpgas,beams,events = simple_read_fits_events(fn)
+
+    # beam positions (vectorized over the whole batch)
+    gx,gy = chime_beam_numbers_to_sky_grid(beams)
+    events['beam_grid_x'] = gx
+    events['beam_grid_y'] = gy
+    dr,dd = chime_beam_numbers_to_dra_ddec(beams)
+    events['beam_dra'] = dr
+    events['beam_ddec'] = dd
+
     u_fpgas = np.unique(fpgas)
     for fpga in u_fpgas:
         I = np.flatnonzero(fpgas == fpga)
@@ -482,63 +475,30 @@ def simple_process_events_file(engine, pipeline, fn,
             # Events for this FPGA chunk and beam number
             J = np.flatnonzero(b == beam)
             K = I[J]
-            beam_events = [events[k] for k in K]
-
-            gx,gy = beam_to_xygrid[beam]
-            for e in beam_events:
-                e['beam_grid_x'] = gx
-                e['beam_grid_y'] = gy
-            dr,dd = beam_to_dradec[beam]
-            for e in beam_events:
-                e['beam_dra'] = dr
-                e['beam_ddec'] = dd
-
-            #print('beam_events:', beam_events)
-
-            outputs = simple_process_events(pipeline, beam_events)
-                                            
-
-            if outputs is None:
-                print('Pipeline outputs:', outputs)
-            else:
-                print('Pipeline outputs:', len(outputs))
-            # if len(outputs):
-            #     # transaction block -- automatic commit on exit
-            #     with Session(engine) as session:
-            #         payloads = send_to_db(session, outputs)
+            beam_events = events[K]
+
+            # Blocks if the pipeline (or the database writer) is behind.
+            pipeline.put(beam_events)
+        print('Pipeline queues:', pipeline.queue_sizes())
 
 def simple_read_fits_events(fn):
     events = fitsio.read(fn)
     print('Events file', fn, 'contains', len(events), 'events')
     beams = events['beam']
     fpgas = events['fpga']
-    frame0nano = events['frame0_nano']
-    eventlist = [{} for i in range(len(events))]
-    for k in events.dtype.names:
-        # output field name
-        k_out = k
-        # data vector for this column
-        v = events[k]
-
-        if k == 'beam_no':
-            # duplicate of "beam", but in float for some reason
-            continue
-        if k == 'fpga':
-            # rename!  This is the FPGAcount for the time chunk of data
-            k_out = 'chunk_fpga'
+    # Copy the columns into an L1 batch.
+    # "beam_no" is a duplicate of "beam" (in float for some reason) -- dropped.
+    # "fpga" is the FPGAcount for the time chunk of data -- rename!
+    batch = as_l1_batch(events, rename={'fpga': 'chunk_fpga'})
 
-        for i in range(len(events)):
-            eventlist[i][k_out] = v[i]
-
-    for e in eventlist:
-        # compute timestamp_fpga to timestamp_utc (in micro-seconds)
-        # ASSUME 2.56 microseconds per FPGA sample
-        e['timestamp_utc'] = e['frame0_nano']/1000. + e['timestamp_fpga'] * 2.56
-        # For completeness, also compute the chunk timestamp in UTC.
-        e['chunk_utc'] = e['frame0_nano']/1000. + e['chunk_fpga'] * 2.56
+    # compute timestamp_fpga to timestamp_utc (in micro-seconds)
+    # ASSUME 2.56 microseconds per FPGA sample
+    batch['timestamp_utc'] = batch['frame0_nano']/1000. + batch['timestamp_fpga'] * 2.56
+    # For completeness, also compute the chunk timestamp in UTC.
+    batch['chunk_utc'] = batch['frame0_nano']/1000. + batch['chunk_fpga'] * 2.56
 
-    print('Event keys:', eventlist[0].keys())
-    return fpgas,beams,eventlist
+    print('Event fields:', batch.dtype.names)
+    return fpgas,beams,batch
 
 if __name__ == '__main__':
     '''
@@ -644,20 +604,25 @@ if __name__ == '__main__':
 
     #pipeline = create_pipeline()
 
-    simple_pipeline = simple_create_pipeline()
+    from chord_frb_db.write_behind import WriteBehindWriter
+    # Writes to the database from a separate thread, so we don't wait for commits.
+    writer = WriteBehindWriter(engine)
+    writer.start()
 
-    beams = np.hstack([np.arange(256) + i*1000 for i in range(4)])
-    dra,ddec = chime_beam_numbers_to_dra_ddec(beams)
-    beam_to_dradec = dict([(k,(v1,v2)) for k,v1,v2 in zip(beams, dra, ddec)])
-    xg,yg = chime_beam_numbers_to_sky_grid(beams)
-    beam_to_xygrid = dict([(k,(v1,v2)) for k,v1,v2 in zip(beams, xg, yg)])
+    simple_pipeline = simple_create_pipeline(writer.put)
+    simple_pipeline.start()
 
     for file_num in range(3):
         fn = 'events/events-%03i.fits' % file_num
         #process_events_file(engine, pipeline, fn)
 
         # print('<<< simple >>>')
-        simple_process_events_file(engine, simple_pipeline, fn,
-                                   beam_to_dradec=beam_to_dradec,
-                                   beam_to_xygrid=beam_to_xygrid)
+        simple_process_events_file(simple_pipeline, fn)
         # print('<<< /simple >>>')
+
+    # Drains the queues, and flushes the last chunk(s) and the groups BeamGrouper is holding
+    # for the next chunk into the writer.
+    simple_pipeline.stop()
+    print('Pipeline:', simple_pipeline.stats())
+    writer.stop()
+    print('Database writer:', writer.stats())
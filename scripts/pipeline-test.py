@@ -0,0 +1,178 @@
+'''
+Checks the threaded Pipeline (chord_frb_sifter/pipeline.py) running
+BeamBuffer -> BeamGrouper -> SimpleLocalizer: that all the L1 events come
+out, that the queues stay bounded behind a slow sink, that stop() flushes
+what the actors are holding (and that BeamBuffer's timeout works without it),
+and that errors are counted.
+
+    python scripts/pipeline-test.py
+'''
+import time
+import threading
+
+import numpy as np
+
+from chord_frb_sifter.events import empty_l1_batch
+from chord_frb_sifter.pipeline import Pipeline
+from chord_frb_sifter.actors.beam_buffer import BeamBuffer
+from chord_frb_sifter.actors.beam_grouper import BeamGrouper
+from chord_frb_sifter.actors.simple_localizer import SimpleLocalizer
+
+CHUNK = 10e6
+NBEAMS = 8
+
+def make_events(chunk, beams):
+    # One event per beam, spread over the chunk (well apart in time, so each is its own
+    # group and every L1 event is kept in the L2 events).
+    beams = np.array(beams)
+    events = empty_l1_batch(len(beams))
+    events['chunk_utc'] = chunk
+    events['beam'] = beams
+    events['beam_grid_x'] = beams // 1000
+    events['beam_grid_y'] = beams % 1000
+    events['timestamp_utc'] = chunk + 1e6 * (beams + 1)
+    events['dm'] = 100.
+    events['snr'] = 10.
+    return events
+
+def make_pipeline(output, flush_timeout=None, **kwargs):
+    pipeline = Pipeline(output=output, **kwargs)
+    pipeline.add_stage('BeamBuffer', BeamBuffer(flush_timeout=flush_timeout))
+    pipeline.add_stage('BeamGrouper', BeamGrouper(t_thr=64., dm_thr=3.5, ra_thr=3.1, dec_thr=2.1,
+                                                  merge_across_chunks=True,
+                                                  chunk_seconds=CHUNK / 1e6))
+    pipeline.add_stage('Localizer', SimpleLocalizer())
+    return pipeline
+
+def feed(pipeline, nchunks):
+    # Each chunk arrives in two halves (eg, from two FRB Search nodes); returns the
+    # number of L1 events sent.
+    n = 0
+    for c in range(nchunks):
+        for beams in [range(0, NBEAMS, 2), range(1, NBEAMS, 2)]:
+            events = make_events(c * CHUNK, list(beams))
+            pipeline.put(events)
+            n += len(events)
+    return n
+
+def n_l1(batches):
+    return sum(len(b.l1_events) for b in batches)
+
+def wait_idle(pipeline, nput):
+    # Waits until the first stage has taken all the items and all the queues are empty.
+    for i in range(200):
+        stats = pipeline.stats()
+        if (stats['BeamBuffer']['items'] == nput and
+            all(s['queued'] == 0 for s in stats.values())):
+            break
+        time.sleep(0.05)
+    # (the last items may still be being processed)
+    time.sleep(0.2)
+
+def test_events_conserved():
+    out = []
+    pipeline = make_pipeline(out.append, queue_size=4, update_period=0.05)
+    pipeline.start()
+    nin = feed(pipeline, 6)
+    pipeline.stop()
+    nout = n_l1(out)
+    assert nout == nin, (nout, nin)
+    chunks = [int(c) for b in out for c in np.unique(b.l1_events['chunk_utc'])]
+    assert chunks == sorted(chunks), chunks
+    print('Pipeline: %i L1 events in, %i out, in %i L2 batches' % (nin, nout, len(out)))
+
+def test_bounded_queues(queue_size=2):
+    # A slow sink (eg, a database) -- the queues must not grow past queue_size; instead,
+    # put() blocks.
+    out = []
+    def slow_sink(batch):
+        time.sleep(0.05)
+        out.append(batch)
+    pipeline = make_pipeline(slow_sink, queue_size=queue_size, update_period=0.05)
+    pipeline.start()
+    maxq = {}
+    done = threading.Event()
+    def watch():
+        while not done.is_set():
+            for name,n in pipeline.queue_sizes().items():
+                maxq[name] = max(maxq.get(name, 0), n)
+            time.sleep(0.001)
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    t0 = time.time()
+    nin = feed(pipeline, 20)
+    tfeed = time.time() - t0
+    pipeline.stop()
+    done.set()
+    watcher.join()
+    assert all(n <= queue_size for n in maxq.values()), maxq
+    # put() was held back by the sink: 20 chunks at 0.05 s each, less what's in the queues
+    assert tfeed > 0.05 * (20 - 3 * (queue_size + 2)), tfeed
+    assert n_l1(out) == nin, (n_l1(out), nin)
+    print('Pipeline: max queue sizes behind a slow sink:', maxq, 'feeding took %.2f s' % tfeed)
+
+def test_stop_drains():
+    # Without a timeout, BeamBuffer holds a chunk that is missing beams, and BeamGrouper
+    # holds the groups at the end of the chunk before; stop(drain=True) flushes them.
+    out = []
+    pipeline = make_pipeline(out.append, update_period=0.05)
+    pipeline.start()
+    nin = feed(pipeline, 3)
+    partial = make_events(3 * CHUNK, list(range(0, NBEAMS, 2)))
+    pipeline.put(partial)
+    nin += len(partial)
+    wait_idle(pipeline, 7)
+    nbefore = n_l1(out)
+    assert nbefore <= nin - len(partial) - 1, (nbefore, nin)
+    pipeline.stop(drain=True)
+    assert n_l1(out) == nin, (n_l1(out), nin)
+    print('Pipeline: %i of %i L1 events held until stop()' % (nin - nbefore, nin))
+
+def test_timeout_flush():
+    # The Pipeline calls perform_update() every update_period, so BeamBuffer's
+    # flush_timeout passes on a chunk that is missing beams without waiting for stop().
+    out = []
+    pipeline = make_pipeline(out.append, flush_timeout=0.2, update_period=0.05)
+    pipeline.start()
+    nin = feed(pipeline, 2)
+    partial = make_events(2 * CHUNK, list(range(0, NBEAMS, 2)))
+    pipeline.put(partial)
+    nin += len(partial)
+    for i in range(100):
+        if 2 * CHUNK in [c for b in out for c in b.l1_events['chunk_utc']]:
+            break
+        time.sleep(0.05)
+    bb = pipeline.stages[0].actors[0]
+    assert bb.n_timeout_flushes == 1, bb.n_timeout_flushes
+    # (BeamGrouper still holds the last events of the chunk)
+    nbefore = n_l1(out)
+    pipeline.stop()
+    assert nin - NBEAMS // 2 <= nbefore < nin, (nbefore, nin)
+    assert n_l1(out) == nin, (n_l1(out), nin)
+    print('Pipeline: chunk with missing beams flushed after the timeout')
+
+def test_errors_counted():
+    out = []
+    def picky(item):
+        if item % 3 == 0:
+            raise ValueError('I do not like %i' % item)
+        return [item]
+    pipeline = Pipeline(output=out.append, update_period=0.05)
+    pipeline.add_stage('Picky', picky)
+    pipeline.start()
+    for i in range(10):
+        pipeline.put(i)
+    pipeline.stop()
+    stats = pipeline.stats()
+    assert stats['Picky']['errors'] == 4, stats
+    assert stats['Picky']['items'] == 6, stats
+    assert out == [1, 2, 4, 5, 7, 8], out
+    print('Pipeline: errors counted:', stats)
+
+if __name__ == '__main__':
+    test_events_conserved()
+    test_bounded_queues()
+    test_stop_drains()
+    test_timeout_flush()
+    test_errors_counted()
+    print('All OK')
@@ -0,0 +1,102 @@
+'''
+Throughput benchmark: sending L1 event batches to another process by
+pickling them through a multiprocessing.Queue, versus copying them into a
+ShmRing (chord_frb_sifter/shm_transport.py) and sending only descriptors.
+
+The receiver touches every event (sums the S/N) so that neither method can
+skip reading the data.
+
+    python scripts/shm-transport-benchmark.py
+    python scripts/shm-transport-benchmark.py --sizes 1000 100000 --nbatches 200
+'''
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from chord_frb_sifter.events import empty_l1_batch
+from chord_frb_sifter.shm_transport import ShmRing
+
+def pickle_receiver(q, results):
+    results.put('ready')
+    total = 0.
+    while True:
+        events = q.get()
+        if events is None:
+            break
+        total += events['snr'].sum()
+    results.put(total)
+
+def shm_receiver(ring, q, results):
+    results.put('ready')
+    total = 0.
+    while True:
+        desc = q.get()
+        if desc is None:
+            break
+        events = ring.get(desc)
+        total += events['snr'].sum()
+        del events
+        ring.release(desc)
+    ring.close()
+    results.put(total)
+
+def run_pickle(ctx, events, nbatches):
+    q = ctx.Queue(maxsize=8)
+    results = ctx.Queue()
+    p = ctx.Process(target=pickle_receiver, args=(q, results))
+    p.start()
+    # don't time the process start-up
+    results.get()
+    t0 = time.perf_counter()
+    for i in range(nbatches):
+        q.put(events)
+    q.put(None)
+    total = results.get()
+    dt = time.perf_counter() - t0
+    p.join()
+    return dt, total
+
+def run_shm(ctx, events, nbatches, nslots):
+    ring = ShmRing(nslots, events.nbytes, lock=ctx.Lock())
+    q = ctx.Queue(maxsize=8)
+    results = ctx.Queue()
+    p = ctx.Process(target=shm_receiver, args=(ring, q, results))
+    p.start()
+    # don't time the process start-up
+    results.get()
+    t0 = time.perf_counter()
+    for i in range(nbatches):
+        q.put(ring.put(events))
+    q.put(None)
+    total = results.get()
+    dt = time.perf_counter() - t0
+    p.join()
+    ring.unlink()
+    return dt, total
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='*', default=[100, 1000, 10000, 100000],
+                        help='Events per batch')
+    parser.add_argument('--nbatches', type=int, default=100)
+    parser.add_argument('--nslots', type=int, default=8, help='ShmRing slots')
+    parser.add_argument('--start-method', default='spawn')
+    opt = parser.parse_args()
+
+    ctx = multiprocessing.get_context(opt.start_method)
+    print('%10s %10s %16s %16s %8s' % ('events', 'MB/batch', 'pickle (ev/sec)',
+                                       'shm (ev/sec)', 'speedup'))
+    for n in opt.sizes:
+        events = empty_l1_batch(n)
+        events['snr'] = np.random.RandomState(n).uniform(7, 20, size=n)
+        dt_pickle, tot_pickle = run_pickle(ctx, events, opt.nbatches)
+        dt_shm, tot_shm = run_shm(ctx, events, opt.nbatches, opt.nslots)
+        assert(np.isclose(tot_pickle, tot_shm))
+        nev = n * opt.nbatches
+        print('%10i %10.2f %16.3g %16.3g %8.2f' % (n, events.nbytes / 1e6, nev / dt_pickle,
+                                                   nev / dt_shm, dt_pickle / dt_shm))
+
+if __name__ == '__main__':
+    main()